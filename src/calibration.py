@@ -0,0 +1,251 @@
+'''
+Calibration of train motors from recorded telemetry.
+
+A train's speed depends on the motor duty cycle, on the battery voltage,
+and on the load (number of cars, friction). The model used here is the
+one of a DC motor with a dead band:
+
+    speed = gain * voltage * (duty - deadband)
+
+Gain and dead band are fitted per train, from runs recorded in the binary
+telemetry format (module recorder.py). Speed is measured as the length of
+a stretch of track in between two known signal tiles, divided by the time
+the train took to go from one tile to the next. Only stretches run at a
+constant power index are used.
+
+The fitted model is kept in a per-train profile, together with the speed
+each power index should produce. MotorHandler loads the profile at start
+up, and from then on picks the duty cycle that gives that speed at the
+current battery voltage. Trains thus hold their lap times as batteries
+drain. Speeds for each power index are taken from the hand-tuned duty
+cycle table the train uses, evaluated at nominal voltage, so a calibrated
+train at nominal voltage runs just as it did before.
+
+Usage, to fit a profile from the recorded files of a train:
+
+    python src/calibration.py <train name> <direction> [linear]
+
+where direction is either clockwise or counter_clockwise. Pass "linear"
+for trains built with linear=True, which use the linear duty cycle table.
+'''
+import os
+import sys
+import json
+import math
+
+from signal import RED, GREEN, BLUE, YELLOW
+from track import DIRECTION_A, DIRECTION_B
+from recorder import read_telemetry_session
+
+PROFILE_DIRECTORY = "profiles"
+
+NOMINAL_VOLTAGE = 8.0  # Volts
+MINIMUM_VOLTAGE = 6.0  # readings below this are not trusted (e.g. before the first one comes in)
+
+# lengths, in cm, of the stretches of track in between signal tiles, per
+# direction of movement. Keys are (name of the sector the train is in when
+# it detects the first tile, color of the first tile, color of the second
+# tile); sector None is the inter-sector zone. These must be measured on
+# the actual layout. The values here match the simulated layout in module
+# simhub.py.
+SEGMENT_LENGTHS = {
+    DIRECTION_A: {(None, YELLOW, BLUE): 60.,
+                  (None, BLUE, BLUE): 240.,
+                  (BLUE, BLUE, BLUE): 120.,
+                  (BLUE, BLUE, GREEN): 60.,
+                  (None, GREEN, GREEN): 280.,
+                  (GREEN, GREEN, RED): 50.},
+    DIRECTION_B: {(None, BLUE, BLUE): 240.,
+                  (BLUE, BLUE, BLUE): 120.,
+                  (BLUE, BLUE, GREEN): 60.,
+                  (None, GREEN, YELLOW): 80.,
+                  (GREEN, YELLOW, YELLOW): 80.,
+                  (GREEN, YELLOW, GREEN): 140.,
+                  (GREEN, GREEN, RED): 60.},
+}
+
+
+class Measurement():
+    '''
+    Speed measured over one stretch of track.
+
+    :param power_index: power index the train was running at
+    :param duty: mean duty cycle sent to the motor
+    :param voltage: mean battery voltage
+    :param speed: mean speed, in cm/s
+    '''
+    __slots__ = ("power_index", "duty", "voltage", "speed")
+
+    def __init__(self, power_index, duty, voltage, speed):
+        self.power_index = power_index
+        self.duty = duty
+        self.voltage = voltage
+        self.speed = speed
+
+
+class MotorProfile():
+    '''
+    Calibrated motor model of one train.
+
+    :param name: train name
+    :param gain: fitted gain, in cm/s per Volt
+    :param deadband: fitted dead band, as a duty cycle
+    :param target_speeds: dict with the speed, in cm/s, for each positive power index
+    :param nominal_voltage: voltage at which the target speeds were defined
+    :param samples: number of measurements used in the fit
+    :param rms_error: RMS residual of the fit, in cm/s
+    '''
+    def __init__(self, name, gain, deadband, target_speeds, nominal_voltage=NOMINAL_VOLTAGE,
+                 samples=0, rms_error=0.):
+        self.name = name
+        self.gain = gain
+        self.deadband = deadband
+        self.target_speeds = {int(index): speed for index, speed in target_speeds.items()}
+        self.nominal_voltage = nominal_voltage
+        self.samples = samples
+        self.rms_error = rms_error
+
+    def speed(self, duty, voltage):
+        '''
+        Speed the model predicts for the given duty cycle and voltage, in cm/s.
+        '''
+        return max(self.gain * voltage * (abs(duty) - self.deadband), 0.)
+
+    def duty(self, power_index, voltage):
+        '''
+        Duty cycle that gives the target speed of the power index at the
+        given voltage. Negative power indices give negative duty cycles.
+        '''
+        target = self.target_speeds.get(abs(power_index), 0.)
+        if target <= 0.:
+            return 0.
+        if voltage < MINIMUM_VOLTAGE:
+            voltage = self.nominal_voltage
+
+        duty = min(target / (self.gain * voltage) + self.deadband, 1.)
+        return math.copysign(duty, power_index)
+
+    def save(self, directory=PROFILE_DIRECTORY):
+        os.makedirs(directory, exist_ok=True)
+        with open(profile_file_name(self.name, directory), "w") as f:
+            json.dump({"name": self.name,
+                       "gain": self.gain,
+                       "deadband": self.deadband,
+                       "target_speeds": self.target_speeds,
+                       "nominal_voltage": self.nominal_voltage,
+                       "samples": self.samples,
+                       "rms_error": self.rms_error}, f, indent=4)
+
+
+def profile_file_name(name, directory=PROFILE_DIRECTORY):
+    return os.path.join(directory, name + ".json")
+
+
+def load_profile(name, directory=PROFILE_DIRECTORY):
+    '''
+    Loads the profile of the given train.
+
+    :return: a MotorProfile instance, or None if the train has no profile
+    '''
+    file_name = profile_file_name(name, directory)
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name) as f:
+        return MotorProfile(**json.load(f))
+
+
+def measure_segments(run, lengths):
+    '''
+    Measures speeds over the stretches of track in between consecutive
+    signal events in a recorded run. Stretches of unknown length, and the
+    ones where the power index changed or was zero, are skipped.
+
+    :param run: dict as returned by recorder.read_telemetry or read_telemetry_session
+    :param lengths: dict with stretch lengths, as in SEGMENT_LENGTHS
+    :return: list of Measurement instances
+    '''
+    sector_names = [None] + list(run["sectors"])
+    event_names = [None] + list(run["events"])
+
+    events = [k for k, code in enumerate(run["event"]) if code > 0]
+
+    result = []
+    for first, second in zip(events[:-1], events[1:]):
+        key = (sector_names[run["sector"][first]], event_names[run["event"][first]],
+               event_names[run["event"][second]])
+        length = lengths.get(key)
+        elapsed = run["time"][second] - run["time"][first]
+        if length is None or elapsed <= 0.:
+            continue
+
+        indices = set([int(index) for index in run["power_index"][first:second + 1]])
+        if len(indices) != 1 or 0 in indices:
+            continue
+
+        voltages = [float(v) for v in run["voltage"][first:second + 1] if v >= MINIMUM_VOLTAGE]
+        if len(voltages) == 0:
+            continue
+        duties = [abs(float(p)) for p in run["power"][first:second + 1]]
+
+        result.append(Measurement(indices.pop(), sum(duties) / len(duties),
+                                  sum(voltages) / len(voltages), length / elapsed))
+    return result
+
+
+def fit_profile(name, measurements, duty_table, nominal_voltage=NOMINAL_VOLTAGE):
+    '''
+    Fits the motor model to the measurements, by least squares on
+    speed / voltage as a linear function of the duty cycle.
+
+    :param name: train name
+    :param measurements: list of Measurement instances
+    :param duty_table: dict with the duty cycle of each power index (at
+        nominal voltage), from which the target speeds are derived
+    :param nominal_voltage: voltage at which the duty cycle table applies
+    :return: a MotorProfile instance
+    '''
+    x = [m.duty for m in measurements]
+    y = [m.speed / m.voltage for m in measurements]
+    n = len(measurements)
+    if n < 2 or max(x) - min(x) < 1.e-3:
+        raise ValueError("at least two different duty cycles are needed to calibrate " + name)
+
+    mean_x = sum(x) / n
+    mean_y = sum(y) / n
+    slope = sum([(xi - mean_x) * (yi - mean_y) for xi, yi in zip(x, y)]) / \
+            sum([(xi - mean_x) ** 2 for xi in x])
+    intercept = mean_y - slope * mean_x
+    if slope <= 0.:
+        raise ValueError("speed doesn't increase with duty cycle; can't calibrate " + name)
+
+    gain = slope
+    deadband = -intercept / slope
+
+    residuals = [m.speed - gain * m.voltage * (m.duty - deadband) for m in measurements]
+    rms_error = math.sqrt(sum([r * r for r in residuals]) / n)
+
+    target_speeds = {index: max(gain * nominal_voltage * (duty - deadband), 0.)
+                     for index, duty in duty_table.items() if index > 0}
+
+    return MotorProfile(name, gain, deadband, target_speeds, nominal_voltage=nominal_voltage,
+                        samples=n, rms_error=rms_error)
+
+
+if __name__ == '__main__':
+    from train import MotorHandler
+
+    train_name = sys.argv[1]
+    direction = sys.argv[2]
+    duty_table = MotorHandler.duty
+    if len(sys.argv) > 3:
+        if sys.argv[3] != "linear":
+            raise ValueError("unknown argument: " + sys.argv[3])
+        duty_table = MotorHandler.duty_linear
+
+    session = read_telemetry_session(train_name)
+    profile = fit_profile(train_name, measure_segments(session, SEGMENT_LENGTHS[direction]),
+                          duty_table, nominal_voltage=MotorHandler.NOMINAL_VOLTAGE)
+    profile.save()
+
+    print("%s: gain %.2f cm/s/V, dead band %.3f, %i measurements, RMS error %.1f cm/s" %
+          (profile.name, profile.gain, profile.deadband, profile.samples, profile.rms_error))
@@ -0,0 +1,268 @@
+'''
+Capture of raw vision sensor readings, and replay of captures through the
+train's sensor pipeline.
+
+A capture holds timestamped (r, g, b) readings, exactly as they come in
+with the BLE notifications of one hub. Readings are kept in a fixed-size
+in-memory ring buffer, so the most recent ones are always at hand, and a
+long-running capture uses a bounded amount of memory. Recording a reading
+packs it in place in the buffer; it never allocates or waits, thus it can
+run in the BLE notification thread. The buffer is written to file when
+asked to, and at exit.
+
+Capture files (extension .cap) have a header, followed by fixed-width
+little-endian records. The header is the 4-byte magic string b"LGSC", the
+length of the JSON metadata that follows as a 4-byte unsigned int, and the
+metadata itself: record format, field names, hub name, and wall-clock
+time of the first reading. Records are (format "<dHHH", 14 bytes):
+
+    time   float64  clock time, in sec.
+    r      uint16
+    g      uint16
+    b      uint16
+
+A capture can be fed back to SmartTrain._vision_sensor_callback, and from
+there through classification, SensorEventFilter and EventProcessor, at
+the original speed, N times faster, or as fast as possible. This is
+useful to benchmark the classification and filtering stages on real
+traces, and to reproduce field incidents without the trains.
+
+Readings are captured by trains built with capture=True. Usage, to replay
+a capture into a train running on a simulated hub:
+
+    python src/capture.py <capture file> [speed]
+
+where speed is a multiple of the original speed (default 1), or "fast"
+to replay as fast as possible. Replays on a virtual clock (pass "virtual")
+keep the original timing, and take no wall-clock time waiting.
+'''
+import os
+import sys
+import json
+import time
+import array
+import atexit
+import struct
+
+from clock import clock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EXTENSION = ".cap"
+
+FIELDS = ["time", "r", "g", "b"]
+
+MAGIC = b"LGSC"
+RECORD_FORMAT = "<dHHH"
+RECORD = struct.Struct(RECORD_FORMAT)
+HEADER_LENGTH = struct.Struct("<I")
+
+# array type codes for each field, used when NumPy is not available
+TYPECODES = ["d", "H", "H", "H"]
+
+CAPACITY = 2 ** 18  # readings; at 20 readings/s, more than 3 hours
+CHANNEL_MAXIMUM = 2 ** 16 - 1
+
+
+class SensorCapture():
+    '''
+    Ring buffer of the most recent vision sensor readings of one hub.
+
+    :param name: hub owner name, used to name the capture file
+    :param directory: directory where the capture file is written
+    :param capacity: number of readings kept
+    :param save_at_exit: if True, the buffer is written to file at exit
+    '''
+    def __init__(self, name, directory=".", capacity=CAPACITY, save_at_exit=True):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self.capacity = capacity
+
+        self.buffer = bytearray(capacity * RECORD.size)
+        self.position = 0
+        self.count = 0
+        self.start = None
+
+        if save_at_exit:
+            atexit.register(self.save)
+
+    def record(self, r, g, b):
+        '''
+        Stores one reading. Never blocks; can be called from the BLE thread.
+        '''
+        if self.start is None:
+            self.start = time.time()
+
+        RECORD.pack_into(self.buffer, self.position * RECORD.size, clock.now(),
+                         min(r, CHANNEL_MAXIMUM), min(g, CHANNEL_MAXIMUM), min(b, CHANNEL_MAXIMUM))
+        self.position = (self.position + 1) % self.capacity
+        self.count += 1
+
+    @property
+    def size(self):
+        # number of readings in the buffer
+        return min(self.count, self.capacity)
+
+    @property
+    def dropped(self):
+        # number of readings overwritten by newer ones
+        return self.count - self.size
+
+    def save(self, file_name=None):
+        '''
+        Writes the readings in the buffer, oldest first, to a capture file.
+
+        :param file_name: defaults to <directory>/<name>.cap
+        :return: the file name, or None if there was nothing to write
+        '''
+        # the BLE thread may keep recording while this runs. Position is
+        # read once, so the result is consistent except, at most, for the
+        # oldest few readings.
+        position = self.position
+        size = self.size
+        if size == 0:
+            return None
+        if file_name is None:
+            file_name = self.path + EXTENSION
+
+        split = position * RECORD.size
+        if size < self.capacity:
+            data = bytes(self.buffer[:split])
+        else:
+            data = bytes(self.buffer[split:]) + bytes(self.buffer[:split])
+
+        metadata = json.dumps({"name": self.name,
+                               "record_format": RECORD_FORMAT,
+                               "fields": FIELDS,
+                               "start": self.start}).encode()
+        with open(file_name, "wb") as f:
+            f.write(MAGIC + HEADER_LENGTH.pack(len(metadata)) + metadata)
+            f.write(data)
+        return file_name
+
+
+def read_capture(file_name):
+    '''
+    Loads a capture file.
+
+    :return: dict with one array per field (NumPy arrays when NumPy is
+        available, else array.array instances), plus the hub owner name
+        and the wall-clock time of the first reading, keyed by "name"
+        and "start".
+    '''
+    with open(file_name, "rb") as f:
+        data = f.read()
+
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("not a capture file: " + file_name)
+    start = len(MAGIC) + HEADER_LENGTH.size
+    length, = HEADER_LENGTH.unpack_from(data, len(MAGIC))
+    metadata = json.loads(data[start:start + length].decode())
+    start += length
+
+    record = struct.Struct(metadata["record_format"])
+    end = start + (len(data) - start) // record.size * record.size
+
+    if numpy is not None:
+        dtype = numpy.dtype({"names": metadata["fields"],
+                             "formats": ["<f8", "<u2", "<u2", "<u2"],
+                             "offsets": [0, 8, 10, 12],
+                             "itemsize": record.size})
+        records = numpy.frombuffer(data, dtype=dtype, offset=start, count=(end - start) // record.size)
+        result = {field: records[field] for field in metadata["fields"]}
+    else:
+        columns = list(zip(*record.iter_unpack(data[start:end])))
+        if len(columns) == 0:
+            columns = [()] * len(metadata["fields"])
+        result = {field: array.array(typecode, column)
+                  for field, typecode, column in zip(metadata["fields"], TYPECODES, columns)}
+
+    result["name"] = metadata["name"]
+    result["start"] = metadata["start"]
+    return result
+
+
+def replay(capture, callback, speed=1.):
+    '''
+    Feeds the readings in a capture to a vision sensor callback, such as
+    SmartTrain._vision_sensor_callback, in the calling thread.
+
+    On a real clock, the original time in between readings is divided by
+    speed; a speed of None feeds readings as fast as possible. On a virtual
+    clock, readings always come at their original times: the caller drives
+    the clock, so waiting costs nothing, and everything the readings trigger
+    runs just as it did when they were captured.
+
+    :param capture: dict as returned by read_capture
+    :param callback: function called with (r, g, b) for each reading
+    :param speed: replay speed, as a multiple of the original speed, or None
+    :return: dict with the number of readings replayed, the time they
+        span in the capture, the wall-clock time the replay took, and
+        the number of readings fed per wall-clock second
+    '''
+    times = [float(t) for t in capture["time"]]
+    readings = list(zip([int(v) for v in capture["r"]],
+                        [int(v) for v in capture["g"]],
+                        [int(v) for v in capture["b"]]))
+    if clock.virtual:
+        speed = 1.
+
+    wall_start = time.perf_counter()
+    if len(times) > 0:
+        first = times[0]
+        start = clock.now()
+        for reading_time, (r, g, b) in zip(times, readings):
+            if speed is not None:
+                delay = start + (reading_time - first) / speed - clock.now()
+                if delay > 0.:
+                    clock.sleep(delay)
+            callback(r, g, b)
+    wall_time = time.perf_counter() - wall_start
+
+    return {"samples": len(times),
+            "duration": times[-1] - times[0] if len(times) > 0 else 0.,
+            "wall_time": wall_time,
+            "samples_per_second": len(times) / wall_time if wall_time > 0. else 0.}
+
+
+if __name__ == '__main__':
+    # the simulated hubs must be selected before module train is imported
+    os.environ["LEGOTRAIN_HUB"] = "sim"
+
+    import simhub
+    from clock import VirtualClock
+    from scheduler import scheduler, VIRTUAL
+    from train import SmartTrain
+
+    file_name = sys.argv[1]
+    replay_speed = 1.
+    virtual = False
+    if len(sys.argv) > 2:
+        if sys.argv[2] == "fast":
+            replay_speed = None
+        elif sys.argv[2] == "virtual":
+            virtual = True
+        else:
+            replay_speed = float(sys.argv[2])
+
+    if virtual:
+        clock.use(VirtualClock())
+        scheduler.select(VIRTUAL)
+
+    # the simulated layout is never stepped, thus the simulated hub's own
+    # sensor stays silent, and the train only sees the captured readings.
+    simhub.layout_simulator = simhub.SimulatedLayout(realtime=False)
+    train = SmartTrain("replay", address="replay")
+    train.auto = True
+    train.initialize_sectors()
+
+    statistics = replay(read_capture(file_name), train._vision_sensor_callback, speed=replay_speed)
+    clock.sleep(1.)
+
+    print("%i readings spanning %.1f s, replayed in %.2f s (%.0f readings/s)" %
+          (statistics["samples"], statistics["duration"], statistics["wall_time"],
+           statistics["samples_per_second"]))
+    print("events:", train.event_queue.statistics())
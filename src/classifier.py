@@ -0,0 +1,494 @@
+'''
+Classification of vision sensor RGB readings into signal tile colors.
+
+The reference classification works in HSV space, comparing hue and
+saturation against the ranges defined in signal.py. It is too expensive
+to run on every sensor notification, since it involves floating point
+color space conversion plus a search over all colors. Instead, it is
+used once at startup to compile a lookup table indexed directly by the
+raw (r, g, b) sensor values.
+
+Any classifier with the interface of class Classifier can be compiled
+into the lookup table. Besides the HSV one, there is a statistical
+classifier (MahalanobisClassifier) that models each color as a cluster
+in the chromaticity plane, with its own tilt and elongation, and
+rejects readings too far from every cluster.
+
+Either classifier can be fitted to labeled sensor captures with module
+thresholds.py. It writes a threshold table, plus the lookup table
+compiled from it, which trains load at startup in place of the ranges in
+signal.py.
+'''
+import os
+import json
+import zlib
+import struct
+from math import floor, ceil, exp, log
+from colorsys import rgb_to_hsv
+
+from signal import HUE, SATURATION, RGB_MINIMUM, V_MINIMUM
+from signal import RED, GREEN, BLUE, YELLOW, PURPLE
+
+# colors are tested in this order; the first match wins.
+COLOR_ORDER = [PURPLE, BLUE, GREEN, RED, YELLOW]
+
+# pylgbst scales the sensor readings to the 0-255 range, but bright
+# surfaces can still generate larger values. Readings with any channel
+# at or above this value are not in the lookup table, and are classified
+# by the reference algorithm instead.
+LUT_SIZE = 256
+
+# hue sectors as computed by colorsys.rgb_to_hsv. Each entry holds the
+# indices of the channels with maximum, minimum and middle values, and
+# (base, sense) such that hue = (base + sense * t) / 6, where t is the
+# position of the middle value in between the minimum and the maximum.
+_HUE_SECTORS = [(0, 2, 1, 0,  1),
+                (0, 1, 2, 6, -1),
+                (1, 2, 0, 2, -1),
+                (1, 0, 2, 2,  1),
+                (2, 0, 1, 4, -1),
+                (2, 1, 0, 4,  1)]
+
+# hue values up to this limit are shifted by 1. to handle the RED wrap-around
+HUE_WRAP = 0.05
+
+# files written by the threshold fitting tool
+THRESHOLD_FILE = "thresholds.json"
+TABLE_FILE = "thresholds.lut"
+
+TABLE_MAGIC = b"LGLT"
+HEADER_LENGTH = struct.Struct("<I")
+
+# classifier types, as stored in the threshold table file
+HSV = "hsv"
+MAHALANOBIS = "mahalanobis"
+
+# readings whose confidence falls below this are rejected by the statistical
+# classifier. In two dimensions, confidence is exp(-d^2 / 2), where d is the
+# Mahalanobis distance, so this rejects readings more than 4.3 standard
+# deviations away from every color.
+MINIMUM_CONFIDENCE = 1.e-4
+
+# minimum standard deviation of each color cluster, in chromaticity units.
+# A few hundred readings taken under one lighting condition give clusters
+# too tight to hold under another.
+MINIMUM_SIGMA = 0.005
+
+# the statistical classifier compiles this many table entries at a time
+COMPILE_CHUNK = 2 ** 16
+
+
+class Classifier:
+    '''
+    Interface of the classifiers that can be compiled into a ColorLookupTable.
+
+    Subclasses set attribute colors, the list of colors they may return, and
+    implement methods score and parameters. Method compile has a generic
+    implementation based on method candidates, that subclasses may replace
+    with a faster one.
+    '''
+    type = None
+    colors = []
+
+    def classify(self, r, g, b):
+        '''
+        Returns the signal color that matches the reading, or None
+        '''
+        color, confidence = self.score(r, g, b)
+        return color
+
+    def score(self, r, g, b):
+        '''
+        Returns (color, confidence), where confidence is in the 0-1 range.
+        Color is None if the reading is rejected.
+        '''
+        raise NotImplementedError
+
+    def parameters(self):
+        '''
+        Returns a dict with the classifier parameters, as stored in the
+        threshold table file, type included.
+        '''
+        raise NotImplementedError
+
+    def candidates(self, size):
+        '''
+        Generates (r, g, b) readings, with all channels smaller than size,
+        that may be classified as a signal color.
+        '''
+        raise NotImplementedError
+
+    def compile(self, size):
+        '''
+        Classifies every reading with all channels smaller than size.
+
+        :return: bytearray with one entry per reading, indexed by
+            (r * size + g) * size + b. Entries are zero for no color,
+            else the index of the color in colors, plus one.
+        '''
+        codes = {color: index + 1 for index, color in enumerate(self.colors)}
+        table = bytearray(size * size * size)
+        for r, g, b in self.candidates(size):
+            color = self.classify(r, g, b)
+            if color is not None:
+                table[(r * size + g) * size + b] = codes[color]
+        return table
+
+
+class HSVClassifier(Classifier):
+    '''
+    Reference classifier. It maps a sensor reading to a signal color by
+    finding the color whose hue and saturation ranges contain the reading.
+    Readings with low signal-to-noise ratio are rejected.
+
+    :param hue: dict with (min, max) hue ranges, keyed by color
+    :param saturation: dict with (min, max) saturation ranges, keyed by color
+    :param rgb_minimum: readings with any channel below this are rejected
+    :param v_minimum: readings with brightness below this are rejected
+    :param colors: colors to test, in order
+    '''
+    type = HSV
+
+    def __init__(self, hue=HUE, saturation=SATURATION, rgb_minimum=RGB_MINIMUM,
+                 v_minimum=V_MINIMUM, colors=COLOR_ORDER):
+        self.hue = hue
+        self.saturation = saturation
+        self.rgb_minimum = rgb_minimum
+        self.v_minimum = v_minimum
+        self.colors = colors
+
+    def classify(self, r, g, b):
+        '''
+        Returns the signal color that matches the reading, or None
+        '''
+        # use HSV as criterion for mapping colors
+        h, s, v = rgb_to_hsv(r, g, b)
+
+        if h >= 1. or h <= 0.:
+            return None
+
+        # RED hue flips back to zero when crossing 1. We add 1. here
+        # so the comparison logic downstream works.
+        if h > 0. and h <= HUE_WRAP:
+            h += 1.
+
+        # ignore events with low signal-to-noise ratio
+        if min(r, g, b) >= self.rgb_minimum and v >= self.v_minimum:
+
+            # find matching color.
+            for color in self.colors:
+
+                if (h >= self.hue[color][0] and h <= self.hue[color][1]) and \
+                   (s >= self.saturation[color][0] and s <= self.saturation[color][1]):
+
+                    return color
+
+        return None
+
+    def score(self, r, g, b):
+        # readings are either in a color's box, or not
+        color = self.classify(r, g, b)
+        return color, 0. if color is None else 1.
+
+    def parameters(self):
+        return {"type": self.type,
+                "hue": {color: list(self.hue[color]) for color in self.colors},
+                "saturation": {color: list(self.saturation[color]) for color in self.colors},
+                "rgb_minimum": self.rgb_minimum,
+                "v_minimum": self.v_minimum,
+                "colors": list(self.colors)}
+
+    def candidates(self, size):
+        '''
+        Generates (r, g, b) readings, with all channels smaller than size,
+        that may be classified as a signal color. All readings that method
+        classify maps to a color are generated; a few readings that it
+        rejects are generated as well.
+
+        Scanning the entire RGB cube would take too long. Instead, for each
+        pair of maximum and minimum channel values, the saturation is fixed,
+        and within each hue sector the hue is a linear function of the middle
+        channel value. This narrows down the search to a thin slab around
+        each color's hue range.
+        '''
+        v_start = max(int(ceil(self.v_minimum)), 1)
+        min_start = max(int(ceil(self.rgb_minimum)), 0)
+
+        for color in self.colors:
+            s_min, s_max = self.saturation[color]
+            hue_ranges = self._unwrapped_hue_ranges(color)
+
+            for maxc in range(v_start, size):
+                for minc in range(min_start, maxc):
+
+                    # same expression used by colorsys.rgb_to_hsv
+                    s = (maxc - minc) / maxc
+                    if s < s_min or s > s_max:
+                        continue
+
+                    for imax, imin, imid, base, sense in _HUE_SECTORS:
+                        for h0, h1 in hue_ranges:
+                            t0 = sense * (6. * h0 - base)
+                            t1 = sense * (6. * h1 - base)
+                            if t0 > t1:
+                                t0, t1 = t1, t0
+                            if t1 < 0. or t0 > 1.:
+                                continue
+
+                            # pad by one unit to be safe against round-off
+                            rangec = maxc - minc
+                            low = max(minc, floor(minc + t0 * rangec) - 1)
+                            high = min(maxc, ceil(minc + t1 * rangec) + 1)
+
+                            rgb = [0, 0, 0]
+                            rgb[imax] = maxc
+                            rgb[imin] = minc
+                            for mid in range(low, high + 1):
+                                rgb[imid] = mid
+                                yield tuple(rgb)
+
+    def _unwrapped_hue_ranges(self, color):
+        # hue ranges, as they come out of colorsys.rgb_to_hsv, that map to
+        # the color's hue range after the RED wrap-around is applied.
+        h0, h1 = self.hue[color]
+        result = []
+        if max(h0, HUE_WRAP) <= min(h1, 1.):
+            result.append((max(h0, HUE_WRAP), min(h1, 1.)))
+        if max(h0, 1.) <= min(h1, 1. + HUE_WRAP):
+            result.append((max(h0, 1.) - 1., min(h1, 1. + HUE_WRAP) - 1.))
+        return result
+
+
+class MahalanobisClassifier(Classifier):
+    '''
+    Statistical classifier. Each color is modeled as a Gaussian cluster in
+    the chromaticity plane (r / (r + g + b), g / (r + g + b)), which does
+    not depend on brightness. A reading goes to the color at the smallest
+    Mahalanobis distance, that is, the distance measured in standard
+    deviations along the cluster's own axes, whatever their tilt. Readings
+    too far from every color, or with low signal-to-noise ratio, are rejected.
+
+    :param centroids: dict with the (x, y) chromaticity mean, keyed by color
+    :param covariances: dict with the 2x2 chromaticity covariance matrix, as
+        nested lists, keyed by color
+    :param min_confidence: readings with lower confidence are rejected
+    :param rgb_minimum: readings with any channel below this are rejected
+    :param v_minimum: readings with brightness below this are rejected
+    :param colors: colors to test; on a tie, the first one wins
+    '''
+    type = MAHALANOBIS
+
+    def __init__(self, centroids, covariances, min_confidence=MINIMUM_CONFIDENCE,
+                 rgb_minimum=RGB_MINIMUM, v_minimum=V_MINIMUM, colors=COLOR_ORDER):
+        self.colors = [color for color in colors if color in centroids]
+        if len(self.colors) == 0:
+            raise ValueError("no color to classify")
+        self.centroids = {color: tuple(centroids[color]) for color in self.colors}
+        self.covariances = {color: [list(row) for row in covariances[color]] for color in self.colors}
+        self.min_confidence = min_confidence
+        self.rgb_minimum = rgb_minimum
+        self.v_minimum = v_minimum
+
+        # squared distance limit, and (a, b, c) coefficients of the inverse
+        # covariance matrix [[a, b], [b, c]] of each color
+        self.max_distance2 = -2. * log(min_confidence)
+        self.inverses = {}
+        for color in self.colors:
+            (sxx, sxy), (syx, syy) = self.covariances[color]
+            determinant = sxx * syy - sxy * syx
+            if determinant <= 0.:
+                raise ValueError("singular covariance matrix for color " + color)
+            self.inverses[color] = (syy / determinant, -sxy / determinant, sxx / determinant)
+
+    def distances2(self, x, y):
+        '''
+        Squared Mahalanobis distances of a chromaticity point to each color,
+        in the order of colors. Arguments may be NumPy arrays.
+        '''
+        result = []
+        for color in self.colors:
+            a, b, c = self.inverses[color]
+            dx = x - self.centroids[color][0]
+            dy = y - self.centroids[color][1]
+            result.append(a * dx * dx + 2. * b * dx * dy + c * dy * dy)
+        return result
+
+    def score(self, r, g, b):
+        if min(r, g, b) < self.rgb_minimum or max(r, g, b) < self.v_minimum:
+            return None, 0.
+
+        total = r + g + b
+        if total == 0:
+            return None, 0.
+        distances2 = self.distances2(r / total, g / total)
+        best = None
+        for index, distance2 in enumerate(distances2):
+            if best is None or distance2 < distances2[best]:
+                best = index
+
+        if best is None or distances2[best] > self.max_distance2:
+            return None, 0.
+        return self.colors[best], exp(-0.5 * distances2[best])
+
+    def score_array(self, readings):
+        '''
+        Vectorized equivalent of method score, over many readings.
+
+        :param readings: NumPy array with one (r, g, b) row per reading
+        :return: (indices, confidences), NumPy arrays with the index of each
+            reading's color in colors, or -1 for no color, and its confidence
+        '''
+        import numpy  # only needed to compile and fit
+
+        readings = numpy.asarray(readings, dtype=float)
+        r, g, b = readings[:, 0], readings[:, 1], readings[:, 2]
+        accepted = (readings.min(axis=1) >= self.rgb_minimum) & (readings.max(axis=1) >= self.v_minimum)
+
+        # same operations, in the same order, as method score, so results
+        # are identical. The divisor is only replaced where readings are
+        # rejected anyway.
+        total = r + g + b
+        accepted &= total > 0.
+        total = numpy.where(accepted, total, 1.)
+        distances2 = numpy.array(self.distances2(r / total, g / total)).reshape(len(self.colors), len(readings))
+
+        indices = numpy.argmin(distances2, axis=0)
+        nearest = distances2[indices, numpy.arange(len(readings))]
+        accepted &= nearest <= self.max_distance2
+
+        indices = numpy.where(accepted, indices, -1)
+        confidences = numpy.where(accepted, numpy.exp(-0.5 * nearest), 0.)
+        return indices, confidences
+
+    def compile(self, size):
+        # the whole RGB cube is classified, in chunks, with NumPy
+        import numpy
+
+        table = numpy.zeros(size * size * size, dtype=numpy.uint8)
+        for start in range(0, len(table), COMPILE_CHUNK):
+            index = numpy.arange(start, min(start + COMPILE_CHUNK, len(table)))
+            readings = numpy.column_stack([index // (size * size), index // size % size, index % size])
+            table[start:start + len(index)] = self.score_array(readings)[0] + 1
+        return bytearray(table.tobytes())
+
+    def parameters(self):
+        return {"type": self.type,
+                "centroids": {color: list(self.centroids[color]) for color in self.colors},
+                "covariances": {color: self.covariances[color] for color in self.colors},
+                "min_confidence": self.min_confidence,
+                "rgb_minimum": self.rgb_minimum,
+                "v_minimum": self.v_minimum,
+                "colors": list(self.colors)}
+
+
+class ColorLookupTable:
+    '''
+    Dense lookup table that maps raw (r, g, b) sensor readings to signal
+    colors. It is compiled once from a classifier (any Classifier subclass),
+    and returns exactly the same colors as the classifier itself, at the
+    cost of one indexed read per sensor reading. Readings outside the table
+    are handed over to the classifier.
+
+    Only colors are stored, not confidences: a classifier that rejects
+    readings below a confidence threshold does so when the table is
+    compiled. Confidences are available from the classifier's score method,
+    for analysis off the sensor path.
+
+    The table takes one byte per entry (16 MB for the default size).
+
+    :param classifier: classifier to compile; defaults to an HSVClassifier
+        built from the parameters in signal.py
+    :param size: number of entries in each RGB axis
+    :param table: table previously compiled from the same classifier; if
+        None, the table is compiled here
+    '''
+    def __init__(self, classifier=None, size=LUT_SIZE, table=None):
+        self.classifier = classifier
+        if self.classifier is None:
+            self.classifier = HSVClassifier()
+        self.size = size
+
+        # table entries are indices into this list. Zero means no color.
+        self.colors = [None] + list(self.classifier.colors)
+
+        if table is not None:
+            self.table = bytearray(table)
+        else:
+            self.table = self.classifier.compile(size)
+
+    def lookup(self, r, g, b):
+        '''
+        Returns the signal color that matches the reading, or None
+        '''
+        size = self.size
+        if r < size and g < size and b < size:
+            return self.colors[self.table[(r * size + g) * size + b]]
+        return self.classifier.classify(r, g, b)
+
+    def save(self, file_name=TABLE_FILE):
+        '''
+        Writes the table to file, compressed, together with the classifier
+        parameters it was compiled from.
+        '''
+        metadata = json.dumps({"size": self.size,
+                               "parameters": self.classifier.parameters()}).encode()
+        with open(file_name, "wb") as f:
+            f.write(TABLE_MAGIC + HEADER_LENGTH.pack(len(metadata)) + metadata)
+            f.write(zlib.compress(bytes(self.table)))
+
+
+def load_thresholds(file_name=THRESHOLD_FILE):
+    '''
+    Builds a classifier from a threshold table written by module thresholds.py.
+
+    :return: an HSVClassifier or MahalanobisClassifier instance, depending
+        on the type stored in the file, or None if the file doesn't exist
+    '''
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name) as f:
+        thresholds = json.load(f)
+
+    # files written before there was a choice hold HSV ranges
+    if thresholds.get("type", HSV) == MAHALANOBIS:
+        return MahalanobisClassifier(thresholds["centroids"], thresholds["covariances"],
+                                     min_confidence=thresholds["min_confidence"],
+                                     rgb_minimum=thresholds["rgb_minimum"],
+                                     v_minimum=thresholds["v_minimum"],
+                                     colors=thresholds["colors"])
+
+    return HSVClassifier(hue={color: tuple(value) for color, value in thresholds["hue"].items()},
+                         saturation={color: tuple(value) for color, value in thresholds["saturation"].items()},
+                         rgb_minimum=thresholds["rgb_minimum"],
+                         v_minimum=thresholds["v_minimum"],
+                         colors=thresholds["colors"])
+
+
+def load_color_table(threshold_file=THRESHOLD_FILE, table_file=TABLE_FILE):
+    '''
+    Builds the lookup table used by the trains: from the classifier in the
+    fitted threshold table if there is one, else from the parameters in
+    signal.py. A table file compiled from the same parameters is loaded
+    instead of compiling the table again; one compiled from other
+    parameters is ignored.
+
+    :return: a ColorLookupTable instance
+    '''
+    classifier = load_thresholds(threshold_file)
+    if classifier is None:
+        classifier = HSVClassifier()
+
+    if os.path.exists(table_file):
+        with open(table_file, "rb") as f:
+            data = f.read()
+        if data[:len(TABLE_MAGIC)] == TABLE_MAGIC:
+            start = len(TABLE_MAGIC) + HEADER_LENGTH.size
+            length, = HEADER_LENGTH.unpack_from(data, len(TABLE_MAGIC))
+            metadata = json.loads(data[start:start + length].decode())
+            # parameters are compared the way they are stored
+            expected = json.loads(json.dumps(classifier.parameters()))
+            if metadata["parameters"] == expected:
+                return ColorLookupTable(classifier, size=metadata["size"],
+                                        table=zlib.decompress(data[start + length:]))
+
+    return ColorLookupTable(classifier)
@@ -0,0 +1,222 @@
+'''
+Time source for the control logic.
+
+Code that needs the current time, needs to sleep, or needs to wait on a
+condition variable with a timeout, does it through the shared clock
+instance defined here. Normally this is a RealClock, a thin wrapper
+around the time module. A simulation replaces it with a VirtualClock,
+where time only advances when every participant thread is blocked, and
+then jumps straight to the next pending wake-up. Hours of operation can
+then run in seconds, and timing becomes reproducible.
+'''
+import time
+import heapq
+import traceback
+from itertools import count
+from threading import Thread, Event, local
+
+# virtual clocks can't be notified by condition variables, thus threads
+# waiting on a condition re-check their predicate at this interval.
+POLL_INTERVAL = 0.05  # s
+
+
+class RealClock():
+    '''
+    Wall-clock time, from a monotonic source.
+    '''
+    virtual = False
+
+    def now(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait_for(self, condition, predicate, timeout=None):
+        '''
+        Same as condition.wait_for. The caller must hold the condition's lock.
+        '''
+        return condition.wait_for(predicate, timeout)
+
+
+class VirtualClock():
+    '''
+    Discrete-event clock. Time is a number that advances only when the
+    simulation driver calls method run.
+
+    Code runs in participant threads, only one of them at any time. A
+    participant runs until it sleeps, waits, or finishes; the driver then
+    jumps to the time of the earliest pending wake-up and resumes whatever
+    is waiting for it. Participant threads are pooled and reused.
+
+    The driver can also schedule plain callables, that run in the driver's
+    own thread. These must never sleep or wait.
+
+    :param start: initial time, in sec.
+    '''
+    virtual = True
+
+    def __init__(self, start=0.):
+        self.time = start
+
+        # heap entries are (time, sequence number, item), where item is
+        # either an Event that resumes a sleeping participant, a job to be
+        # started in a participant, or a callable run by the driver.
+        self.heap = []
+        self.sequence = count()
+
+        # set by the running participant when it gives control back
+        self.idle = Event()
+        self.workers = []
+        self.local = local()
+
+    def now(self):
+        return self.time
+
+    def sleep(self, seconds):
+        '''
+        Blocks the calling participant for the given amount of virtual time.
+
+        Called from any other thread, it acts as the driver instead, and runs
+        everything that is due within the given amount of time. This lets
+        test code and start-up sequences sleep as they would in real time.
+        '''
+        if not getattr(self.local, "participant", False):
+            self.run(self.time + max(seconds, 0.))
+            return
+
+        wake = Event()
+        self._push(self.time + max(seconds, 0.), wake)
+        self.idle.set()
+        wake.wait()
+
+    def wait_for(self, condition, predicate, timeout=None):
+        '''
+        Equivalent of condition.wait_for in virtual time. The caller must
+        hold the condition's lock exactly once; it is released while sleeping.
+        '''
+        deadline = None if timeout is None else self.time + timeout
+        result = predicate()
+        while not result:
+            if deadline is not None and self.time >= deadline:
+                break
+            interval = POLL_INTERVAL
+            if deadline is not None:
+                interval = min(interval, deadline - self.time)
+
+            condition.release()
+            try:
+                self.sleep(interval)
+            finally:
+                condition.acquire()
+            result = predicate()
+        return result
+
+    def spawn(self, function, *args, delay=0.):
+        '''
+        Runs function(*args) in a participant thread, after delay seconds.
+        '''
+        self._push(self.time + delay, (function, args))
+
+    def call_at(self, when, function, *args):
+        '''
+        Runs function(*args) in the driver thread, at the given time.
+        '''
+        self._push(when, lambda: function(*args))
+
+    def run(self, until):
+        '''
+        Runs everything that is due up to the given time, and leaves the
+        clock at that time. Must be called from a non-participant thread.
+        '''
+        while self.heap and self.heap[0][0] <= until:
+            when, sequence, item = heapq.heappop(self.heap)
+            self.time = when
+
+            if isinstance(item, Event):
+                self._resume(item.set)
+            elif isinstance(item, tuple):
+                self._resume(lambda: self._start_job(item))
+            else:
+                item()
+
+        self.time = max(self.time, until)
+
+    def _push(self, when, item):
+        heapq.heappush(self.heap, (when, next(self.sequence), item))
+
+    def _resume(self, action):
+        # hands control over to a participant, and waits until it gives it back
+        self.idle.clear()
+        action()
+        self.idle.wait()
+
+    def _start_job(self, job):
+        if self.workers:
+            worker = self.workers.pop()
+        else:
+            worker = _Participant(self)
+        worker.start_job(job)
+
+
+class _Participant():
+    # pooled thread that runs jobs for a VirtualClock
+    def __init__(self, clock):
+        self.clock = clock
+        self.job = None
+        self.wake = Event()
+        Thread(target=self._loop, name="virtual clock participant", daemon=True).start()
+
+    def start_job(self, job):
+        self.job = job
+        self.wake.set()
+
+    def _loop(self):
+        self.clock.local.participant = True
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+
+            function, args = self.job
+            try:
+                function(*args)
+            except Exception:
+                traceback.print_exc()
+
+            self.job = None
+            self.clock.workers.append(self)
+            self.clock.idle.set()
+
+
+class ClockSelector():
+    '''
+    Front end to the clock in use. Modules import the shared instance
+    below by name, thus the clock is switched by replacing the one behind
+    it, before anything time-related gets started.
+    '''
+    def __init__(self):
+        self.backend = RealClock()
+
+    def use(self, backend):
+        self.backend = backend
+
+    @property
+    def virtual(self):
+        return self.backend.virtual
+
+    def now(self):
+        return self.backend.now()
+
+    def sleep(self, seconds):
+        self.backend.sleep(seconds)
+
+    def spawn(self, function, *args, delay=0.):
+        # only available in virtual clocks
+        self.backend.spawn(function, *args, delay=delay)
+
+    def wait_for(self, condition, predicate, timeout=None):
+        return self.backend.wait_for(condition, predicate, timeout)
+
+
+# clock shared by the entire system
+clock = ClockSelector()
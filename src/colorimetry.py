@@ -0,0 +1,210 @@
+'''
+Vectorized colorimetry analysis of vision sensor captures.
+
+Captures are either CSV files with one "r , g , b" reading per line, as
+the ones in test/data, or binary capture files written by module
+capture.py. All readings in a capture set are loaded into one NumPy
+array, converted to HSV in one go, and summarized per file: mean,
+standard deviation, minimum, maximum and percentiles of each of the H,
+S, V, R, G and B channels.
+
+Large capture sets are loaded and summarized in a pool of processes, one
+file per task. Small sets are done in the calling process, since starting
+the pool would take longer than the work itself.
+
+The HSV transform gives the same values as colorsys.rgb_to_hsv, which is
+what the classifiers in classifier.py use; raw readings are not scaled,
+thus V is in sensor units.
+
+Usage, to summarize every CSV capture in a directory:
+
+    python src/colorimetry.py test/data
+'''
+import os
+import sys
+import glob
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+CHANNELS = ["H", "S", "V", "R", "G", "B"]
+
+PERCENTILES = [5, 25, 50, 75, 95]
+
+# capture sets larger than this are handled in a process pool
+POOL_MINIMUM_BYTES = 4 * 1024 * 1024
+
+# files in the data directories that are not captures
+NON_CAPTURES = ["lego_colors.csv"]
+
+
+def load_capture(file_name):
+    '''
+    Loads the readings of one capture file.
+
+    :param file_name: a CSV file, or a binary capture file (extension .cap)
+    :return: float array with one (r, g, b) row per reading
+    '''
+    if file_name.endswith(".cap"):
+        # binary captures need module capture, thus src in the path
+        from capture import read_capture
+        run = read_capture(file_name)
+        return numpy.column_stack([run["r"], run["g"], run["b"]]).astype(float)
+
+    return numpy.loadtxt(file_name, delimiter=",", ndmin=2)
+
+
+def load_captures(file_names):
+    '''
+    Loads several capture files into a single array.
+
+    :return: (readings, offsets), where readings is a float array with one
+        (r, g, b) row per reading, and offsets holds the index of the first
+        reading of each file, followed by the total number of readings.
+    '''
+    arrays = [load_capture(file_name) for file_name in file_names]
+    offsets = numpy.cumsum([0] + [len(a) for a in arrays])
+    if len(arrays) == 0:
+        return numpy.empty((0, 3)), offsets
+    return numpy.concatenate(arrays), offsets
+
+
+def rgb_to_hsv(rgb):
+    '''
+    Vectorized equivalent of colorsys.rgb_to_hsv.
+
+    :param rgb: array with one (r, g, b) row per reading
+    :return: array with one (h, s, v) row per reading
+    '''
+    rgb = numpy.asarray(rgb, dtype=float)
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+
+    maxc = rgb.max(axis=1)
+    minc = rgb.min(axis=1)
+    rangec = maxc - minc
+    gray = rangec == 0.
+
+    # grays, black included, have zero hue and saturation. Their divisors
+    # are replaced by 1. just to keep the arithmetic quiet.
+    safe_max = numpy.where(maxc == 0., 1., maxc)
+    safe_range = numpy.where(gray, 1., rangec)
+    s = numpy.where(gray, 0., rangec / safe_max)
+
+    rc = (maxc - r) / safe_range
+    gc = (maxc - g) / safe_range
+    bc = (maxc - b) / safe_range
+
+    # same precedence as colorsys: red, then green, then blue
+    h = numpy.where(r == maxc, bc - gc,
+                    numpy.where(g == maxc, 2. + rc - bc, 4. + gc - rc))
+    h = numpy.where(gray, 0., (h / 6.) % 1.)
+
+    return numpy.column_stack([h, s, maxc])
+
+
+def summarize(readings, offsets, percentiles=PERCENTILES):
+    '''
+    Computes statistics of the H, S, V, R, G and B channels, per file.
+
+    :param readings: array as returned by load_captures
+    :param offsets: offsets as returned by load_captures
+    :param percentiles: percentiles to compute, in the 0-100 range
+    :return: list with one dict per file, keyed by channel name. Each
+        value is a dict with count, mean, stdev (sample standard
+        deviation), min, max, and percentiles keyed by percentile.
+    '''
+    channels = numpy.column_stack([rgb_to_hsv(readings), readings])
+    starts = numpy.asarray(offsets[:-1])
+    counts = numpy.diff(offsets)
+
+    # per-file reductions. Empty files are left out: they own no readings,
+    # thus every other file's readings still run up to the next start.
+    valid = counts > 0
+    result = [{} for count in counts]
+    if not valid.any():
+        return result
+    valid_starts = starts[valid]
+    valid_counts = counts[valid]
+
+    sums = numpy.add.reduceat(channels, valid_starts, axis=0)
+    minima = numpy.minimum.reduceat(channels, valid_starts, axis=0)
+    maxima = numpy.maximum.reduceat(channels, valid_starts, axis=0)
+    means = sums / valid_counts[:, None]
+
+    # sample variance, from deviations to each file's own mean
+    deviations = channels - numpy.repeat(means, valid_counts, axis=0)
+    squares = numpy.add.reduceat(deviations * deviations, valid_starts, axis=0)
+    variances = squares / numpy.maximum(valid_counts - 1, 1)[:, None]
+
+    for k, index in enumerate(numpy.flatnonzero(valid)):
+        start = valid_starts[k]
+        count = valid_counts[k]
+        values = numpy.percentile(channels[start:start + count], percentiles, axis=0)
+
+        summary = {}
+        for c, channel in enumerate(CHANNELS):
+            summary[channel] = {"count": int(count),
+                                "mean": float(means[k, c]),
+                                "stdev": float(numpy.sqrt(variances[k, c])),
+                                "min": float(minima[k, c]),
+                                "max": float(maxima[k, c]),
+                                "percentiles": {p: float(v) for p, v in zip(percentiles, values[:, c])}}
+        result[index] = summary
+    return result
+
+
+def _analyze_file(file_name):
+    # process pool task: one file at a time
+    readings = load_capture(file_name)
+    return summarize(readings, [0, len(readings)])[0]
+
+
+def analyze(file_names, processes=None):
+    '''
+    Summarizes each capture file, as in method summarize.
+
+    :param file_names: list of capture files
+    :param processes: number of worker processes. None picks the pool size
+        automatically, and uses no pool for small capture sets; 1 uses no pool.
+    :return: dict with one summary per file, keyed by file name
+    '''
+    file_names = list(file_names)
+    if processes is None:
+        total = sum([os.path.getsize(file_name) for file_name in file_names])
+        if total < POOL_MINIMUM_BYTES:
+            processes = 1
+
+    if processes == 1 or len(file_names) < 2:
+        readings, offsets = load_captures(file_names)
+        summaries = summarize(readings, offsets)
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            summaries = list(pool.map(_analyze_file, file_names))
+
+    return dict(zip(file_names, summaries))
+
+
+def capture_files(directory):
+    '''
+    Lists the capture files in a directory, skipping the ones that aren't.
+    '''
+    file_names = glob.glob(os.path.join(directory, "*.csv")) + glob.glob(os.path.join(directory, "*.cap"))
+    return sorted([f for f in file_names if os.path.basename(f) not in NON_CAPTURES])
+
+
+def print_summaries(summaries):
+    for file_name, summary in summaries.items():
+        print(file_name)
+        for channel in CHANNELS:
+            values = summary[channel]
+            print("%s stats: " % channel, values["mean"], values["stdev"], values["min"], values["max"],
+                  " percentiles:", " ".join(["%i%%=%.4g" % (p, v) for p, v in values["percentiles"].items()]))
+        print()
+
+
+if __name__ == '__main__':
+    directory = "data"
+    if len(sys.argv) > 1:
+        directory = sys.argv[1]
+
+    print_summaries(analyze(capture_files(directory)))
@@ -1,13 +1,12 @@
-import time
-from time import sleep
-
-from pylgbst.hub import RemoteHandset
-from pylgbst.peripherals import RemoteButton
+from hubs import RemoteHandset
+from hubs import RemoteButton
 
 import uuid_definitions
 
 import track
 from train import SmartTrain, CompoundTrain
+from scheduler import scheduler
+from clock import clock
 
 DUAL = "dual"
 LONG = "long"
@@ -32,7 +31,7 @@ class Controller:
         self.train2 = train2
         self.handset_address = handset_address
 
-        sleep(5)
+        clock.sleep(5)
         self.handset = RemoteHandset(address=self.handset_address)
         self.handset_handler = HandsetHandler(self)
 
@@ -148,9 +147,10 @@ class Controller:
             self.train1.initialize_sectors()
             self.train2.initialize_sectors()
 
+            # second train restarts a bit later. This is scheduled instead
+            # of slept on, so the handset callback returns right away.
             self.train1.timed_stop_at_station()
-            time.sleep(0.5)
-            self.train2.timed_stop_at_station()
+            scheduler.call_later(0.5, self.train2.timed_stop_at_station)
 
         # restart mode for configuration with compound train
         if isinstance(self.train1, CompoundTrain):
@@ -162,7 +162,7 @@ class Controller:
 class HandsetEvent:
     def __init__(self, button):
         self.button = button
-        self.timestamp = time.time()
+        self.timestamp = clock.now()
 
 
 class HandsetHandler:
@@ -1,59 +1,472 @@
-import time
-from time import sleep
-from threading import Timer
+import queue
+import traceback
+from math import ceil
+from threading import Thread, Lock
 
 from signal import RED, GREEN, BLUE, YELLOW, PURPLE, INTER_SECTOR
 from track import StructuredSector, sectors, xtrack, XTrack
 from track import FAST, SLOW, DEFAULT_BRAKING_TIME, XTRACK_BRAKING_TIME, \
     MAX_SPEED, DEFAULT_SPEED, SECTOR_EXIT_SPEED, STATION_SPEED
 from gui import tk_color
+from scheduler import scheduler
+from clock import clock
 
 
 TIME_THRESHOLD = 0.5  # seconds
 
+# maximum number of color events waiting to be processed, per train
+EVENT_QUEUE_SIZE = 16
+
+# signal colors handled by SensorEventFilter. Each color gets a fixed slot.
+SIGNAL_COLORS = [RED, GREEN, BLUE, YELLOW, PURPLE]
+
+# parameters for the optional sample confirmation stage
+CONFIRMATION_TILE_TIME = 0.6         # s, time for the sensor to cross a tile at power index 1
+CONFIRMATION_VOTE = 0.6              # fraction of samples in window that must agree
+CONFIRMATION_MAX_WINDOW = 16         # samples
+CONFIRMATION_SAMPLE_INTERVAL = 0.05  # s, initial guess, replaced by measured value
+CONFIRMATION_SMOOTHING = 0.05        # weight of each new sample interval measurement
+
+# parameters for the online estimate of sector traversal times
+SECTOR_TIME_SMOOTHING = 0.2    # weight of each new traversal time measurement
+SECTOR_TIME_MIN_SAMPLES = 3    # static sector parameters are used until this many measurements
+SECTOR_TIME_SIGMAS = 3.        # guard and speedup end this many standard deviations before the mean
+SECTOR_TIME_OUTLIER = 4.       # measurements are clipped this many standard deviations off the mean,
+SECTOR_TIME_OUTLIER_FRACTION = 0.25  # or this fraction of the mean, whichever is larger
+SECTOR_TIME_ROBUST_SIGMA = 1.4826    # standard deviation / median absolute deviation, for normal data
+GUARD_FRACTION = 0.75          # guard never exceeds this fraction of the mean traversal time
+MINIMUM_GUARD = TIME_THRESHOLD # s
+SPEEDUP_MARGIN = 1.0           # s, time to slow down from max speed before reaching the signal
+
 
 sign = lambda x: x and (1, -1)[x<0]
 
 
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.
+
+
 class SensorEventFilter():
     '''
     This class is used to filter out multiple detections of the same color
     by the vision sensor in a SmartTrain.
 
     It works by ignoring all detections of the given color that take place
-    within a pre-defined time interval (TIME_THRESHOLD). The first event
-    will be passed back to the caller, an instance of SmartTrain, via its
-    process_event method.
+    within a pre-defined time interval (TIME_THRESHOLD, or a per-color value
+    passed to the constructor). The first event will be passed on to the
+    train's EventQueue, to be handled by its EventProcessor.
+
+    Each train must own its own instance, so that events detected by one
+    train never suppress events detected by another. Event times come from
+    the shared clock, which is monotonic, thus immune to adjustments in the
+    system clock.
+
+    :param train: an instance of SmartTrain
+    :param time_thresholds: dict with time thresholds in seconds, keyed by
+        color. Colors not in the dict use TIME_THRESHOLD.
     '''
-    events = {}
+    def __init__(self, train, time_thresholds=None):
+        self.train = train
 
-    def __init__(self, train):
+        # state is kept in fixed-size lists, with one slot per color. The
+        # slot holds the time of the last event passed on to the train.
+        self.slots = {color: index for index, color in enumerate(SIGNAL_COLORS)}
+        self.event_times = [float('-inf')] * len(SIGNAL_COLORS)
+        self.time_thresholds = [TIME_THRESHOLD] * len(SIGNAL_COLORS)
+
+        if time_thresholds is not None:
+            for color in time_thresholds:
+                self.time_thresholds[self.slots[color]] = time_thresholds[color]
+
+    def filter_event(self, event_key):
+        # events are discriminated by their color. If an event of a given
+        # color happened less than the threshold time ago, this current event
+        # is a double detection, and is ignored.
+        event_time = clock.now()
+        slot = self.slots[event_key]
+
+        if (event_time - self.event_times[slot]) > self.time_thresholds[slot]:
+            # not a double detection. Alert caller and
+            # redefine stored event
+            self.event_times[slot] = event_time
+            self.train.event_queue.put(event_key)
+
+
+class EventQueue():
+    '''
+    Bounded queue of the color events of one train, plus the worker that
+    hands them over to the train's EventProcessor, one at a time, in order.
+
+    Processing an event may take seconds: braking and waiting at the
+    cross-track, waiting for the next sector to be free, stopping at a
+    station. Events are thus put here by the BLE notification thread, which
+    never waits on them, and keeps taking sensor samples meanwhile. If the
+    queue is full, the event is dropped, and counted.
+
+    The worker is started when the first event is queued. When running on a
+    virtual clock, it is a clock participant, started whenever events are
+    waiting.
+
+    :param train: an instance of SmartTrain
+    :param maxsize: maximum number of events waiting
+    '''
+    def __init__(self, train, maxsize=EVENT_QUEUE_SIZE):
+        self.train = train
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.started = False
+        self.busy = False
+        self._start_lock = Lock()
+
+        # metrics
+        self.dropped = 0
+        self.max_depth = 0
+        self.latency = [0, 0., 0.]
+
+    def put(self, event):
         '''
-        
-        :param train: an instance of SmartTrain
+        Queues an event to be processed, and returns right away.
+
+        :return: False if the event was dropped
+        '''
+        try:
+            self.queue.put_nowait((clock.now(), event))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+        if clock.virtual:
+            if not self.busy:
+                self.busy = True
+                clock.spawn(self._drain)
+        elif not self.started:
+            with self._start_lock:
+                if not self.started:
+                    self._start()
+        return True
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def statistics(self):
+        '''
+        Returns a dict with current and maximum queue depth, number of events
+        dropped and processed, and mean and maximum of the time events spend
+        waiting in the queue (in seconds).
         '''
+        n, total, maximum = self.latency
+        return {"depth": self.depth,
+                "max_depth": self.max_depth,
+                "dropped": self.dropped,
+                "processed": n,
+                "latency_mean": total / n if n > 0 else 0.,
+                "latency_max": maximum}
+
+    def _start(self):
+        self.started = True
+        Thread(target=self._worker_loop, name=self.train.name + " events", daemon=True).start()
+
+    def _worker_loop(self):
+        while True:
+            self._process(*self.queue.get())
+
+    def _drain(self):
+        while not self.queue.empty():
+            self._process(*self.queue.get_nowait())
+        self.busy = False
+
+    def _process(self, enqueue_time, event):
+        latency = clock.now() - enqueue_time
+        self.latency[0] += 1
+        self.latency[1] += latency
+        self.latency[2] = max(self.latency[2], latency)
+
+        # the event processor is looked up on every event, since it may be
+        # replaced after the train is built.
+        try:
+            self.train.event_processor.process_event(event)
+        except Exception:
+            traceback.print_exc()
+
+
+class SensorConfirmation():
+    '''
+    Optional stage that sits in between the vision sensor callback and the
+    SensorEventFilter. It passes on a color only after it shows up in a given
+    fraction (CONFIRMATION_VOTE) of the most recent samples. This rejects
+    isolated false positive samples, at the cost of some detection delay.
+
+    The window size is the number of samples the sensor takes while crossing
+    a tile. It is recomputed on every sample from the train's power index, and
+    from the measured interval in between samples (which depends on the sensor
+    subscription granularity). Thus fast trains use short windows and don't
+    miss short tiles. A vote fraction of 1. amounts to requiring a minimum run
+    length equal to the window size.
+
+    The stage runs in the BLE notification thread. Samples are kept in a
+    pre-allocated ring buffer, and per-color counts over the window are kept
+    up to date as samples come in and out.
+
+    :param train: an instance of SmartTrain
+    :param vote: fraction of samples in window that must agree
+    :param tile_time: time in sec for the sensor to cross a tile at power index 1
+    :param max_window: maximum window size, in samples
+    '''
+    def __init__(self, train, vote=CONFIRMATION_VOTE, tile_time=CONFIRMATION_TILE_TIME,
+                 max_window=CONFIRMATION_MAX_WINDOW):
         self.train = train
+        self.vote = vote
+        self.tile_time = tile_time
+
+        # colors are stored in the ring buffer as integer codes. Zero means no color.
+        self.colors = [None] + SIGNAL_COLORS
+        self.codes = {color: code for code, color in enumerate(self.colors)}
+
+        # ring buffer with sample codes and times
+        self.buffer = [0] * max_window
+        self.times = [0.] * max_window
+        self.position = 0
+
+        # window size and number of samples required to confirm a color
+        self.window = 1
+        self.required = 1
+        self.counts = [0] * len(self.colors)
+        self.counts[0] = self.window
+        self.emitted = 0
+
+        self.sample_interval = CONFIRMATION_SAMPLE_INTERVAL
+        self.last_sample_time = None
+
+        # statistics
+        self.confirmed = 0
+        self.latency_total = 0.
+        self.latency_max = 0.
+
+    def confirm(self, color):
+        '''
+        Feeds a sample into the stage. Every sample coming from the vision sensor
+        must be fed, including the ones that were not classified as a color.
 
-    def filter_event(self, event_key):
-        # events are discriminated by their color. If an event of a given
-        # color is already stored here, it means that this current event is
-        # possibly a double detection. Verify by checking event times.
-        event_time = time.time()
-        if event_key in self.events:
-            if (event_time - self.events[event_key]) > TIME_THRESHOLD:
-                # not a double detection. Alert caller and
-                # redefine stored event
-                self.events[event_key] = event_time
-                self.train.event_processor.process_event(event_key)
+        :param color: the color of the sample, or None
+        :return: the color, if it got confirmed by this sample, or None
+        '''
+        now = clock.now()
+        if self.last_sample_time is not None:
+            self.sample_interval += CONFIRMATION_SMOOTHING * \
+                                    (now - self.last_sample_time - self.sample_interval)
+        self.last_sample_time = now
+
+        self._update_window()
+
+        # the oldest sample in the window drops out, the new one comes in.
+        size = len(self.buffer)
+        self.counts[self.buffer[(self.position - self.window) % size]] -= 1
+
+        code = self.codes[color]
+        self.buffer[self.position] = code
+        self.times[self.position] = now
+        self.position = (self.position + 1) % size
+        self.counts[code] += 1
+
+        # a color is passed on only once for each sequence of samples that confirm it
+        if self.emitted and self.counts[self.emitted] < self.required:
+            self.emitted = 0
+
+        if code and code != self.emitted and self.counts[code] >= self.required:
+            self.emitted = code
+            self._record_latency(code, now)
+            return color
+
+        return None
+
+    def _update_window(self):
+        speed = max(abs(self.train.power_index), 1)
+        samples_per_tile = self.tile_time / (speed * self.sample_interval)
+        window = int(max(1, min(samples_per_tile, len(self.buffer))))
+
+        if window != self.window:
+            self.window = window
+            self.required = max(1, ceil(self.vote * window))
+
+            # re-count colors over the new window
+            size = len(self.buffer)
+            for code in range(len(self.counts)):
+                self.counts[code] = 0
+            for k in range(1, window + 1):
+                self.counts[self.buffer[(self.position - k) % size]] += 1
+
+    def _record_latency(self, code, now):
+        # latency is counted from the oldest sample in the window with
+        # the confirmed color.
+        size = len(self.buffer)
+        first_time = now
+        for k in range(1, self.window + 1):
+            index = (self.position - k) % size
+            if self.buffer[index] == code:
+                first_time = self.times[index]
+
+        latency = now - first_time
+        self.confirmed += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    @property
+    def expected_latency(self):
+        '''
+        Delay added by the stage to a clean sequence of samples, in sec.
+        '''
+        return (self.required - 1) * self.sample_interval
 
-            else:
-                # double detection. Do nothing.
-                pass
+    def statistics(self):
+        '''
+        Returns a dict with the current window parameters, and with
+        the detection delay measured so far.
+        '''
+        mean_latency = 0.
+        if self.confirmed > 0:
+            mean_latency = self.latency_total / self.confirmed
 
-        # if event of current color is not stored here, store current event
-        else:
-            self.events[event_key] = event_time
-            self.train.event_processor.process_event(event_key)
+        return {"window": self.window,
+                "required": self.required,
+                "sample_interval": self.sample_interval,
+                "expected_latency": self.expected_latency,
+                "confirmed": self.confirmed,
+                "mean_latency": mean_latency,
+                "max_latency": self.latency_max}
+
+
+class SectorTimeEstimator():
+    '''
+    Online estimate of the times a train takes to go through each sector.
+    Two times are measured from the sector entry signal:
+
+    - to the next signal of the same color: the end-of-sector signal in a
+      regular sector, the FAST-SLOW transition signal in a structured
+      sector. This is the signal the entry guard must not hide.
+    - to the first signal of any color, e.g. a cross-track tile inside
+      the sector. This is the signal the speedup must end before.
+
+    Traversal times depend on battery voltage, number of cars and speed,
+    so the static sector_time and max_speed_time parameters in track.py
+    can't be right for every train. Here, each measurement updates an
+    exponentially weighted mean and variance, and both timers are derived
+    from these. The first measurements seed the estimate through their
+    median, and later ones are clipped on both sides, so a few spurious
+    ones can't pull it far. The timers are derived as follows: the guard
+    lasts as long as it safely can, so spurious signals are ignored for
+    most of the traversal, and the speedup ends just in time to slow
+    down before the first signal. The static parameters are used until
+    enough measurements come in.
+
+    Each train must own its own instance. Sectors are keyed by name.
+
+    :param smoothing: weight of each new measurement
+    :param min_samples: number of measurements needed before estimates are used
+    :param sigmas: safety margin, in standard deviations
+    '''
+    def __init__(self, smoothing=SECTOR_TIME_SMOOTHING, min_samples=SECTOR_TIME_MIN_SAMPLES,
+                 sigmas=SECTOR_TIME_SIGMAS):
+        self.smoothing = smoothing
+        self.min_samples = min_samples
+        self.sigmas = sigmas
+
+        # sector name -> [mean, variance, number of measurements, first
+        # measurements, kept until min_samples come in]
+        self.exit_times = {}
+        self.signal_times = {}
+
+    def update_exit(self, sector_name, elapsed):
+        '''
+        Feeds in one measured time from entry to the same color signal, in sec.
+        '''
+        self._update(self.exit_times, sector_name, elapsed)
+
+    def update_signal(self, sector_name, elapsed):
+        '''
+        Feeds in one measured time from entry to the first signal, in sec.
+        '''
+        self._update(self.signal_times, sector_name, elapsed)
+
+    def _update(self, estimates, sector_name, elapsed):
+        estimate = estimates.setdefault(sector_name, [elapsed, 0., 0, []])
+        mean, variance, count, samples = estimate
+
+        # the first measurements seed the estimate with their median and
+        # median absolute deviation. Seeding from the very first one would
+        # let a single spurious measurement bias the timers for many laps.
+        if count < self.min_samples:
+            samples.append(elapsed)
+            median = _median(samples)
+            deviation = SECTOR_TIME_ROBUST_SIGMA * _median([abs(sample - median) for sample in samples])
+            estimate[0] = median
+            estimate[1] = deviation * deviation
+            estimate[2] = count + 1
+            if estimate[2] >= self.min_samples:
+                estimate[3] = []
+            return
+
+        # a train slowed down by something else than the motor (e.g. a
+        # handset command) must not inflate the estimate all at once, and a
+        # spurious signal must not shrink it. The clip limit can't be too
+        # tight though, or a train whose speed changed for good would never
+        # be followed.
+        limit = max(SECTOR_TIME_OUTLIER * variance ** 0.5, SECTOR_TIME_OUTLIER_FRACTION * mean)
+        elapsed = min(max(elapsed, mean - limit), mean + limit)
+
+        difference = elapsed - mean
+        increment = self.smoothing * difference
+        estimate[0] = mean + increment
+        estimate[1] = (1. - self.smoothing) * (variance + difference * increment)
+        estimate[2] = count + 1
+
+    def _lower_bound(self, estimates, sector_name):
+        # earliest time the signal is expected, with the safety margin;
+        # None if there aren't enough measurements yet.
+        estimate = estimates.get(sector_name)
+        if estimate is None or estimate[2] < self.min_samples:
+            return None
+        mean, variance, count, samples = estimate
+        return mean - self.sigmas * variance ** 0.5
+
+    def guard_time(self, sector):
+        '''
+        Time interval after sector entry during which sector signals are ignored.
+
+        :param sector: a Sector instance
+        '''
+        bound = self._lower_bound(self.exit_times, sector.name)
+        if bound is None:
+            return sector.sector_time
+        guard = min(bound, GUARD_FRACTION * self.exit_times[sector.name][0])
+        return max(guard, MINIMUM_GUARD)
+
+    def speedup_time(self, sector):
+        '''
+        Duration of the speedup that starts at sector entry.
+
+        :param sector: a Sector instance
+        '''
+        bound = self._lower_bound(self.signal_times, sector.name)
+        if bound is None:
+            return sector.max_speed_time
+        return max(bound - SPEEDUP_MARGIN, 0.)
+
+    def statistics(self):
+        '''
+        Returns a dict with mean, standard deviation and number of
+        measurements of both times, for each sector measured so far.
+        '''
+        result = {}
+        for kind, estimates in [("exit", self.exit_times), ("signal", self.signal_times)]:
+            for name, (mean, variance, count, samples) in estimates.items():
+                result.setdefault(name, {})[kind] = {"mean": mean, "deviation": variance ** 0.5,
+                                                     "samples": count}
+        return result
 
 
 class EventProcessor:
@@ -74,6 +487,12 @@ class EventProcessor:
         # this helps to detected unexpected, thus invalid, events.
         self.last_processed_xtrack_event = None
 
+        # measured sector traversal times, and the start of the one
+        # being measured now.
+        self.sector_times = SectorTimeEstimator()
+        self.sector_entry_time = None
+        self.first_signal_pending = False
+
     def process_event(self, event):
         '''
         Processes events pre-filtered by SensorEventFilter.
@@ -89,6 +508,7 @@ class EventProcessor:
 
         # report signal color
         self.train.report_signal(tk_color[event])
+        self.train.record_event(event)
 
         # events should be processed only when train is in auto mode
         if not self.train.auto:
@@ -120,6 +540,9 @@ class EventProcessor:
         # track.
         if event in [YELLOW]:
             # self._process_braking_event()
+            if self.train.sector is not None and \
+                    (self.train.sector.color, self.train.direction) in xtrack.valid_signals:
+                self._measure_first_signal()
             self._process_xtrack_event()
 
         # RED events are reserved for handling sectors that contain a
@@ -143,6 +566,9 @@ class EventProcessor:
                 self.train.sector.color == event and \
                 not self.train.just_entered_sector:
 
+            self._measure_first_signal()
+            self._measure_sector_time()
+
             if isinstance(self.train.sector, StructuredSector):
 
                 self._handle_structured_sector(event)
@@ -180,36 +606,54 @@ class EventProcessor:
             self.train.sector.sub_sector_type = FAST
             self.train.report_sector(tk_color[event], subtext="F")
 
-        # lock sector. This was probably handled somewhere else, before
-        # the train had taken the decision to enter the sector. But we do
-        # it again here just in case.
-        self.train.sector.occupier = self.train.name
+        # book sector. This was handled before the train had taken the
+        # decision to enter the sector. But we do it again here just in
+        # case, without waiting and without taking it from another train.
+        if not self.train.book_track([self.train.sector]):
+            print("ERROR: entered sector booked by another train. Sector: ", self.train.sector.color,
+                  "  ", self.train.name)
 
         # make sure previous sector is released.
-        self.train.previous_sector.occupier = None
+        self.train.release_track(self.train.previous_sector)
 
         # set up timer for sanity check to prevent false detections
         # of a spurious end-of-sector signal. The sector_time parameter
         # defines a time interval, counted from the instant of sector
         # entry, during which the train is blind from sector signals.
         # This thread acts just on the ability of a signal event to be
-        # detected; it doesn't affect train movement.
-        sector_time = self.train.sector.sector_time
-        self.train.time_in_sector = Timer(sector_time, self.train.mark_exit_valid)
+        # detected; it doesn't affect train movement. Once the train has
+        # gone through the sector a few times, the interval comes from the
+        # measured traversal times instead of from the sector definition.
+        sector_time = self.sector_times.guard_time(self.train.sector)
         self.train.just_entered_sector = True
-        self.train.time_in_sector.start()
+        self.train.time_in_sector = scheduler.call_later(sector_time, self.train.mark_exit_valid)
+        self.sector_entry_time = clock.now()
+        self.first_signal_pending = True
 
         # when entering sector, set timed speedup. Make sure the speedup
         # time duration ends before reaching any signal on the track.
         if self.train.speedup_timer is not None:
             self.train.speedup_timer.cancel()
-        self.train.speedup_timer = Timer(self.train.sector.max_speed_time,
-                                         self._return_to_sector_speed)
-        self.train.speedup_timer.start()
+        self.train.speedup_timer = scheduler.call_later(self.sector_times.speedup_time(self.train.sector),
+                                                        self._return_to_sector_speed)
 
         # enter sector at max speed setting
         self.accelerate(self.train.sector.max_speed)
 
+    def _measure_first_signal(self):
+        # called on signals accepted by the sector logic: cross-track tiles
+        # valid in the sector, and the sector color past the entry guard.
+        # Spurious readings of other colors are left out.
+        if self.first_signal_pending and self.train.sector is not None:
+            self.sector_times.update_signal(self.train.sector.name, clock.now() - self.sector_entry_time)
+        self.first_signal_pending = False
+
+    def _measure_sector_time(self):
+        # called on the first valid signal of the sector color after entry
+        if self.sector_entry_time is not None:
+            self.sector_times.update_exit(self.train.sector.name, clock.now() - self.sector_entry_time)
+            self.sector_entry_time = None
+
     def _return_to_sector_speed(self):
         self.accelerate(DEFAULT_SPEED, time=0.8)
 
@@ -236,15 +680,16 @@ class EventProcessor:
         else:
             # leaving SLOW sub-sector, thus leaving the entire structured
             # sector as well. Either do a full stop-and-wait, or keep going,
-            # based on occupancy status of next sector
-            if next_sector.occupier is not None and \
-                    next_sector.occupier != self.train.name:
-                # occupied: stop and keep interrogating next sector
-                self._stop_and_wait(next_sector)
-            else:
-                # next sector is free: exit current sector
+            # based on occupancy status of next sector. It is already booked
+            # by this train if it was free at the sub-sector transition;
+            # otherwise, check and book it in one atomic step.
+            if self.train.book_track([next_sector]):
+                # next sector is booked: exit current sector
                 # and keep moving
                 self._exit_sector(event)
+            else:
+                # occupied: stop and wait for next sector
+                self._stop_and_wait(next_sector)
 
     def _handle_subsector_transition(self, next_sector, event):
         '''
@@ -259,15 +704,15 @@ class EventProcessor:
 
         # Decision on how to behave from now on depends on the occupancy status
         # of the next sector ahead of train. Train should slow down and eventually
-        # stop only if next sector is occupied. Otherwise, grab next sector.
-        if next_sector.occupier is not None and next_sector.occupier != self.train.name:
+        # stop only if next sector is occupied. Otherwise, grab next sector. The
+        # check and the grab happen in one atomic step, without waiting.
+        if not self.train.book_track([next_sector]):
             # next sector is occupied: slow down to minimum speed and wait for
             # end-of-sector signal.
             self.accelerate(SECTOR_EXIT_SPEED, time=0.2)
 
         else:
-            # next sector is free. Grab it.
-            next_sector.occupier = self.train.name
+            # next sector was free, and is now booked by this train.
 
             # drop speed to a reasonable value to cross over the inter-sector zone,
             # but avoid using train.down_speed(), since it kills any underlying threads.
@@ -294,21 +739,21 @@ class EventProcessor:
             # thread associated with train movement is cancelled.
             self.train.cancel_acceleration_thread()
             self.train.cancel_speedup_timer()
-            sleep(0.01)
+            clock.sleep(0.01)
             self.train.stop(from_handset=False)
 
             # gui displays station color
             self.train.report_sector(tk_color[event])
 
             # make sure previous sector is released.
-            self.train.previous_sector.occupier = None
+            self.train.release_track(self.train.previous_sector)
 
-            # mark current sector as occupied. Note that this is not
-            # strictly required in the current implementation, but we
-            # do it anyway for debugging and logging purposes.
-            self.train.previous_sector.next[self.train.direction].occupier = self.train.name
+            # book current sector. Note that this is not strictly required
+            # in the current implementation, but we do it anyway for
+            # debugging and logging purposes.
+            self.train.book_track([self.train.previous_sector.next[self.train.direction]])
 
-            # after stopping at station, execute a Timer delay followed by a re-start
+            # after stopping at station, schedule a delay followed by a re-start
             self.train.timed_stop_at_station()
 
             # if a secondary train instance is registered, call its stop
@@ -347,7 +792,7 @@ class EventProcessor:
         self.accelerate(1, time=0.1)
 
         # keep brake applied
-        time.sleep(DEFAULT_BRAKING_TIME)
+        clock.sleep(DEFAULT_BRAKING_TIME)
 
         # accelerate back to sector speed
         if self.train.sector is not None:
@@ -389,14 +834,16 @@ class EventProcessor:
                 self.train.cancel_speedup_timer()
                 self.train.cancel_station_timer()
 
+                # the time spent waiting doesn't count as traversal time
+                self.sector_entry_time = None
+
                 # brake and wait until full stop
                 speed = self.train.power_index
                 self.accelerate(0, time=XTRACK_BRAKING_TIME)
-                time.sleep(XTRACK_BRAKING_TIME + 0.5) # leeway to account for inertia
+                clock.sleep(XTRACK_BRAKING_TIME + 0.5) # leeway to account for inertia
 
                 # wait until crossing opens
-                while not xtrack.is_free(self.train):
-                    time.sleep(0.5)
+                xtrack.wait_until_free(self.train)
 
                 # this is the train that last stopped at the xtrack
                 xtrack.last_stopped = self.train.name
@@ -474,12 +921,11 @@ class EventProcessor:
     def _stop_and_wait(self, next_sector):
         self.train.stop(from_handset=False)
 
-        # make sure we wait for the next sector to go free. This
-        # may be redundant here, since train.restart_movement should
-        # be doing the same check anyway. We do just in case though.
-        while next_sector.occupier is not None and \
-              next_sector.occupier != self.train.name:
-            time.sleep(0.3)
+        # wait for the next sector to go free, and book it in the same
+        # atomic step, so no other train can grab it in between.
+        # train.restart_movement books it again along with any
+        # cross-track ahead; that just confirms this booking.
+        self.train.book_track([next_sector], timeout=None)
 
         self._exit_sector("from stop and wait")
         self.train.restart_movement()
@@ -556,6 +1002,7 @@ class CompoundTrainEventProcessor(EventProcessor):
         Overrides base class to process events in the rear train only.
         '''
         self.train.train_rear.report_signal(tk_color[event])
+        self.train.train_rear.record_event(event)
 
         if not self.train.train_rear.auto:
             return
@@ -590,10 +1037,10 @@ class CompoundTrainEventProcessor(EventProcessor):
             # programmer to fully implement a threaded accelerate method for
             # a compound train.
             self.train.set_power(1)
-            sleep(2.)
+            clock.sleep(2.)
             self.train.stop(False)
 
-            # after stopping at station, execute a Timer delay followed by a re-start
+            # after stopping at station, schedule a delay followed by a re-start
             self.train.train_rear.timed_stop_at_station()
 
             # if a secondary train instance is registered, call its stop
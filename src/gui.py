@@ -1,14 +1,13 @@
-import time
-from threading import Thread
 
 import queue
 import tkinter as T
-from tkinter import StringVar, LEFT, TOP
+from tkinter import StringVar, LEFT, TOP, BOTTOM
 
 from signal import RED, GREEN, BLUE, YELLOW, PURPLE, INTER_SECTOR
+from clock import clock
 
-tkinter_output_queue = queue.Queue()
 QUEUE_POLLING = 50 # ms
+QUEUE_SIZE = 1000  # messages
 
 # tkinter color names
 TK_GRAY = "light gray"
@@ -32,211 +31,327 @@ ASTATION = "@STATION"
 SECTOR = "SECTOR"
 SIGNAL = "SIGNAL"
 XTRACK = "XTRACK"
+REGISTER = "REGISTER"
+
+# fields displayed for each train, in display order. Widgets are looked up
+# by these indices.
+NAME_FIELD = 0
+VOLTAGE_FIELD = 1
+CURRENT_FIELD = 2
+SPEED_FIELD = 3
+POWER_FIELD = 4
+SIGNAL_FIELD = 5
+ASTATION_FIELD = 6
+SECTOR_FIELD = 7
+XTRACK_FIELD = 8
+
+FIELD_LABELS = ["", "Voltage", "Current", "Speed", "Power", "Signal", "@ station", "Sector", "Xtrack"]
+
+# fields displayed as a colored label, instead of text
+COLOR_FIELDS = [SIGNAL_FIELD, SECTOR_FIELD, XTRACK_FIELD]
+
+# voltage, current, speed and power come in at the rate of the hub
+# notifications. At most this many trains get these fields repainted at each
+# tick, in round-robin order, so the repaint cost doesn't grow with the
+# number of trains. Other fields change seldom, and are repainted right away.
+BASIC_REPAINTS_PER_TICK = 2
+
+
+class GUIOutputQueue():
+    '''
+    Carries messages from the train threads to the GUI thread, since
+    tkinter is not thread-safe and can't be updated from anywhere else.
+
+    Messages are time stamped when queued, so the GUI can tell how far
+    behind reality it is. The queue is bounded; should the GUI stop
+    draining it, new messages are dropped (and counted) instead of
+    blocking the caller, which may be a BLE notification thread.
+
+    :param maxsize: maximum number of messages waiting in the queue
+    '''
+    def __init__(self, maxsize=QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait((clock.now(), message))
+        except queue.Full:
+            self.dropped += 1
+
+    def drain(self):
+        '''
+        Returns all messages waiting in the queue, as (time stamp, message)
+        tuples, oldest first.
+        '''
+        items = []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+
+tkinter_output_queue = GUIOutputQueue()
+
+
+class GUIMessage():
+    '''
+    Message sent by a train to the GUI. Values are kept as they come from
+    the train; they are formatted in the GUI thread, and only when they
+    actually make it to the display.
+
+    :param type: one of the message types defined in this module
+    :param name: train name
+    :param gui_id: str that identifies the set of widgets to update
+    :param values: tuple with the values, in the order the message type defines
+    '''
+    __slots__ = ("type", "name", "gui_id", "values")
+
+    def __init__(self, type, name, gui_id, values):
+        self.type = type
+        self.name = name
+        self.gui_id = gui_id
+        self.values = values
+
+
+def coalesce(messages):
+    '''
+    Keeps only the newest message for each combination of message type and
+    GUI id. Each message type updates its own set of widgets, thus older
+    messages would be overwritten in the display anyway.
+
+    :param messages: list of GUIMessage instances, oldest first
+    :return: list of messages, in order of first appearance of their key
+    '''
+    newest = {}
+    for message in messages:
+        newest[(message.type, message.gui_id)] = message
+    return list(newest.values())
 
 
 class GUI():
+    '''
+    Status display. There is one column of fields per train, created when
+    the train registers, or else when the first message from it comes in.
+
+    All widget handling happens in the Tk thread. Trains, which run in
+    other threads, talk to the GUI only through tkinter_output_queue.
+    '''
     def __init__(self):
         self.root = T.Tk()
-        self.root.geometry("600x480")
-        font = ('Helvetica', 36)
+        self.font = ('Helvetica', 36)
 
         self.root.title("Lego train control")
 
-        left_frame = T.Frame(self.root)
-        center_frame = T.Frame(self.root)
-        right_frame = T.Frame(self.root)
+        # bottom line: display pipeline metrics
+        self.status_text = StringVar(self.root, '')
+        T.Label(self.root, textvariable=self.status_text, font=('Helvetica', 12)).pack(side=BOTTOM)
 
         # left frame: field names
-        T.Label(left_frame, text="",          font=font, justify=LEFT).pack(side=TOP)
-        T.Label(left_frame, text="Voltage",   font=font, justify=LEFT).pack(side=TOP)
-        T.Label(left_frame, text="Current",   font=font, justify=LEFT).pack(side=TOP)
-        T.Label(left_frame, text="Speed",     font=font, justify=LEFT).pack(side=TOP)
-        T.Label(left_frame, text="Power",     font=font, justify=LEFT).pack(side=TOP)
-        T.Label(left_frame, text="Signal",    font=font, justify=LEFT).pack(side=TOP)
-        T.Label(left_frame, text="@ station", font=font, justify=LEFT).pack(side=TOP)
-        T.Label(left_frame, text="Sector",    font=font, justify=LEFT).pack(side=TOP)
-        T.Label(left_frame, text="Xtrack",    font=font, justify=LEFT).pack(side=TOP)
-
-        # text variables
-        self.name_1_text     = StringVar(center_frame, '')
-        self.voltage_1_text  = StringVar(center_frame, '- - -')
-        self.current_1_text  = StringVar(center_frame, '- - -')
-        self.speed_1_text    = StringVar(center_frame, '- - -')
-        self.power_1_text    = StringVar(center_frame, '- - -')
-        self.astation_1_text = StringVar(center_frame, '- - -')
-        # self.sector_1_text   = StringVar(center_frame, '- - -')
-
-        self.name_2_text     = StringVar(right_frame, '')
-        self.voltage_2_text  = StringVar(right_frame, '- - -')
-        self.current_2_text  = StringVar(right_frame, '- - -')
-        self.speed_2_text    = StringVar(right_frame, '- - -')
-        self.power_2_text    = StringVar(right_frame, '- - -')
-        self.astation_2_text = StringVar(center_frame, '- - -')
-        # self.sector_2_text   = StringVar(center_frame, '- - -')
-
-        # center frame: fields associated with id 1
-        width = 9
-        self.name_1_label     = T.Label(center_frame, textvariable=self.name_1_text, font=font)
-        self.voltage_1_label  = T.Label(center_frame, textvariable=self.voltage_1_text, font=font, width=width)
-        self.current_1_label  = T.Label(center_frame, textvariable=self.current_1_text, font=font, width=width)
-        self.speed_1_label    = T.Label(center_frame, textvariable=self.speed_1_text, font=font, width=width)
-        self.power_1_label    = T.Label(center_frame, textvariable=self.power_1_text, font=font, width=width)
-        self.signal_1_label   = T.Label(center_frame, font=font, width=5, anchor="e")
-        self.astation_1_label = T.Label(center_frame, textvariable=self.astation_1_text, font=font, width=width)
-        # self.sector_1_label   = T.Label(center_frame, textvariable=self.sector_1_text, font=font, width=width, anchor="e")
-        self.sector_1_label   = T.Label(center_frame, font=font, width=5, anchor="e")
-        self.xtrack_1_label   = T.Label(center_frame, font=font, width=5, anchor="e")
-
-        self.name_1_label.pack(side=TOP)
-        self.voltage_1_label.pack(side=TOP)
-        self.current_1_label.pack(side=TOP)
-        self.speed_1_label.pack(side=TOP)
-        self.power_1_label.pack(side=TOP)
-        self.signal_1_label.pack(side=TOP)
-        self.astation_1_label.pack(side=TOP)
-        self.sector_1_label.pack(side=TOP)
-        self.xtrack_1_label.pack(side=TOP)
-
-        # right frame: fields associated with id 2
-        self.name_2_label     = T.Label(right_frame, textvariable=self.name_2_text, font=font)
-        self.voltage_2_label  = T.Label(right_frame, textvariable=self.voltage_2_text, font=font, width=width)
-        self.current_2_label  = T.Label(right_frame, textvariable=self.current_2_text, font=font, width=width)
-        self.speed_2_label    = T.Label(right_frame, textvariable=self.speed_2_text, font=font, width=width)
-        self.power_2_label    = T.Label(right_frame, textvariable=self.power_2_text, font=font, width=width)
-        self.signal_2_label   = T.Label(right_frame, font=font, width=5, anchor="e")
-        self.astation_2_label = T.Label(right_frame, textvariable=self.astation_2_text, font=font, width=width)
-        # self.sector_2_label   = T.Label(right_frame, textvariable=self.sector_2_text, font=font, width=width, anchor="e")
-        self.sector_2_label   = T.Label(right_frame, font=font, width=5, anchor="e")
-        self.xtrack_2_label   = T.Label(right_frame, font=font, width=5, anchor="e")
-
-        self.name_2_label.pack(side=TOP)
-        self.voltage_2_label.pack(side=TOP)
-        self.current_2_label.pack(side=TOP)
-        self.speed_2_label.pack(side=TOP)
-        self.power_2_label.pack(side=TOP)
-        self.signal_2_label.pack(side=TOP)
-        self.astation_2_label.pack(side=TOP)
-        self.sector_2_label.pack(side=TOP)
-        self.xtrack_2_label.pack(side=TOP)
-
+        left_frame = T.Frame(self.root)
+        for text in FIELD_LABELS:
+            T.Label(left_frame, text=text, font=self.font, justify=LEFT).pack(side=TOP)
         left_frame.pack(side=LEFT)
-        center_frame.pack(side=LEFT)
-        right_frame.pack(side=LEFT)
 
-    def after_callback(self):
-        try:
-            message = tkinter_output_queue.get(block=False)
-        except queue.Empty:
-            # try again later
-            self.root.after(QUEUE_POLLING, self.after_callback)
-            return
-
-        if message is not None:
-            self._decode_message_and_update(message)
+        # widgets for each train are kept in a list indexed by field, and the
+        # lists in a list indexed by column. Columns are found by gui id.
+        self.columns = []
+        self.column_index = {}
+
+        self.handlers = self._message_handlers()
+
+        # telemetry messages waiting to be repainted, keyed by gui id
+        self.pending_basic = {}
+
+        # station dwell deadlines, and the values on display, keyed by gui id
+        self.countdowns = {}
+
+        # metrics
+        self.max_depth = 0
+        self.lag = 0.
+        self.max_lag = 0.
+
+    def register(self, name, gui_id):
+        '''
+        Asks for a column for the given train. Can be called from any thread.
+        '''
+        tkinter_output_queue.put(GUIMessage(REGISTER, name, gui_id, ()))
+
+    def _column(self, gui_id):
+        # returns the widgets for the given gui id, creating them if needed
+        index = self.column_index.get(gui_id)
+        if index is None:
+            index = len(self.columns)
+            self.columns.append(self._build_column())
+            self.column_index[gui_id] = index
+        return self.columns[index]
+
+    def _build_column(self):
+        # text fields are driven by text variables, color fields by the label background
+        frame = T.Frame(self.root)
+        width = 9
+        widgets = []
+        for field in range(len(FIELD_LABELS)):
+            if field in COLOR_FIELDS:
+                label = T.Label(frame, font=self.font, width=5, anchor="e")
+                widgets.append(label)
+            elif field == NAME_FIELD:
+                widgets.append(StringVar(frame, ''))
+                label = T.Label(frame, textvariable=widgets[field], font=self.font)
+            else:
+                widgets.append(StringVar(frame, '- - -'))
+                label = T.Label(frame, textvariable=widgets[field], font=self.font, width=width)
+            label.pack(side=TOP)
+        frame.pack(side=LEFT)
+        return widgets
 
-            # we're not done yet, let's come back later
-            self.root.after(QUEUE_POLLING, self.after_callback)
+    def after_callback(self):
+        # take everything that piled up since the previous tick, and update
+        # each field just once, with its most recent value.
+        items = tkinter_output_queue.drain()
+
+        if len(items) > 0:
+            self.max_depth = max(self.max_depth, len(items))
+
+            # the oldest message tells how far behind the display was
+            self.lag = clock.now() - items[0][0]
+            self.max_lag = max(self.max_lag, self.lag)
+        else:
+            self.lag = 0.
+
+        self._update([message for timestamp, message in items])
+
+        self.status_text.set("queue %i (max %i)   lag %i ms (max %i)   dropped %i" %
+                             (len(items), self.max_depth, self.lag * 1000., self.max_lag * 1000.,
+                              tkinter_output_queue.dropped))
+
+        # come back later
+        self.root.after(QUEUE_POLLING, self.after_callback)
+
+    def _update(self, messages):
+        # telemetry is held back and repainted in round-robin order. A train
+        # with a newer value waiting keeps its place in the line.
+        for message in coalesce(messages):
+            if message.type == BASIC:
+                self.pending_basic[message.gui_id] = message
+            else:
+                self._decode_message_and_update(message)
+
+        for gui_id in list(self.pending_basic)[:BASIC_REPAINTS_PER_TICK]:
+            self._decode_message_and_update(self.pending_basic.pop(gui_id))
+
+        self._update_countdowns()
+
+    def _update_countdowns(self):
+        # the display only changes once a second, thus most ticks paint nothing
+        now = clock.now()
+        for gui_id, (deadline, shown) in list(self.countdowns.items()):
+            remaining = max(int(deadline - now), 0)
+            if remaining != shown:
+                self.columns[self.column_index[gui_id]][ASTATION_FIELD].set("%3i" % remaining)
+                self.countdowns[gui_id] = (deadline, remaining)
+            if remaining == 0:
+                del self.countdowns[gui_id]
+
+    def statistics(self):
+        '''
+        Returns a dict with the display pipeline metrics: current and maximum
+        number of messages drained per tick, current and maximum display lag
+        (in seconds), and number of messages dropped.
+        '''
+        return {"depth": tkinter_output_queue.depth,
+                "max_depth": self.max_depth,
+                "lag": self.lag,
+                "max_lag": self.max_lag,
+                "dropped": tkinter_output_queue.dropped}
 
     def encode_basic_variables(self, name, id, voltage, current, power_index, power):
-        message = ("%s, %s, %1s, %5.2f, %5.3f, %i, %4.2f" %
-                   (BASIC, name, id, voltage, current, power_index, power))
-        return message
-
-    def encode_int_variable(self, message_type, name, id, value):
-        message = (message_type + ", %s, %1s, %3i" % (name, id, value))
-        return message
+        return GUIMessage(BASIC, name, id, (voltage, current, power_index, power))
 
     def encode_str_variable(self, message_type, name, id, value, subtext=""):
-        message = (message_type + ", %s, %1s, %s, %s" % (name, id, value, subtext))
-        return message
+        return GUIMessage(message_type, name, id, (value, subtext))
+
+    def _message_handlers(self):
+        # functions that update the widgets, keyed by message type
+        return {BASIC: self._update_basic,
+                ASTATION: self._update_astation,
+                SECTOR: self._update_sector,
+                SIGNAL: self._update_signal,
+                XTRACK: self._update_xtrack,
+                REGISTER: self._update_name}
 
     def _decode_message_and_update(self, message):
-        tokens = message.split(',')
-
-        if tokens[0] == BASIC:
-            name = tokens[1]
-            id = tokens[2].strip()
-            voltage_value = tokens[3]
-            current_value = tokens[4]
-            speed = tokens[5]
-            power = tokens[6]
-
-            vname = f"name_{id}_text".format(id=id)
-            self.__dict__[vname].set(name)
-            vname = f"voltage_{id}_text".format(id=id)
-            self.__dict__[vname].set(voltage_value)
-            vname = f"current_{id}_text".format(id=id)
-            self.__dict__[vname].set(current_value)
-            vname = f"speed_{id}_text".format(id=id)
-            self.__dict__[vname].set(speed)
-            vname = f"power_{id}_text".format(id=id)
-            self.__dict__[vname].set(power)
-
-        elif tokens[0] == ASTATION:
-            id = tokens[2].strip()
-            astation = tokens[3]
-
-            vname = f"astation_{id}_text".format(id=id)
-            self.__dict__[vname].set(astation)
-
-        elif tokens[0] == SECTOR:
-            id = tokens[2].strip()
-
-            color = tokens[3].strip()
-            subtext = tokens[4].strip()
-            vname = f"sector_{id}_label".format(id=id)
-            self.__dict__[vname].configure(text=subtext, bg=color)
-
-        elif tokens[0] == SIGNAL:
-            id = tokens[2].strip()
-
-            color = tokens[3].strip()
-            vname = f"signal_{id}_label".format(id=id)
-            self.__dict__[vname].configure(bg=color)
-
-        elif tokens[0] == XTRACK:
-            id = tokens[2].strip()
-
-            color = tokens[3].strip()
-            vname = f"xtrack_{id}_label".format(id=id)
-            self.__dict__[vname].configure(bg=color)
+        self.handlers[message.type](self._column(message.gui_id), message)
+
+    def _update_name(self, widgets, message):
+        widgets[NAME_FIELD].set(message.name)
+
+    def _update_basic(self, widgets, message):
+        voltage, current, power_index, power = message.values
+        widgets[NAME_FIELD].set(message.name)
+        widgets[VOLTAGE_FIELD].set("%5.2f" % voltage)
+        widgets[CURRENT_FIELD].set("%5.3f" % current)
+        widgets[SPEED_FIELD].set("%i" % power_index)
+        widgets[POWER_FIELD].set("%4.2f" % power)
+
+    def _update_astation(self, widgets, message):
+        # a new deadline replaces any countdown in progress; no deadline
+        # means the train left the station.
+        deadline = message.values[0]
+        if deadline is None:
+            self.countdowns.pop(message.gui_id, None)
+            widgets[ASTATION_FIELD].set("%3i" % 0)
+        else:
+            self.countdowns[message.gui_id] = (deadline, None)
+            self._update_countdowns()
+
+    def _update_sector(self, widgets, message):
+        color, subtext = message.values
+        widgets[SECTOR_FIELD].configure(text=subtext, bg=color)
+
+    def _update_signal(self, widgets, message):
+        widgets[SIGNAL_FIELD].configure(bg=message.values[0])
+
+    def _update_xtrack(self, widgets, message):
+        widgets[XTRACK_FIELD].configure(bg=message.values[0])
 
     def report_astation(self, name, gui_id, value):
-        counting = Thread(target=self._countdown, args=(name, gui_id, value,))
-        counting.start()
-    def _countdown(self, name, gui_id, value):
-        counter = value
-        while counter >= 0:
-            output_buffer = self.encode_int_variable(ASTATION, name, gui_id, counter)
-            tkinter_output_queue.put(output_buffer)
-            time.sleep(1)
-            counter -= 1
+        '''
+        Starts the countdown of the time left at a station. The GUI counts
+        down by itself, from the deadline passed here; a zero value stops
+        the countdown. Can be called from any thread.
+
+        :param value: time left at the station, in sec.
+        '''
+        deadline = clock.now() + value if value > 0 else None
+        tkinter_output_queue.put(GUIMessage(ASTATION, name, gui_id, (deadline,)))
 
 if __name__ == '__main__':
     g = GUI()
 
-    g.voltage_1_text.set("8.1")
-    g.name_1_text.set("Blue")
+    g.register("Blue", "1")
+    g.register("Purple", "2")
+    g.register("Green", "3")
 
-    g.voltage_2_text.set("7.9")
-    g.name_2_text.set("Purple")
+    tkinter_output_queue.put(g.encode_basic_variables("Blue", "1", 8.1, 0.1, 2, 0.45))
+    tkinter_output_queue.put(g.encode_basic_variables("Purple", "2", 7.9, 0.12, 3, 0.5))
 
-    g.sector_1_label.configure(text="", bg='lightblue')
-    g.sector_2_label.configure(text="S", bg='yellow')
+    tkinter_output_queue.put(g.encode_str_variable(SECTOR, "Blue", "1", TK_BLUE))
+    tkinter_output_queue.put(g.encode_str_variable(SECTOR, "Purple", "2", TK_YELLOW, subtext="S"))
 
-    g.signal_1_label.configure(text="", bg='light gray')
-    g.signal_2_label.configure(text="", bg='purple')
+    tkinter_output_queue.put(g.encode_str_variable(SIGNAL, "Blue", "1", TK_GRAY))
+    tkinter_output_queue.put(g.encode_str_variable(SIGNAL, "Purple", "2", TK_PURPLE))
 
-    g.xtrack_1_label.configure(text="", bg='light gray')
-    g.xtrack_2_label.configure(text="", bg='purple')
+    tkinter_output_queue.put(g.encode_str_variable(XTRACK, "Blue", "1", TK_GRAY))
+    tkinter_output_queue.put(g.encode_str_variable(XTRACK, "Purple", "2", TK_PURPLE))
 
-    g.report_astation("Blue", 1, 35)
-    g.report_astation("Purple", 2, 23)
+    g.report_astation("Blue", "1", 35)
+    g.report_astation("Purple", "2", 23)
 
     g.root.after(100, g.after_callback)
     g.root.mainloop()
-
-
-
-
-
@@ -0,0 +1,170 @@
+'''
+Outbound command queue for a train hub.
+
+Each hub has its own queue, served by a dedicated writer thread. Commands
+are sent one at a time, in priority order: motor power and stop commands
+go out ahead of LED and headlight writes, so a blinking LED on one hub, or
+a flurry of status writes on the other hub, never delays a stop.
+
+Commands to different hubs go out in parallel, each from its own writer.
+If the BLE backend can't handle concurrent writes, a lock shared among all
+queues can be provided to serialize them.
+
+When running on a virtual clock, the hubs are simulated and never block,
+thus commands are sent right away, in the caller's thread.
+'''
+import queue
+import traceback
+from itertools import count
+from threading import Thread, Lock, Event
+
+from clock import clock
+
+# command priorities. Lower values go out first.
+STOP = 0
+MOTOR = 1
+LED = 2
+HEADLIGHT = 2
+
+PRIORITY_NAMES = {STOP: "stop", MOTOR: "motor", LED: "light"}
+
+
+class HubCommand():
+    '''
+    A command waiting in the queue to be sent to the hub.
+
+    :param priority: one of the priority levels defined in this module
+    :param function: the function that actually talks to the hub
+    :param args: arguments to the function
+    '''
+    def __init__(self, priority, function, args):
+        self.priority = priority
+        self.function = function
+        self.args = args
+        self.cancelled = False
+        self.result = None
+        self.enqueue_time = clock.now()
+        self.done = Event()
+
+    def wait(self, timeout=None):
+        '''
+        Waits until the command is sent, and returns the function's result.
+        '''
+        self.done.wait(timeout)
+        return self.result
+
+
+class HubCommandQueue():
+    '''
+    Priority queue of commands to one hub, plus the writer thread that
+    sends them. The writer is started when the first command is queued.
+
+    A stop supersedes motor commands still waiting in the queue; they
+    would otherwise go out after it, since they have lower priority.
+
+    :param name: name of the hub owner, used to name the writer thread
+    :param lock: optional lock shared by queues that must not write concurrently
+    '''
+    def __init__(self, name, lock=None):
+        self.name = name
+        self.lock = lock
+
+        self.queue = queue.PriorityQueue()
+        self.sequence = count()
+        self.pending_motor = []
+        self._pending_lock = Lock()
+        self.started = False
+
+        # metrics
+        self.max_depth = 0
+        self.latency = {priority: [0, 0., 0.] for priority in PRIORITY_NAMES}
+
+    def put(self, priority, function, *args):
+        '''
+        Queues function(*args) to be sent to the hub, and returns right away.
+
+        :return: a HubCommand instance
+        '''
+        command = HubCommand(priority, function, args)
+
+        if clock.virtual:
+            self._send(command)
+            return command
+
+        with self._pending_lock:
+            if not self.started:
+                self._start()
+            if priority == STOP:
+                for pending in self.pending_motor:
+                    pending.cancelled = True
+                self.pending_motor = []
+            if priority <= MOTOR:
+                self.pending_motor.append(command)
+
+            self.queue.put((priority, next(self.sequence), command))
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+
+        return command
+
+    def call(self, priority, function, *args):
+        '''
+        Queues function(*args) and waits until it is sent.
+
+        :return: the function's result
+        '''
+        return self.put(priority, function, *args).wait()
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def statistics(self):
+        '''
+        Returns a dict with current and maximum queue depth, and with count,
+        mean and maximum of the time commands spend waiting in the queue
+        (in seconds), per priority level.
+        '''
+        result = {"depth": self.depth, "max_depth": self.max_depth}
+        for priority, (n, total, maximum) in self.latency.items():
+            name = PRIORITY_NAMES[priority]
+            result[name + "_count"] = n
+            result[name + "_latency_mean"] = total / n if n > 0 else 0.
+            result[name + "_latency_max"] = maximum
+        return result
+
+    def _start(self):
+        self.started = True
+        Thread(target=self._writer_loop, name=self.name + " writer", daemon=True).start()
+
+    def _writer_loop(self):
+        while True:
+            priority, sequence, command = self.queue.get()
+
+            with self._pending_lock:
+                if command in self.pending_motor:
+                    self.pending_motor.remove(command)
+            if command.cancelled:
+                command.done.set()
+                continue
+
+            self._send(command)
+
+    def _send(self, command):
+        self._record_latency(command)
+        try:
+            if self.lock is not None:
+                with self.lock:
+                    command.result = command.function(*command.args)
+            else:
+                command.result = command.function(*command.args)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            command.done.set()
+
+    def _record_latency(self, command):
+        latency = clock.now() - command.enqueue_time
+        statistics = self.latency[command.priority]
+        statistics[0] += 1
+        statistics[1] += latency
+        statistics[2] = max(statistics[2], latency)
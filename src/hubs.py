@@ -0,0 +1,26 @@
+'''
+Selects the hub backend: real Powered UP hardware via pylgbst, or the
+in-process simulator in module simhub.py.
+
+The backend is selected by the LEGOTRAIN_HUB environment variable, which
+can be set to "ble" (the default) or "sim". Modules that talk to hubs
+import the hub classes and constants from here, never from pylgbst
+directly, so they run unchanged on either backend.
+'''
+import os
+
+BLE = "ble"
+SIMULATOR = "sim"
+
+HUB_BACKEND = os.environ.get("LEGOTRAIN_HUB", BLE)
+
+if HUB_BACKEND == SIMULATOR:
+    from simhub import SmartHub, RemoteHandset
+    from simhub import Voltage, Current, LEDLight, RemoteButton
+    from simhub import COLOR_BLUE, COLOR_ORANGE, COLOR_GREEN, COLOR_RED, COLOR_PURPLE
+elif HUB_BACKEND == BLE:
+    from pylgbst.hub import SmartHub, RemoteHandset
+    from pylgbst.peripherals import Voltage, Current, LEDLight, RemoteButton
+    from pylgbst.peripherals import COLOR_BLUE, COLOR_ORANGE, COLOR_GREEN, COLOR_RED, COLOR_PURPLE
+else:
+    raise ValueError("unknown hub backend: " + HUB_BACKEND)
@@ -0,0 +1,274 @@
+'''
+Discrete-event simulation of the full layout, for throughput studies.
+
+The real control code runs here: SmartTrain, EventProcessor, the sector and
+cross-track topology in track.py, and the station dwell policy in util.py.
+Only the hardware is simulated (module simhub.py), and time is virtual
+(module clock.py). Nothing sleeps on the wall clock, thus hours of
+operation run in seconds.
+
+Parameters can be tuned in between runs by changing them where they are
+defined, e.g.:
+
+    track.sectors[GREEN].max_speed_time = 4.
+    util.MAXIMUM_TIME_STATION_LONG = 30.
+
+The report gives, per train, station arrivals per hour, and time spent
+blocked: waiting at stations for the track ahead, stopped at a sector end
+(EventProcessor._stop_and_wait), and at the cross-track, plus the number
+of color events dropped by its EventQueue and the longest time an event
+waited there. It also gives the fraction of time each sector was occupied.
+
+The track topology in track.py has one station per direction, thus the
+simulation takes one or two trains. Studies with three or four trains need
+a topology with more stations (or sidings) to hold them.
+
+Hub commands are sent inline when running on a virtual clock (see module
+hubqueue.py): the simulated hubs never block, so commands never wait in
+the hub queues. The simulation thus doesn't exercise stop priority or the
+cancellation of superseded motor commands in the queue; their effect on
+real hubs, where BLE writes take time, is not reflected in the results.
+
+Usage, to simulate the given number of trains (default 2) for the given
+number of hours of operation (default 1):
+
+    python src/layoutsim.py [hours] [ntrains]
+'''
+import os
+import sys
+import time
+import random
+from collections import deque
+
+# the simulated hubs must be selected before module train is imported
+os.environ["LEGOTRAIN_HUB"] = "sim"
+
+import simhub
+import track
+from track import sectors, xtrack, station_sector_names, DIRECTION_A, DIRECTION_B
+from clock import clock, VirtualClock
+from scheduler import scheduler, VIRTUAL
+from event import EventProcessor
+from train import SmartTrain
+from util import VariableTimerValue
+
+# routes followed by trains in each direction
+ROUTES = {DIRECTION_A: simhub.ROUTE_A,
+          DIRECTION_B: simhub.ROUTE_B}
+
+# time in between physics steps, in sec. of virtual time
+TICK = 0.05
+
+# maximum number of sensor notifications waiting to be delivered to a train
+NOTIFICATION_BACKLOG = 256
+
+
+class _NotificationChannel():
+    '''
+    Stands for the BLE notification thread of one hub. Sensor readings over
+    a signal tile are delivered in order, by a clock participant, so they
+    run the same way they do in a real notification thread. Readings over
+    plain track can't trigger anything, thus are delivered right away, as
+    long as nothing is waiting ahead of them.
+    '''
+    def __init__(self, hub, peripheral):
+        self.hub = hub
+        self.callbacks = peripheral.callbacks
+        self.pending = deque(maxlen=NOTIFICATION_BACKLOG)
+        self.busy = False
+
+    def notify(self, *values):
+        if not self.busy and self.hub.route.color_at(self.hub.position) is None:
+            self._deliver(values)
+            return
+
+        self.pending.append(values)
+        if not self.busy:
+            self.busy = True
+            clock.spawn(self._drain)
+
+    def _drain(self):
+        while self.pending:
+            self._deliver(self.pending.popleft())
+        self.busy = False
+
+    def _deliver(self, values):
+        for callback in self.callbacks:
+            callback(*values)
+
+
+class _InstrumentedEventProcessor(EventProcessor):
+    # measures the time trains spend blocked while handling sensor events
+    def __init__(self, train):
+        super(_InstrumentedEventProcessor, self).__init__(train)
+        self.sector_wait_time = 0.
+        self.xtrack_wait_time = 0.
+
+    def _stop_and_wait(self, next_sector):
+        start = clock.now()
+        super(_InstrumentedEventProcessor, self)._stop_and_wait(next_sector)
+        self.sector_wait_time += clock.now() - start
+
+    def _process_xtrack_event(self):
+        # the event handler only takes time when the train has to stop
+        start = clock.now()
+        super(_InstrumentedEventProcessor, self)._process_xtrack_event()
+        self.xtrack_wait_time += clock.now() - start
+
+
+class _SimulatedTrain(SmartTrain):
+    # counts station arrivals
+    def __init__(self, *args, **kwargs):
+        super(_SimulatedTrain, self).__init__(*args, **kwargs)
+        self.arrivals = 0
+        self.event_processor = _InstrumentedEventProcessor(self)
+
+    def timed_stop_at_station(self):
+        if self.auto and self.power_index == 0 and self.sector is None and \
+                self.event_processor.last_station_event is not None:
+            self.arrivals += 1
+        super(_SimulatedTrain, self).timed_stop_at_station()
+
+
+class LayoutSimulation():
+    '''
+    Sets up trains on the simulated layout, and runs them in auto mode.
+
+    Trains alternate between directions, each one starting at the station
+    of its direction. The track topology in track.py has one station per
+    direction, thus it can't take more trains than that.
+
+    :param ntrains: number of trains
+    :param seed: seed for the random station dwell times and sensor noise; None for a random seed
+    :param confirm: if True, trains use the sensor confirmation stage
+    :param tick: time in between physics steps, in sec.
+    :param record: if True, trains record their telemetry in files named as
+        the trains, in the current directory (see module recorder.py)
+    '''
+    def __init__(self, ntrains=2, seed=None, confirm=False, tick=TICK, record=False):
+        directions = [DIRECTION_B, DIRECTION_A]
+        if ntrains > len(station_sector_names):
+            raise ValueError("the track topology has one station per direction, thus room for "
+                             "at most %i trains; more trains need more stations in track.py" %
+                             len(station_sector_names))
+
+        self.tick = tick
+
+        # station dwell times come from a generator owned by the simulation;
+        # sensor noise in module simhub comes from the module-level one.
+        self.generator = random.Random(seed)
+        random.seed(seed)
+
+        # everything time-related runs in virtual time from now on
+        self.clock = VirtualClock()
+        clock.use(self.clock)
+        scheduler.select(VIRTUAL)
+
+        # fresh layout and track state
+        self.layout = simhub.SimulatedLayout(realtime=False, tick=tick)
+        simhub.layout_simulator = self.layout
+        track.clear_track()
+        xtrack.initialize(None)
+
+        self.trains = []
+        for k in range(ntrains):
+            direction = directions[k % len(directions)]
+            address = "simulated hub %i" % (k + 1)
+            self.layout.configure(address, ROUTES[direction])
+
+            train = _SimulatedTrain("Train %i" % (k + 1), str(k + 1), report=True, record=record,
+                                    init_short=(k % 2 == 0), direction=direction,
+                                    address=address, confirm=confirm)
+            train.variable_timer = VariableTimerValue(short=(k % 2 == 0), generator=self.generator)
+            train.hub.vision_sensor.notify = _NotificationChannel(train.hub,
+                                                                  train.hub.vision_sensor).notify
+            self.trains.append(train)
+
+        self.occupied_time = {name: 0. for name in sectors}
+        self.xtrack_booked_time = 0.
+        self.elapsed = 0.
+
+    def run(self, hours=1.):
+        '''
+        Runs the simulation for the given number of hours of virtual time,
+        and returns the report.
+        '''
+        wall_start = time.monotonic()
+
+        # same start sequence as a dual red button press on the handset
+        track.clear_track()
+        for k, train in enumerate(self.trains):
+            train.auto = True
+            train.initialize_sectors()
+            self.clock.spawn(train.timed_stop_at_station, delay=0.5 * k)
+
+        self.clock.call_at(self.clock.now() + self.tick, self._step)
+        self.clock.run(self.clock.now() + hours * 3600.)
+
+        return self.report(time.monotonic() - wall_start)
+
+    def _step(self):
+        self.layout.step(self.tick)
+        self.elapsed += self.tick
+
+        for name, sector in sectors.items():
+            if sector.occupier is not None:
+                self.occupied_time[name] += self.tick
+        if xtrack.booked is not None:
+            self.xtrack_booked_time += self.tick
+
+        self.clock.call_at(self.clock.now() + self.tick, self._step)
+
+    def report(self, wall_time=None):
+        '''
+        Returns a dict with the simulation results.
+        '''
+        hours = self.elapsed / 3600.
+        trains = {}
+        for train in self.trains:
+            trains[train.name] = {
+                "arrivals": train.arrivals,
+                "arrivals_per_hour": train.arrivals / hours if hours > 0 else 0.,
+                "station_wait_time": train.station_wait_time,
+                "sector_wait_time": train.event_processor.sector_wait_time,
+                "xtrack_wait_time": train.event_processor.xtrack_wait_time,
+                "events_dropped": train.event_queue.dropped,
+                "event_latency_max": train.event_queue.statistics()["latency_max"],
+            }
+
+        utilization = {name: occupied / self.elapsed if self.elapsed > 0 else 0.
+                       for name, occupied in self.occupied_time.items()}
+
+        return {"simulated_hours": hours,
+                "wall_time": wall_time,
+                "arrivals_per_hour": sum([t["arrivals_per_hour"] for t in trains.values()]),
+                "trains": trains,
+                "sector_utilization": utilization,
+                "xtrack_utilization": self.xtrack_booked_time / self.elapsed if self.elapsed > 0 else 0.}
+
+
+def print_report(report):
+    print("simulated %.2f h in %.1f s" % (report["simulated_hours"], report["wall_time"]))
+    print("station arrivals per hour: %.1f" % report["arrivals_per_hour"])
+    for name, values in report["trains"].items():
+        print("  %s: %i arrivals (%.1f/h), blocked at stations %.0f s, at sector ends %.0f s, "
+              "at cross-track %.0f s; %i events dropped, max event latency %.1f s" %
+              (name, values["arrivals"], values["arrivals_per_hour"], values["station_wait_time"],
+               values["sector_wait_time"], values["xtrack_wait_time"], values["events_dropped"],
+               values["event_latency_max"]))
+    print("sector utilization:")
+    for name, fraction in report["sector_utilization"].items():
+        print("  %-6s %5.1f %%" % (name, 100. * fraction))
+    print("  %-6s %5.1f %%" % ("xtrack", 100. * report["xtrack_utilization"]))
+
+
+if __name__ == '__main__':
+    hours = 1.
+    ntrains = 2
+    if len(sys.argv) > 1:
+        hours = float(sys.argv[1])
+    if len(sys.argv) > 2:
+        ntrains = int(sys.argv[2])
+
+    simulation = LayoutSimulation(ntrains=ntrains, seed=1)
+    print_report(simulation.run(hours))
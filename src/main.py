@@ -1,6 +1,6 @@
 from threading import RLock
 
-from pylgbst.peripherals import COLOR_PURPLE
+from hubs import COLOR_PURPLE
 
 import uuid_definitions
 from train import SimpleTrain, SmartTrain, CompoundTrain
@@ -22,9 +22,11 @@ won't respond to button presses from this point on).
 
 if __name__ == '__main__':
 
-    # global lock for threading access to BLE functionality
-    lock = RLock()
-    # lock = None
+    # each hub has its own command queue and writer, so commands to different
+    # hubs go out in parallel. If the BLE backend can't cope with that, a global
+    # lock can be used to serialize all hub writes.
+    lock = None
+    # lock = RLock()
 
     # Tkinter window for displaying status information
     gui = GUI()
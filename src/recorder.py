@@ -0,0 +1,320 @@
+'''
+Background recorder for train telemetry, and reader for recorded runs.
+
+Samples are handed over by the BLE notification thread, and must never
+wait on the disk. They are kept in a bounded in-memory buffer, and
+written out in batches by a writer thread. Files are rotated when they
+grow past a given size, or get older than a given age, and only a given
+number of rotated files is kept. Week-long sessions thus produce a set
+of manageable files, and a bounded amount of disk space.
+
+Each sample holds time, voltage, current, power index, motor power, the
+sector the train is in, and the color event processed by the train's
+EventProcessor, if any. Telemetry samples have no event; event samples
+carry the most recent telemetry values.
+
+Two file formats are supported:
+
+BINARY (extension .tlm): a header, followed by fixed-width little-endian
+records. The header is the 4-byte magic string b"LGTR", the length of the
+JSON metadata that follows as a 4-byte unsigned int, and the metadata
+itself: record format, field names, and the names behind the sector and
+event codes. Records are (format "<dfffbBBx", 24 bytes):
+
+    time         float64  time, in sec. since the epoch (see below)
+    voltage      float32
+    current      float32
+    power        float32  motor power, as sent to the motor
+    power_index  int8
+    sector       uint8    0 for the inter-sector zone, else 1 + index in metadata list
+    event        uint8    0 for no event, else 1 + index in metadata list
+
+Sample times come from the shared clock (module clock.py), offset so they
+read as time since the epoch. Under a RealClock they are wall-clock times.
+In a simulation they advance in virtual time, so speeds measured from them
+are the simulated speeds.
+
+A run is loaded with read_telemetry, as one array per field, without any
+per-record parsing when NumPy is available.
+
+CSV (extension .csv): one sample per line, with a header line, and with
+time in ISO format. Meant to be read by people.
+'''
+import os
+import json
+import time
+import array
+import atexit
+import struct
+import datetime
+import traceback
+from collections import deque
+from threading import Thread, Event, Lock
+
+from signal import RED, GREEN, BLUE, YELLOW, PURPLE
+from clock import clock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# file formats
+BINARY = "binary"
+CSV = "csv"
+EXTENSIONS = {BINARY: ".tlm", CSV: ".csv"}
+
+FIELDS = ["time", "voltage", "current", "power", "power_index", "sector", "event"]
+
+MAGIC = b"LGTR"
+RECORD_FORMAT = "<dfffbBBx"
+RECORD = struct.Struct(RECORD_FORMAT)
+HEADER_LENGTH = struct.Struct("<I")
+
+# array type codes for each field, used when NumPy is not available
+TYPECODES = ["d", "f", "f", "f", "b", "B", "B"]
+
+# colors that can show up as events
+EVENT_NAMES = [RED, GREEN, BLUE, YELLOW, PURPLE]
+
+BUFFER_SIZE = 10000         # samples
+FLUSH_INTERVAL = 2.0        # s
+MAX_BYTES = 5 * 1024 * 1024 # rotate files at this size
+MAX_AGE = 24 * 3600.        # s, rotate files at this age
+BACKUPS = 7                 # number of rotated files kept
+
+
+class TelemetryRecorder():
+    '''
+    Records telemetry samples of one train in a set of rotating files. The
+    current file is named <name>.<ext>; rotated files are <name>.1.<ext>
+    (the most recent), <name>.2.<ext>, and so on.
+
+    If the writer can't keep up and the buffer fills up, the oldest samples
+    are dropped, and counted.
+
+    :param name: base name of the files, usually the train name
+    :param directory: directory where files are written
+    :param format: BINARY or CSV
+    :param sector_names: names of the sectors that may be recorded
+    :param buffer_size: maximum number of samples waiting to be written
+    :param flush_interval: time in between batched writes, in sec.
+    :param max_bytes: files are rotated when they reach this size; None to disable
+    :param max_age: files are rotated when they reach this age, in sec.; None to disable
+    :param backups: number of rotated files kept
+    '''
+    def __init__(self, name, directory=".", format=BINARY, sector_names=(),
+                 buffer_size=BUFFER_SIZE, flush_interval=FLUSH_INTERVAL,
+                 max_bytes=MAX_BYTES, max_age=MAX_AGE, backups=BACKUPS):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self.format = format
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+
+        # codes for sectors and events. Zero stands for none.
+        self.sector_names = list(sector_names)
+        self.sector_codes = {name: code + 1 for code, name in enumerate(self.sector_names)}
+        self.event_codes = {name: code + 1 for code, name in enumerate(EVENT_NAMES)}
+
+        # appending to and popping from a deque are thread-safe. A full
+        # deque discards its oldest entry when a new one is appended.
+        self.buffer = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self.written = 0
+
+        # offset from the shared clock's time to time since the epoch. The
+        # clock must thus be selected before the recorder is created.
+        self.epoch = time.time() - clock.now()
+
+        self.file = None
+        self.file_start = None
+        self._write_lock = Lock()
+
+        self._stop = Event()
+        self._writer = Thread(target=self._writer_loop, name=name + " recorder", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def record(self, voltage, current, power_index, power, sector=None, event=None):
+        '''
+        Queues one sample. Never blocks; can be called from the BLE thread.
+
+        :param sector: sector name, or None for the inter-sector zone
+        :param event: color of the event processed, or None
+        '''
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append((self.epoch + clock.now(), voltage, current, power, power_index,
+                            self.sector_codes.get(sector, 0), self.event_codes.get(event, 0)))
+
+    def flush(self):
+        '''
+        Writes out every sample waiting in the buffer.
+        '''
+        with self._write_lock:
+            samples = []
+            while self.buffer:
+                samples.append(self.buffer.popleft())
+            if len(samples) == 0:
+                return
+
+            if self.format == BINARY:
+                data = b"".join([RECORD.pack(*sample) for sample in samples])
+            else:
+                data = "".join([self._csv_line(sample) for sample in samples])
+
+            if self.file is None or self._rotation_due():
+                self._rotate()
+            self.file.write(data)
+            self.file.flush()
+            self.written += len(samples)
+
+    def close(self):
+        '''
+        Stops the writer, and writes out whatever is left in the buffer.
+        '''
+        self._stop.set()
+        self.flush()
+        with self._write_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _csv_line(self, sample):
+        sample_time, voltage, current, power, power_index, sector, event = sample
+        return "%s,%.3f,%.4f,%.3f,%i,%s,%s\n" % \
+               (datetime.datetime.fromtimestamp(sample_time).isoformat(), voltage, current, power,
+                power_index, self.sector_names[sector - 1] if sector > 0 else "",
+                EVENT_NAMES[event - 1] if event > 0 else "")
+
+    def _header(self):
+        if self.format == CSV:
+            return ",".join(FIELDS) + "\n"
+
+        metadata = json.dumps({"name": self.name,
+                               "record_format": RECORD_FORMAT,
+                               "fields": FIELDS,
+                               "sectors": self.sector_names,
+                               "events": EVENT_NAMES}).encode()
+        return MAGIC + HEADER_LENGTH.pack(len(metadata)) + metadata
+
+    def _writer_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def _file_name(self, index=0):
+        return telemetry_file_name(self.path, self.format, index)
+
+    def _rotation_due(self):
+        if self.max_bytes is not None and self.file.tell() >= self.max_bytes:
+            return True
+        if self.max_age is not None and time.time() - self.file_start >= self.max_age:
+            return True
+        return False
+
+    def _rotate(self):
+        # the first time around, a file left over from a previous session
+        # is rotated away too, so each file holds a single session.
+        if self.file is not None:
+            self.file.close()
+
+        if os.path.exists(self._file_name()):
+            oldest = self._file_name(self.backups)
+            if os.path.exists(oldest):
+                os.remove(oldest)
+            for index in range(self.backups - 1, -1, -1):
+                if os.path.exists(self._file_name(index)):
+                    os.replace(self._file_name(index), self._file_name(index + 1))
+
+        self.file = open(self._file_name(), "wb" if self.format == BINARY else "w")
+        self.file.write(self._header())
+        self.file_start = time.time()
+
+
+def telemetry_file_name(path, format=BINARY, index=0):
+    '''
+    Name of a telemetry file: the current one for index 0, else a rotated one.
+
+    :param path: directory and base name, usually the train name
+    '''
+    if index == 0:
+        return path + EXTENSIONS[format]
+    return "%s.%i%s" % (path, index, EXTENSIONS[format])
+
+
+def read_telemetry(file_name):
+    '''
+    Loads a binary telemetry file.
+
+    :return: dict with one array per field (NumPy arrays when NumPy is
+        available, else array.array instances), plus the lists of names
+        behind the sector and event codes, keyed by "sectors" and "events".
+    '''
+    with open(file_name, "rb") as f:
+        data = f.read()
+
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("not a telemetry file: " + file_name)
+    start = len(MAGIC) + HEADER_LENGTH.size
+    length, = HEADER_LENGTH.unpack_from(data, len(MAGIC))
+    metadata = json.loads(data[start:start + length].decode())
+    start += length
+
+    record = struct.Struct(metadata["record_format"])
+    end = start + (len(data) - start) // record.size * record.size
+
+    if numpy is not None:
+        records = numpy.frombuffer(data, dtype=_numpy_dtype(metadata["fields"]), offset=start,
+                                   count=(end - start) // record.size)
+        result = {field: records[field] for field in metadata["fields"]}
+    else:
+        columns = list(zip(*record.iter_unpack(data[start:end])))
+        if len(columns) == 0:
+            columns = [()] * len(metadata["fields"])
+        result = {field: array.array(typecode, column)
+                  for field, typecode, column in zip(metadata["fields"], TYPECODES, columns)}
+
+    result["sectors"] = metadata["sectors"]
+    result["events"] = metadata["events"]
+    return result
+
+
+def read_telemetry_session(path, backups=BACKUPS):
+    '''
+    Loads the current and all rotated binary telemetry files of a train,
+    and joins them in time order.
+
+    :param path: directory and base name, usually the train name
+    :return: same as read_telemetry
+    '''
+    runs = [read_telemetry(telemetry_file_name(path, BINARY, index))
+            for index in range(backups, -1, -1)
+            if os.path.exists(telemetry_file_name(path, BINARY, index))]
+    if len(runs) == 0:
+        raise FileNotFoundError(telemetry_file_name(path, BINARY))
+
+    result = {}
+    for field in FIELDS:
+        if numpy is not None:
+            result[field] = numpy.concatenate([run[field] for run in runs])
+        else:
+            result[field] = array.array(runs[0][field].typecode)
+            for run in runs:
+                result[field].extend(run[field])
+    result["sectors"] = runs[-1]["sectors"]
+    result["events"] = runs[-1]["events"]
+    return result
+
+
+def _numpy_dtype(fields):
+    # structured type equivalent to RECORD_FORMAT, including the pad byte
+    return numpy.dtype({"names": fields,
+                        "formats": ["<f8", "<f4", "<f4", "<f4", "i1", "u1", "u1"],
+                        "offsets": [0, 8, 12, 16, 20, 21, 22],
+                        "itemsize": RECORD.size})
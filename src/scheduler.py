@@ -0,0 +1,253 @@
+'''
+A single timer thread plus a small pool of worker threads, shared by all
+timed actions in the system.
+
+Before this, every timed action (sector timers, station stops, LED
+blinking, acceleration ramps, etc.) created its own short-lived thread.
+Here, timed actions are kept in a heap ordered by due time. The timer
+thread sleeps until the earliest one is due, and hands it over to the
+worker pool for execution.
+
+Actions are plain blocking functions (ramps, station dwells, hub writes).
+They can't be turned into asyncio coroutines as long as the hub API they
+end up calling, pylgbst's, is synchronous.
+
+Simulations use a second mode, where actions run in virtual time, as
+participants of a VirtualClock.
+'''
+import time
+import heapq
+import queue
+import traceback
+from itertools import count
+from threading import Thread, Condition, Lock, current_thread
+
+from clock import clock
+
+# Actions must not block for long: a blocked action holds a worker, and
+# enough of them would stall every other timed action. Waits for track
+# resources, for instance, are left with track.ReservationManager instead.
+WORKERS = 8
+
+# execution modes
+THREADED = "threaded"
+VIRTUAL = "virtual"
+
+
+class ScheduledTask():
+    '''
+    Handle to an action submitted to the Scheduler. It can be used to cancel
+    the action, in the same way as a threading.Timer instance.
+
+    A periodic action is repeated at fixed intervals, until it is cancelled,
+    or until its function returns False.
+
+    :param function: the function to call
+    :param args: arguments to the function
+    :param interval: time in between repetitions of a periodic action, or
+        None for a one-shot action
+    '''
+    def __init__(self, function, args, interval=None):
+        self.function = function
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+
+        # held while the function runs
+        self._run_lock = Lock()
+        self._runner = None
+
+    def cancel(self, wait=False):
+        '''
+        Cancels the action. If it is running right now, the current run
+        completes, but there won't be any further runs.
+
+        :param wait: if True, and the action is running in another thread,
+            block until that run completes
+        '''
+        self.cancelled = True
+        if wait and self._runner is not current_thread():
+            with self._run_lock:
+                pass
+
+    def run(self):
+        '''
+        Runs the action, unless it was cancelled.
+
+        :return: True if it must be scheduled again
+        '''
+        with self._run_lock:
+            if self.cancelled:
+                return False
+            self._runner = current_thread()
+            try:
+                result = self.function(*self.args)
+            except Exception:
+                traceback.print_exc()
+                result = False
+            finally:
+                self._runner = None
+
+        return self._repeat(result)
+
+    def _repeat(self, result):
+        return self.interval is not None and result is not False and not self.cancelled
+
+
+class Scheduler():
+    '''
+    Runs actions after a delay, or at fixed intervals, in a shared pool of
+    worker threads. Threads are started when the first action is submitted.
+
+    :param workers: number of worker threads
+    '''
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self.condition = Condition()
+
+        # heap entries are (due time, sequence number, task). The sequence
+        # number keeps ordering stable among tasks with same due time.
+        self.heap = []
+        self.sequence = count()
+
+        self.ready = queue.SimpleQueue()
+        self.started = False
+
+    def call_later(self, delay, function, *args):
+        '''
+        Runs function(*args) once, after delay seconds.
+
+        :return: a ScheduledTask instance
+        '''
+        task = ScheduledTask(function, args)
+        self._schedule(task, time.monotonic() + delay)
+        return task
+
+    def call_periodic(self, interval, function, *args, delay=0.):
+        '''
+        Runs function(*args) after delay seconds, and then repeatedly, with
+        interval seconds in between the end of a run and the start of the
+        next. It stops when cancelled, or when the function returns False.
+
+        :return: a ScheduledTask instance
+        '''
+        task = ScheduledTask(function, args, interval=interval)
+        self._schedule(task, time.monotonic() + delay)
+        return task
+
+    def submit(self, function, *args):
+        '''
+        Runs function(*args) as soon as a worker thread is available.
+
+        :return: a ScheduledTask instance
+        '''
+        return self.call_later(0., function, *args)
+
+    def _schedule(self, task, due_time):
+        with self.condition:
+            if not self.started:
+                self._start()
+            heapq.heappush(self.heap, (due_time, next(self.sequence), task))
+            self.condition.notify()
+
+    def _start(self):
+        self.started = True
+        Thread(target=self._timer_loop, name="scheduler timer", daemon=True).start()
+        for k in range(self.workers):
+            Thread(target=self._worker_loop, name="scheduler worker %i" % k, daemon=True).start()
+
+    def _timer_loop(self):
+        while True:
+            with self.condition:
+                while True:
+                    # cancelled tasks are just discarded when they get to the top
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+
+                    now = time.monotonic()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+
+                    timeout = None
+                    if self.heap:
+                        timeout = self.heap[0][0] - now
+                    self.condition.wait(timeout)
+
+                due_time, sequence, task = heapq.heappop(self.heap)
+
+            self.ready.put(task)
+
+    def _worker_loop(self):
+        while True:
+            task = self.ready.get()
+            if task.run():
+                self._schedule(task, time.monotonic() + task.interval)
+
+
+class VirtualScheduler():
+    '''
+    Same interface as Scheduler, for simulations running on a VirtualClock.
+    Each action runs in a participant thread of the clock, and its delays
+    and intervals elapse in virtual time.
+
+    Nothing runs in the background, thus the scheduler mode can be switched
+    at any time; each simulation run selects a fresh virtual clock.
+    '''
+    started = False
+
+    def call_later(self, delay, function, *args):
+        task = ScheduledTask(function, args)
+        clock.spawn(self._run, task, delay=delay)
+        return task
+
+    def call_periodic(self, interval, function, *args, delay=0.):
+        task = ScheduledTask(function, args, interval=interval)
+        clock.spawn(self._run, task, delay=delay)
+        return task
+
+    def submit(self, function, *args):
+        return self.call_later(0., function, *args)
+
+    def _run(self, task):
+        while task.run():
+            clock.sleep(task.interval)
+
+
+class SchedulerSelector():
+    '''
+    Front end to the scheduler that actually runs the actions. Modules
+    import the shared instance below by name, thus the execution mode is
+    switched by replacing the backend behind it. This can only be done
+    before the first action is submitted.
+
+    :param mode: THREADED or VIRTUAL
+    :param workers: number of worker threads
+    '''
+    def __init__(self, mode=THREADED, workers=WORKERS):
+        self.backend = None
+        self.select(mode, workers)
+
+    def select(self, mode, workers=WORKERS):
+        if self.backend is not None and self.backend.started:
+            raise RuntimeError("scheduler mode must be selected before any action is submitted")
+
+        if mode == THREADED:
+            self.backend = Scheduler(workers)
+        elif mode == VIRTUAL:
+            self.backend = VirtualScheduler()
+        else:
+            raise ValueError("unknown scheduler mode: " + str(mode))
+        self.mode = mode
+
+    def call_later(self, delay, function, *args):
+        return self.backend.call_later(delay, function, *args)
+
+    def call_periodic(self, interval, function, *args, delay=0.):
+        return self.backend.call_periodic(interval, function, *args, delay=delay)
+
+    def submit(self, function, *args):
+        return self.backend.submit(function, *args)
+
+
+# scheduler shared by the entire system
+scheduler = SchedulerSelector()
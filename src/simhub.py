@@ -0,0 +1,421 @@
+'''
+In-process simulation of the Powered UP hardware, for running the control
+logic on a machine without Bluetooth, or without trains.
+
+The simulated SmartHub and RemoteHandset classes expose the subset of the
+pylgbst API that is used by this package, and can be used as drop-in
+replacements for the real ones (see module hubs.py).
+
+Each simulated train hub runs along a route: a closed loop of track with
+color tiles at given positions. Motor power drives the train along the
+route, the vision sensor streams the RGB readings of whatever is under
+it, and the battery voltage sags with the current drawn by the motor.
+The handset buttons are pressed programmatically.
+
+The physics is advanced by SimulatedLayout.step. By default, a thread
+calls it in real time; a simulation driver may instead call it directly,
+with its own notion of time.
+'''
+import random
+import time
+from threading import Thread, Lock
+
+import uuid_definitions
+from signal import RED, GREEN, BLUE, YELLOW, PURPLE
+
+# LED colors, with the same values used by pylgbst
+COLOR_BLACK = 0x00
+COLOR_PINK = 0x01
+COLOR_PURPLE = 0x02
+COLOR_BLUE = 0x03
+COLOR_LIGHTBLUE = 0x04
+COLOR_CYAN = 0x05
+COLOR_GREEN = 0x06
+COLOR_YELLOW = 0x07
+COLOR_ORANGE = 0x08
+COLOR_RED = 0x09
+COLOR_WHITE = 0x0A
+COLOR_NONE = 0xFF
+
+# mean sensor readings over each kind of surface, from the captures in test/data
+TILE_RGB = {RED:    (220,  38,  43),
+            GREEN:  ( 34, 122,  53),
+            BLUE:   ( 48, 158, 250),
+            YELLOW: (345, 283, 144),
+            PURPLE: (184,  43,  71)}
+TRACK_RGB = (51, 58, 64)
+SENSOR_NOISE = 3  # uniform, in sensor units
+
+# train dynamics
+MAX_SPEED_CMS = 80.    # speed at full power and nominal voltage, in cm/s
+DEADBAND = 0.2         # the motor doesn't move the train below this power
+INERTIA = 0.3          # time constant for speeding up, in sec.
+COASTING = 0.8         # time constant for slowing down, in sec. Trains roll a bit
+                       # after the power is cut, so they stop past the station tile.
+
+# battery model
+BATTERY_VOLTAGE = 8.3  # fresh batteries, in Volts
+NOMINAL_VOLTAGE = 8.0
+INTERNAL_RESISTANCE = 1.2  # Ohm
+IDLE_CURRENT = 0.05    # Amp
+LOAD_CURRENT = 0.6     # current at full power, in Amp
+DRAIN = 0.0005         # Volts lost per Amp.sec of charge drawn
+
+# time in between physics steps and sensor notifications, in sec.
+TICK = 0.02
+SENSOR_INTERVAL = 0.05
+BATTERY_INTERVAL = 0.5
+
+
+class Peripheral():
+    '''
+    Simulated hub peripheral that can be subscribed to.
+    '''
+    def __init__(self):
+        self.callbacks = []
+
+    def subscribe(self, callback, mode=None, granularity=1):
+        self.callbacks.append(callback)
+
+    def unsubscribe(self, callback=None):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    def notify(self, *values):
+        for callback in self.callbacks:
+            callback(*values)
+
+
+class Motor(Peripheral):
+    def __init__(self):
+        super(Motor, self).__init__()
+        self.power_setting = 0.
+
+    def power(self, param=1.0):
+        self.power_setting = max(min(param, 1.), -1.)
+
+
+class LEDRGB(Peripheral):
+    def __init__(self):
+        super(LEDRGB, self).__init__()
+        self.color = COLOR_WHITE
+
+    def set_color(self, color):
+        self.color = color
+
+
+class LEDLight(Peripheral):
+    def __init__(self):
+        super(LEDLight, self).__init__()
+        self.brightness = 100
+
+    def set_brightness(self, brightness):
+        self.brightness = brightness
+
+
+class VisionSensor(Peripheral):
+    pass
+
+
+class Voltage(Peripheral):
+    VOLTAGE_L = 0x00
+
+
+class Current(Peripheral):
+    CURRENT_L = 0x00
+
+
+class RemoteButton():
+    # button sets
+    LEFT = 0
+    RIGHT = 1
+
+    # buttons
+    RELEASE = 0
+    PLUS = 1
+    RED = 127
+    MINUS = 255
+
+
+class Tile():
+    '''
+    A color tile on the track.
+
+    :param position: position of the tile start along the route, in cm
+    :param color: signal color, one of the keys in TILE_RGB
+    :param length: tile length along the track, in cm
+    '''
+    def __init__(self, position, color, length=8.):
+        self.position = position
+        self.color = color
+        self.length = length
+
+
+class Route():
+    '''
+    Closed loop of track followed by a train, with color tiles on it.
+
+    :param length: route length in cm
+    :param tiles: list of Tile instances
+    :param start: initial position of the train, in cm
+    '''
+    def __init__(self, length, tiles, start=0.):
+        self.length = length
+        self.tiles = sorted(tiles, key=lambda tile: tile.position)
+        self.start = start
+
+    def color_at(self, position):
+        '''
+        Returns the color of the tile at position, or None if over plain track.
+        '''
+        position = position % self.length
+        for tile in self.tiles:
+            if tile.position <= position < tile.position + tile.length:
+                return tile.color
+        return None
+
+
+# Approximation of the layout defined in track.py. Station stop tiles are
+# short, so that trains coming to a stop roll past them. Train hubs running in
+# DIRECTION_B start right after the RED_1 station stop tile, cross BLUE
+# (a structured sector, with a mid tile), GREEN (with the cross-track pair
+# of YELLOW tiles in it), and arrive back at RED_1.
+ROUTE_B = Route(1000., [Tile( 60., BLUE), Tile(300., BLUE), Tile(420., BLUE),
+                        Tile(480., GREEN), Tile(560., YELLOW), Tile(640., YELLOW),
+                        Tile(780., GREEN),
+                        Tile(840., RED), Tile(960., RED, length=4.)],
+                start=975.)
+
+# Train hubs running in DIRECTION_A leave the RED_2 station over the
+# cross-track, which is released by a YELLOW tile in the inter-sector zone.
+ROUTE_A = Route(1000., [Tile( 30., YELLOW),
+                        Tile( 90., BLUE), Tile(330., BLUE), Tile(450., BLUE),
+                        Tile(510., GREEN), Tile(790., GREEN),
+                        Tile(840., RED), Tile(960., RED, length=4.)],
+                start=975.)
+
+
+class SmartHub():
+    '''
+    Simulated train hub. Port A drives the motor. Port B has either a
+    vision sensor or a headlight, depending on the layout configuration
+    for the hub address.
+
+    :param address: hub address, used to look up its configuration in the layout
+    :param layout: SimulatedLayout instance; defaults to the module's layout
+    '''
+    def __init__(self, address=None, layout=None):
+        self.address = address
+        self.layout = layout
+        if self.layout is None:
+            self.layout = layout_simulator
+
+        route, headlight = self.layout.configuration(address)
+        self.route = route
+        self.position = route.start
+        self.speed = 0.
+        self.battery_voltage = BATTERY_VOLTAGE
+        self.current_value = IDLE_CURRENT
+        self.voltage_value = BATTERY_VOLTAGE - INTERNAL_RESISTANCE * IDLE_CURRENT
+
+        self.led = LEDRGB()
+        self.port_A = Motor()
+        self.voltage = Voltage()
+        self.current = Current()
+        if headlight:
+            self.vision_sensor = None
+            self.port_B = LEDLight()
+        else:
+            self.vision_sensor = VisionSensor()
+            self.port_B = self.vision_sensor
+
+        self.sensor_time = 0.
+        self.battery_time = 0.
+        self.layout.add_hub(self)
+
+    def step(self, dt):
+        '''
+        Advances the hub state by dt seconds, and notifies the sensors.
+        '''
+        power = self.port_A.power_setting
+
+        # current drawn by the motor, and voltage sag caused by it
+        self.current_value = IDLE_CURRENT + LOAD_CURRENT * abs(power)
+        self.battery_voltage -= DRAIN * self.current_value * dt
+        self.voltage_value = self.battery_voltage - INTERNAL_RESISTANCE * self.current_value
+
+        # target speed is proportional to the power above the deadband, and to the voltage
+        target = 0.
+        if abs(power) > DEADBAND:
+            target = MAX_SPEED_CMS * (abs(power) - DEADBAND) / (1. - DEADBAND)
+            target *= self.voltage_value / NOMINAL_VOLTAGE
+            if power < 0:
+                target = -target
+        time_constant = INERTIA if abs(target) > abs(self.speed) else COASTING
+        self.speed += (target - self.speed) * min(dt / time_constant, 1.)
+        self.position = (self.position + self.speed * dt) % self.route.length
+
+        self.sensor_time += dt
+        if self.vision_sensor is not None and self.sensor_time >= SENSOR_INTERVAL:
+            self.sensor_time = 0.
+            self.vision_sensor.notify(*self.sensor_reading())
+
+        self.battery_time += dt
+        if self.battery_time >= BATTERY_INTERVAL:
+            self.battery_time = 0.
+            self.voltage.notify(self.voltage_value)
+            self.current.notify(self.current_value)
+
+    def sensor_reading(self):
+        '''
+        Returns a noisy (r, g, b) reading of the surface under the sensor.
+        '''
+        color = self.route.color_at(self.position)
+        rgb = TILE_RGB[color] if color is not None else TRACK_RGB
+        return tuple(max(0, value + random.randint(-SENSOR_NOISE, SENSOR_NOISE)) for value in rgb)
+
+    def disconnect(self):
+        self.layout.remove_hub(self)
+
+
+class HandsetPort(Peripheral):
+    '''
+    One of the two button sets in the simulated handset.
+    '''
+    def __init__(self, button_set):
+        super(HandsetPort, self).__init__()
+        self.button_set = button_set
+
+
+class RemoteHandset():
+    '''
+    Simulated handset. Buttons are pressed by calling method press.
+
+    :param address: handset address (ignored)
+    :param layout: SimulatedLayout instance; defaults to the module's layout
+    '''
+    def __init__(self, address=None, layout=None):
+        self.address = address
+        self.layout = layout
+        if self.layout is None:
+            self.layout = layout_simulator
+
+        self.led = LEDRGB()
+        self.port_A = HandsetPort(RemoteButton.LEFT)
+        self.port_B = HandsetPort(RemoteButton.RIGHT)
+        self.layout.handset = self
+
+    def press(self, button_set, button, duration=0.1):
+        '''
+        Presses a button, and releases it after duration seconds of layout time.
+
+        :param button_set: RemoteButton.LEFT or RemoteButton.RIGHT
+        :param button: RemoteButton.PLUS, RED or MINUS
+        '''
+        port = self.port_A if button_set == RemoteButton.LEFT else self.port_B
+        port.notify(button, port.button_set)
+        self.layout.call_later(duration, port.notify, RemoteButton.RELEASE, port.button_set)
+
+    def press_dual(self, button=RemoteButton.RED, duration=0.1):
+        '''
+        Presses the same button in both sets at the same time.
+        '''
+        self.port_A.notify(button, self.port_A.button_set)
+        self.port_B.notify(button, self.port_B.button_set)
+        self.layout.call_later(duration, self.port_A.notify, RemoteButton.RELEASE, self.port_A.button_set)
+        self.layout.call_later(duration, self.port_B.notify, RemoteButton.RELEASE, self.port_B.button_set)
+
+    def disconnect(self):
+        pass
+
+
+class SimulatedLayout():
+    '''
+    Holds the simulated hubs, and advances them in time.
+
+    Routes and port B devices are configured per hub address. Hubs with an
+    address that wasn't configured run on the default route, with a vision
+    sensor.
+
+    :param default_route: route for hubs without a configuration
+    :param tick: time in between physics steps, in sec.
+    :param realtime: if True, start advancing in real time as soon as a hub
+        is added; otherwise, the caller is in charge of calling method step
+    '''
+    def __init__(self, default_route=ROUTE_B, tick=TICK, realtime=True):
+        self.default_route = default_route
+        self.tick = tick
+        self.realtime = realtime
+        self.routes = {}
+        self.hubs = []
+        self.handset = None
+        self.time = 0.
+
+        # actions to be executed at a given layout time: [time, function, args]
+        self.pending = []
+
+        self.lock = Lock()
+        self.thread = None
+
+    def configure(self, address, route, headlight=False):
+        '''
+        Defines the route a hub runs on, and whether it has a headlight
+        instead of a vision sensor on port B.
+        '''
+        self.routes[address] = (route, headlight)
+
+    def configuration(self, address):
+        return self.routes.get(address, (self.default_route, False))
+
+    def add_hub(self, hub):
+        with self.lock:
+            self.hubs.append(hub)
+        if self.realtime:
+            self.start()
+
+    def remove_hub(self, hub):
+        with self.lock:
+            if hub in self.hubs:
+                self.hubs.remove(hub)
+
+    def call_later(self, delay, function, *args):
+        with self.lock:
+            self.pending.append([self.time + delay, function, args])
+
+    def step(self, dt):
+        '''
+        Advances all hubs by dt seconds, and runs the actions that became due.
+        '''
+        with self.lock:
+            self.time += dt
+            hubs = list(self.hubs)
+            due = [action for action in self.pending if action[0] <= self.time]
+            self.pending = [action for action in self.pending if action[0] > self.time]
+
+        for hub in hubs:
+            hub.step(dt)
+        for due_time, function, args in due:
+            function(*args)
+
+    def start(self):
+        '''
+        Starts advancing the layout in real time, in a background thread.
+        '''
+        if self.thread is None:
+            self.thread = Thread(target=self._run, name="layout simulator", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        previous = time.monotonic()
+        while True:
+            time.sleep(self.tick)
+            now = time.monotonic()
+            self.step(now - previous)
+            previous = now
+
+
+# layout shared by all simulated hubs, unless told otherwise. The hubs
+# configured in main.py run on the routes that match their directions.
+layout_simulator = SimulatedLayout()
+layout_simulator.configure(uuid_definitions.HUB_ORIG, ROUTE_B)
+layout_simulator.configure(uuid_definitions.HUB_TEST, ROUTE_A)
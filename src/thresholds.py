@@ -0,0 +1,369 @@
+'''
+Fitting of the hue and saturation ranges used to classify vision sensor
+readings, from labeled sensor captures.
+
+Captures are labeled by file name (see LABELS): each one holds readings
+of either a signal tile of a given color, or of background surfaces
+(track, carpet) that must not be taken for a signal. Readings are
+converted to HSV and filtered exactly as HSVClassifier does, hue
+wrap-around included.
+
+For each color, a box in the hue-saturation plane is fitted by
+coordinate descent over a fine grid. Each box edge is moved to where it
+minimizes
+
+    false negative rate + FALSE_POSITIVE_WEIGHT * false positive rate
+
+where false negatives are readings of the color left out of the box, and
+false positives are readings of every other label (background and other
+colors) that fall in it. Colors are fitted in turn, in the order they are
+tested at runtime, and a box may not overlap the boxes fitted before it,
+nor those of colors left with the ranges in signal.py. Otherwise, two
+colors whose readings are close would both extend their boxes to the
+middle of the gap in between, and readings in the overlap would all go
+to the color tested first. Edge positions are evaluated all at once, from
+2D cumulative histograms of the readings, so a fit over hundreds of
+thousands of readings takes a fraction of a second. Usually a whole range
+of positions is equally good: the edge goes to the middle of it, which
+maximizes the distance to readings on both sides, and thus the tolerance
+to lighting changes. The brightness and signal-to-noise cut-offs are not
+fitted; they come from signal.py.
+
+Alternatively, a statistical classifier (classifier.MahalanobisClassifier)
+can be fitted instead: the mean and covariance of each color's readings
+in the chromaticity plane. Its clusters can be tilted and elongated,
+which boxes in the hue-saturation plane can't follow. Readings of the
+background are only used to evaluate it.
+
+The fitted classifier is then evaluated on all readings, with colors
+tested in the same order as at runtime, and the expected false positive
+and false negative rates are reported per color.
+
+Results are written to a threshold table file, and to a lookup table
+file compiled from it. Trains load both at startup, in place of the
+ranges in signal.py (see classifier.load_color_table).
+
+Usage, to fit the captures in a directory and write the files in the
+current directory:
+
+    python src/thresholds.py test/data [mahalanobis]
+'''
+import os
+import sys
+import json
+from math import floor, ceil
+
+import numpy
+
+from signal import RED, GREEN, BLUE, YELLOW, PURPLE, RGB_MINIMUM, V_MINIMUM
+from classifier import HSVClassifier, MahalanobisClassifier, ColorLookupTable, COLOR_ORDER, HUE_WRAP, \
+    THRESHOLD_FILE, TABLE_FILE, HSV, MAHALANOBIS, MINIMUM_CONFIDENCE, MINIMUM_SIGMA
+from colorimetry import load_capture, rgb_to_hsv
+
+# labels of the capture files, keyed by file name. None stands for
+# background. Captures of tiles not used in the layout (LighterBlue,
+# DarkerYellow, LightPurple) are left out; swap them in to use those tiles.
+LABELS = {"Red.csv": RED,
+          "DarkGreen.csv": GREEN,
+          "DarkerBlue.csv": BLUE,
+          "LighterYellow.csv": YELLOW,
+          "DarkPurple.csv": PURPLE,
+          "Track.csv": None,
+          "Carpet.csv": None}
+
+FALSE_POSITIVE_WEIGHT = 10.  # a false signal is worse than a missed sample
+GRID_BINS = 256              # grid resolution, per axis
+WINDOW_EXTENSION = 1.        # grid extends this many times the color's spread on each side
+MINIMUM_WINDOW = 0.02        # minimum extension, in hue or saturation units
+MAX_ITERATIONS = 20
+OVERLAP_WEIGHT = 1.e6        # cost of overlapping another box, per unit of grid cell area
+ROUNDING = 4                 # decimal places kept in the fitted ranges
+
+
+def load_labeled(directory, labels=LABELS):
+    '''
+    Loads the labeled captures found in a directory.
+
+    :return: dict with one readings array per label
+    '''
+    result = {}
+    for file_name, label in labels.items():
+        path = os.path.join(directory, file_name)
+        if os.path.exists(path):
+            readings = load_capture(path)
+            if label in result:
+                readings = numpy.concatenate([result[label], readings])
+            result[label] = readings
+    return result
+
+
+def _features(readings, rgb_minimum=RGB_MINIMUM, v_minimum=V_MINIMUM):
+    # unwrapped hue and saturation of each reading, and whether it passes
+    # the same filters HSVClassifier.classify applies.
+    hsv = rgb_to_hsv(readings)
+    h, s, v = hsv[:, 0], hsv[:, 1], hsv[:, 2]
+    accepted = (h > 0.) & (h < 1.) & (readings.min(axis=1) >= rgb_minimum) & (v >= v_minimum)
+    h = numpy.where((h > 0.) & (h <= HUE_WRAP), h + 1., h)
+    return h, s, accepted
+
+
+def classify(classifier, readings):
+    '''
+    Vectorized equivalent of classifier.classify over many readings.
+
+    :return: array with the index of each reading's color in
+        classifier.colors, or -1 for no color
+    '''
+    if classifier.type == MAHALANOBIS:
+        return classifier.score_array(readings)[0]
+
+    h, s, accepted = _features(readings, classifier.rgb_minimum, classifier.v_minimum)
+    result = numpy.full(len(readings), -1)
+    # colors are tested in order, the first match wins
+    for index in range(len(classifier.colors) - 1, -1, -1):
+        color = classifier.colors[index]
+        inside = accepted & \
+            (h >= classifier.hue[color][0]) & (h <= classifier.hue[color][1]) & \
+            (s >= classifier.saturation[color][0]) & (s <= classifier.saturation[color][1])
+        result[inside] = index
+    return result
+
+
+class _BoxFit():
+    # fits one color's box on a grid, from cumulative histograms of the
+    # color's readings and of everything else, plus a cumulative map of
+    # the area taken by other boxes.
+    def __init__(self, own, others, own_total, others_total, boxes=()):
+        h, s = own
+        low = numpy.percentile(numpy.column_stack([h, s]), 0.1, axis=0)
+        high = numpy.percentile(numpy.column_stack([h, s]), 99.9, axis=0)
+        extension = numpy.maximum(WINDOW_EXTENSION * (high - low), MINIMUM_WINDOW)
+        # hues at or below HUE_WRAP can't show up, since they get unwrapped
+        self.h_edges = numpy.linspace(max(low[0] - extension[0], HUE_WRAP),
+                                      min(high[0] + extension[0], 1. + HUE_WRAP), GRID_BINS + 1)
+        self.s_edges = numpy.linspace(max(low[1] - extension[1], 0.),
+                                      min(high[1] + extension[1], 1.), GRID_BINS + 1)
+
+        self.own = self._cumulative(own)
+        self.others = self._cumulative(others)
+        self.own_total = max(own_total, 1)
+        self.others_total = max(others_total, 1)
+
+        # area of each grid cell covered by the boxes, in units of cell area
+        taken = numpy.zeros((GRID_BINS, GRID_BINS))
+        for (h0, h1), (s0, s1) in boxes:
+            h_overlap = self._overlap(self.h_edges, h0, h1)
+            s_overlap = self._overlap(self.s_edges, s0, s1)
+            taken += numpy.outer(h_overlap, s_overlap)
+        self.taken = numpy.zeros((GRID_BINS + 1, GRID_BINS + 1))
+        self.taken[1:, 1:] = taken.cumsum(axis=0).cumsum(axis=1)
+
+    def _overlap(self, edges, low, high):
+        # fraction of each grid interval that falls in between low and high
+        overlap = numpy.minimum(edges[1:], high) - numpy.maximum(edges[:-1], low)
+        return numpy.maximum(overlap, 0.) / (edges[1:] - edges[:-1])
+
+    def _cumulative(self, points):
+        histogram, h_edges, s_edges = numpy.histogram2d(points[0], points[1],
+                                                        bins=[self.h_edges, self.s_edges])
+        result = numpy.zeros((GRID_BINS + 1, GRID_BINS + 1))
+        result[1:, 1:] = histogram.cumsum(axis=0).cumsum(axis=1)
+        return result
+
+    def _count(self, table, h0, h1, s0, s1):
+        # readings in the box with the given edge indices; arguments may be arrays
+        return table[h1, s1] - table[h0, s1] - table[h1, s0] + table[h0, s0]
+
+    def cost(self, h0, h1, s0, s1):
+        missed = self.own_total - self._count(self.own, h0, h1, s0, s1)
+        false = self._count(self.others, h0, h1, s0, s1)
+        overlap = self._count(self.taken, h0, h1, s0, s1)
+        return missed / self.own_total + FALSE_POSITIVE_WEIGHT * false / self.others_total + \
+            OVERLAP_WEIGHT * overlap
+
+    def fit(self):
+        # start with the whole window, then move one edge at a time
+        edges = [0, GRID_BINS, 0, GRID_BINS]
+        for iteration in range(MAX_ITERATIONS):
+            previous = list(edges)
+            for k in range(4):
+                edges[k] = self._best_edge(edges, k)
+            if edges == previous:
+                break
+
+        # ranges are rounded inwards, so they don't grow into other boxes
+        scale = 10 ** ROUNDING
+        return ((ceil(self.h_edges[edges[0]] * scale) / scale, floor(self.h_edges[edges[1]] * scale) / scale),
+                (ceil(self.s_edges[edges[2]] * scale) / scale, floor(self.s_edges[edges[3]] * scale) / scale))
+
+    def _best_edge(self, edges, k):
+        # lower edges range up to the upper edge, and the other way round
+        if k % 2 == 0:
+            candidates = numpy.arange(0, edges[k + 1])
+        else:
+            candidates = numpy.arange(edges[k - 1] + 1, GRID_BINS + 1)
+        arguments = list(edges)
+        arguments[k] = candidates
+        costs = self.cost(*arguments)
+
+        # among equally good positions, take the middle of the run closest
+        # to the color's own readings
+        best = numpy.flatnonzero(costs <= costs.min() + 1.e-12)
+        if k % 2 == 0:
+            end = len(best) - 1
+            start = end
+            while start > 0 and best[start - 1] == best[start] - 1:
+                start -= 1
+        else:
+            start = 0
+            end = start
+            while end < len(best) - 1 and best[end + 1] == best[end] + 1:
+                end += 1
+        return int(candidates[best[(start + end) // 2]])
+
+
+def fit_thresholds(labeled, colors=COLOR_ORDER, rgb_minimum=RGB_MINIMUM, v_minimum=V_MINIMUM):
+    '''
+    Fits hue and saturation ranges to labeled readings.
+
+    :param labeled: dict with one readings array per label, as returned by
+        load_labeled. Label None stands for background.
+    :param colors: colors to fit, in the order they are tested at runtime.
+        Colors without readings keep the ranges in signal.py.
+    :return: an HSVClassifier instance
+    '''
+    features = {label: _features(readings, rgb_minimum, v_minimum) for label, readings in labeled.items()}
+    classifier = HSVClassifier(rgb_minimum=rgb_minimum, v_minimum=v_minimum, colors=list(colors))
+    hue = dict(classifier.hue)
+    saturation = dict(classifier.saturation)
+
+    # boxes fitted so far, plus those of colors that won't be fitted
+    boxes = [(hue[color], saturation[color]) for color in colors
+             if color not in labeled or not features[color][2].any()]
+
+    for color in colors:
+        if color not in labeled:
+            continue
+        h, s, accepted = features[color]
+        if not accepted.any():
+            continue
+
+        others = [label for label in labeled if label != color]
+        others_h = numpy.concatenate([features[label][0][features[label][2]] for label in others])
+        others_s = numpy.concatenate([features[label][1][features[label][2]] for label in others])
+
+        box = _BoxFit((h[accepted], s[accepted]), (others_h, others_s),
+                      len(h), sum([len(labeled[label]) for label in others]), boxes)
+        hue[color], saturation[color] = box.fit()
+        boxes.append((hue[color], saturation[color]))
+
+    classifier.hue = {color: tuple(hue[color]) for color in colors}
+    classifier.saturation = {color: tuple(saturation[color]) for color in colors}
+    return classifier
+
+
+def fit_statistical(labeled, colors=COLOR_ORDER, min_confidence=MINIMUM_CONFIDENCE,
+                    rgb_minimum=RGB_MINIMUM, v_minimum=V_MINIMUM):
+    '''
+    Fits the chromaticity mean and covariance of each color to labeled
+    readings. Readings are filtered by the same cut-offs as at runtime.
+
+    :param labeled: dict with one readings array per label, as returned by
+        load_labeled. Background readings are not used.
+    :param colors: colors to fit, in the order they are tested at runtime.
+        Colors without readings are left out of the classifier.
+    :param min_confidence: readings with lower confidence are rejected
+    :return: a MahalanobisClassifier instance
+    '''
+    centroids = {}
+    covariances = {}
+    for color in colors:
+        if color not in labeled:
+            continue
+        readings = labeled[color]
+        accepted = (readings.min(axis=1) >= rgb_minimum) & (readings.max(axis=1) >= v_minimum)
+        readings = readings[accepted]
+        if len(readings) < 2:
+            continue
+
+        chromaticity = readings[:, :2] / readings.sum(axis=1)[:, None]
+        covariance = numpy.cov(chromaticity, rowvar=False) + MINIMUM_SIGMA ** 2 * numpy.eye(2)
+        centroids[color] = [round(float(v), 6) for v in chromaticity.mean(axis=0)]
+        covariances[color] = [[float(v) for v in row] for row in covariance]
+
+    return MahalanobisClassifier(centroids, covariances, min_confidence=min_confidence,
+                                 rgb_minimum=rgb_minimum, v_minimum=v_minimum, colors=list(colors))
+
+
+def evaluate(classifier, labeled):
+    '''
+    Runs the classifier on labeled readings.
+
+    :return: dict keyed by color, with the false negative rate (readings of
+        the color not classified as such) and false positive rate (readings
+        of other labels classified as the color), plus the number of
+        readings of the color. Key None gives the rate of background
+        readings classified as any color.
+    '''
+    results = {label: classify(classifier, readings) for label, readings in labeled.items()}
+    total = sum([len(readings) for readings in labeled.values()])
+
+    report = {}
+    for index, color in enumerate(classifier.colors):
+        own = results.get(color)
+        false_positives = sum([int((result == index).sum()) for label, result in results.items() if label != color])
+        others = total - (len(own) if own is not None else 0)
+        report[color] = {"readings": len(own) if own is not None else 0,
+                         "false_negative_rate": float((own != index).mean()) if own is not None else None,
+                         "false_positive_rate": false_positives / others if others > 0 else 0.}
+    if None in results:
+        report[None] = {"readings": len(results[None]),
+                        "false_positive_rate": float((results[None] >= 0).mean())}
+    return report
+
+
+def save(classifier, report, threshold_file=THRESHOLD_FILE, table_file=TABLE_FILE):
+    '''
+    Writes the threshold table, with the evaluation report, and the
+    lookup table compiled from it.
+    '''
+    thresholds = classifier.parameters()
+    thresholds["report"] = {str(color): values for color, values in report.items()}
+    with open(threshold_file, "w") as f:
+        json.dump(thresholds, f, indent=4)
+
+    ColorLookupTable(classifier).save(table_file)
+
+
+if __name__ == '__main__':
+    directory = sys.argv[1]
+    method = sys.argv[2] if len(sys.argv) > 2 else HSV
+
+    labeled = load_labeled(directory)
+    if method == MAHALANOBIS:
+        fitted = fit_statistical(labeled)
+    else:
+        fitted = fit_thresholds(labeled)
+    fitted_report = evaluate(fitted, labeled)
+    current_report = evaluate(HSVClassifier(), labeled)
+    save(fitted, fitted_report)
+
+    print("color     FN rate  FP rate  (signal.py: FN, FP)  fitted parameters")
+    for color in fitted.colors:
+        values = fitted_report[color]
+        current = current_report.get(color, {"false_negative_rate": None, "false_positive_rate": 0.})
+        false_negatives = values["false_negative_rate"]
+        if method == MAHALANOBIS:
+            parameters = "centroid %.4f, %.4f" % fitted.centroids[color]
+        else:
+            parameters = "hue %.4f - %.4f  saturation %.4f - %.4f" % \
+                (fitted.hue[color] + fitted.saturation[color])
+        print("%-8s  %s  %.5f  (%s, %.5f)  %s" %
+              (color, "  -   " if false_negatives is None else "%.4f" % false_negatives,
+               values["false_positive_rate"],
+               "-" if current["false_negative_rate"] is None else "%.4f" % current["false_negative_rate"],
+               current["false_positive_rate"], parameters))
+    if None in fitted_report:
+        print("background readings taken for a color: %.5f (signal.py: %.5f)" %
+              (fitted_report[None]["false_positive_rate"], current_report[None]["false_positive_rate"]))
+    print("wrote", THRESHOLD_FILE, "and", TABLE_FILE)
@@ -1,7 +1,11 @@
-from threading import RLock
+import weakref
+from itertools import count
+from threading import Condition
 
 from signal import RED, GREEN, BLUE, PURPLE
 from gui import tk_color, INTER_SECTOR
+from clock import clock
+from scheduler import scheduler
 
 # these names are actually descriptive on a topologically circular track,
 # but are just labels on a figure-8 track, or more complex topologies.
@@ -22,6 +26,28 @@ DEFAULT_SPEED = 4
 SECTOR_EXIT_SPEED = 2
 STATION_SPEED = 1
 
+# All track resources (sectors and cross-tracks) share one lock and one
+# condition variable. This allows a train to book several resources at
+# once, atomically, and to wait for any change in any of them.
+track_condition = Condition()
+
+# resources are always booked and released in the order of their rank
+_resource_rank = count()
+
+
+# reservation managers, whose waiting requests are checked whenever any
+# resource changes status
+_managers = weakref.WeakSet()
+
+
+def _resources_changed():
+    # wakes up the trains blocked on the track condition, and serves the
+    # requests waiting in the managers. Caller must hold the lock.
+    track_condition.notify_all()
+    for manager in list(_managers):
+        manager.serve()
+
+
 class Sector():
     def __init__(self, color, sector_time=DEFAULT_SECTOR_TIME,
                  max_speed=MAX_SPEED, max_speed_time=MAX_SPEED_TIME,
@@ -63,6 +89,7 @@ class Sector():
             in advance
         '''
         self.color = color
+        self.name = color
         self.sector_time = sector_time
         self.max_speed = max_speed
         self.max_speed_time = max_speed_time
@@ -74,8 +101,85 @@ class Sector():
         # sense of motion (A or B).
         self.next = {}
 
-        # This attribute tells what train owns the sector.
-        self.occupier = None
+        # This attribute tells what train owns the sector. Any change in it
+        # wakes up the trains that are waiting for the sector to be free.
+        self.condition = track_condition
+        self.rank = next(_resource_rank)
+        self._occupier = None
+
+    @property
+    def occupier(self):
+        return self._occupier
+
+    @occupier.setter
+    def occupier(self, name):
+        with self.condition:
+            self._occupier = name
+            _resources_changed()
+
+    def is_free(self, train):
+        '''
+        Tells if the sector is either free, or already owned by the train
+        '''
+        occupier = self._occupier
+        return occupier is None or occupier == train.name
+
+    def wait_until_free(self, train, timeout=None):
+        '''
+        Blocks until the sector is free for the train, without occupying it.
+
+        :param train: the train that wants to get in
+        :param timeout: maximum time to wait in sec; None waits forever
+        :return: True if sector is free, False if the wait timed out
+        '''
+        with self.condition:
+            return clock.wait_for(self.condition, lambda: self.is_free(train), timeout)
+
+    def acquire(self, train, timeout=None):
+        '''
+        Blocks until the sector is free for the train, and occupies it.
+
+        :param train: the train that wants to get in
+        :param timeout: maximum time to wait in sec; None waits forever
+        :return: True if sector was occupied, False if the wait timed out
+        '''
+        with self.condition:
+            if not clock.wait_for(self.condition, lambda: self.is_free(train), timeout):
+                return False
+            self.hold(train)
+            return True
+
+    def hold(self, train):
+        '''
+        Occupies the sector. Caller must hold the condition's lock, and
+        must have checked that the sector is free for the train.
+        '''
+        self._occupier = train.name
+
+    def free(self, train):
+        '''
+        Frees the sector, in case it is owned by the train. Caller must
+        hold the condition's lock.
+
+        :return: True if the sector was freed
+        '''
+        if self._occupier != train.name:
+            return False
+        self._occupier = None
+        _resources_changed()
+        return True
+
+    def release(self, train):
+        '''
+        Frees the sector, in case it is owned by the train
+        '''
+        with self.condition:
+            self.free(train)
+
+    def report(self, train, booked):
+        # sector status is reported by the event processor, as the train
+        # actually gets in and out of sectors.
+        pass
 
 
 class StructuredSector(Sector):
@@ -143,34 +247,97 @@ class XTrack():
     ]
     def __init__(self, name):
 
+        # any change in booking status wakes up the trains waiting
+        # for the cross-track to be free.
+        self.condition = track_condition
+        self.rank = next(_resource_rank)
+
         # keep identifications of trains that booked, and last stopped
-        self.booked = None
+        self._booked = None
         self.last_stopped = None
 
-        self.lock = RLock()
+    @property
+    def booked(self):
+        return self._booked
+
+    @booked.setter
+    def booked(self, name):
+        with self.condition:
+            self._booked = name
+            _resources_changed()
 
     def is_free(self, train):
-        self.lock.acquire()
-        result = not (self.booked is not None and self.booked != train.name)
-        self.lock.release()
-        return result
+        with self.condition:
+            return not (self._booked is not None and self._booked != train.name)
+
+    def wait_until_free(self, train, timeout=None):
+        '''
+        Blocks until the cross-track is free for the train, without booking it.
+
+        :param train: the train that wants to cross
+        :param timeout: maximum time to wait in sec; None waits forever
+        :return: True if cross-track is free, False if the wait timed out
+        '''
+        with self.condition:
+            return clock.wait_for(self.condition, lambda: self.is_free(train), timeout)
 
     def book(self, train):
-        self.lock.acquire()
+        # the GUI is updated after the lock is released, so GUI I/O never
+        # holds up the trains waiting on the track condition.
+        with self.condition:
 
-        if self.booked is None:
-            self.booked = train.name
-            train.report_xtrack(tk_color[RED])
+            if self._booked is None:
+                self.hold(train)
+                booked = True
 
-        elif self.booked == train.name:
-            self.booked = None
-            train.report_xtrack(tk_color[INTER_SECTOR])
+            elif self._booked == train.name:
+                self.free(train)
+                booked = False
 
-        else:
+            else:
+                booked = None
+
+        if booked is None:
             print("Error booking xtrack")
             #TODO maybe should generate an emergency stop?
+        else:
+            self.report(train, booked)
 
-        self.lock.release()
+    def hold(self, train):
+        '''
+        Books the cross-track. Caller must hold the condition's lock, and
+        must have checked that the cross-track is free for the train.
+        '''
+        self._booked = train.name
+
+    def free(self, train):
+        '''
+        Frees the cross-track, in case it is booked by the train. Caller
+        must hold the condition's lock.
+
+        :return: True if the cross-track was freed
+        '''
+        if self._booked != train.name:
+            return False
+        self._booked = None
+        _resources_changed()
+        return True
+
+    def release(self, train):
+        '''
+        Frees the cross-track, in case it is booked by the train
+        '''
+        with self.condition:
+            freed = self.free(train)
+        if freed:
+            self.report(train, False)
+
+    def report(self, train, booked):
+        '''
+        Reports a change in booking status to the train's GUI column. Must
+        be called without holding the condition's lock.
+        '''
+        train.report_xtrack(tk_color[RED] if booked else tk_color[INTER_SECTOR])
 
     def initialize(self, train):
         self.booked = None
@@ -206,6 +373,141 @@ class XTrack():
         return result
 
 
+class Reservation():
+    '''
+    Token that represents a set of track resources booked by a train.
+
+    :param train: the train that owns the resources
+    :param resources: list of resources, sorted by rank
+    '''
+    def __init__(self, train, resources):
+        self.train = train
+        self.resources = resources
+
+    def release(self, resources=None):
+        '''
+        Frees resources in the reservation that are still owned by the
+        train, and drops them from the reservation. Resources that were
+        already freed by other means, or taken over by another train since,
+        are left alone.
+
+        :param resources: the resources to free; None frees all of them
+        '''
+        with track_condition:
+            if resources is None:
+                resources = self.resources
+            released = [resource for resource in self.resources if resource in resources]
+            freed = [resource for resource in reversed(released) if resource.free(self.train)]
+            self.resources = [resource for resource in self.resources if resource not in released]
+
+        for resource in freed:
+            resource.report(self.train, False)
+
+
+class PendingReservation():
+    '''
+    Request for a set of track resources, waiting in the ReservationManager
+    until they are all free. It can be cancelled in the same way as a
+    ScheduledTask, as long as it wasn't served yet.
+
+    :param train: the train that wants the resources
+    :param resources: list of resources, sorted by rank
+    :param callback: function called with the Reservation, once booked
+    '''
+    def __init__(self, train, resources, callback):
+        self.train = train
+        self.resources = resources
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self, wait=False):
+        self.cancelled = True
+
+
+class ReservationManager():
+    '''
+    Books a set of track resources (sectors and cross-tracks) for a train, in
+    a single atomic step. Either all resources in the set are booked, or none.
+
+    Checking resources one by one, and then booking them one by one, leaves
+    gaps in between that another train can slip through. Here, the check and
+    the booking happen while holding the lock shared by all track resources.
+    Since a train never holds some resources while waiting for others, trains
+    cannot deadlock each other. Waiting trains block on the track condition
+    variable, and are woken up whenever any resource changes status.
+
+    Trains may also leave a request with the manager instead of blocking,
+    so no thread is held while they wait (see method reserve_later).
+    '''
+    def __init__(self):
+        self.waiting = []
+        _managers.add(self)
+
+    def reserve(self, train, resources, timeout=None):
+        '''
+        Waits until all resources are free for the train, and books them.
+
+        :param train: the train that wants the resources
+        :param resources: list of Sector and XTrack instances; None entries
+            are ignored
+        :param timeout: maximum time to wait in sec; None waits forever, and
+            zero just tries once without waiting
+        :return: a Reservation instance, or None if the wait timed out
+        '''
+        resources = sorted([r for r in resources if r is not None], key=lambda r: r.rank)
+
+        with track_condition:
+            if not clock.wait_for(track_condition, lambda: all([r.is_free(train) for r in resources]),
+                                  timeout):
+                return None
+            for resource in resources:
+                resource.hold(train)
+
+        for resource in resources:
+            resource.report(train, True)
+        return Reservation(train, resources)
+
+    def reserve_later(self, train, resources, callback):
+        '''
+        Books the resources as soon as they are all free for the train,
+        without blocking the caller. Then, callback(reservation) is submitted
+        to the scheduler. Requests are checked in order of arrival whenever
+        any resource changes status.
+
+        :param train: the train that wants the resources
+        :param resources: list of Sector and XTrack instances; None entries
+            are ignored
+        :param callback: function called with the Reservation instance
+        :return: a PendingReservation instance, used to cancel the request
+        '''
+        request = PendingReservation(train, sorted([r for r in resources if r is not None],
+                                                   key=lambda r: r.rank), callback)
+        with track_condition:
+            self.waiting.append(request)
+            self.serve()
+        return request
+
+    def serve(self):
+        '''
+        Books the resources of the waiting requests that can be served.
+        Caller must hold the track condition's lock.
+        '''
+        for request in list(self.waiting):
+            if request.cancelled:
+                self.waiting.remove(request)
+            elif all([r.is_free(request.train) for r in request.resources]):
+                self.waiting.remove(request)
+                for resource in request.resources:
+                    resource.hold(request.train)
+                scheduler.submit(self._grant, request, Reservation(request.train, request.resources))
+
+    def _grant(self, request, reservation):
+        # runs in the scheduler, without the lock held
+        for resource in reservation.resources:
+            resource.report(request.train, True)
+        request.callback(reservation)
+
+
 def clear_track():
     for sector in sectors.items():
         sector[1].occupier = None
@@ -213,6 +515,9 @@ def clear_track():
 
 #------------------ TRACK DEFINITION ----------------------------
 
+# trains book sectors and cross-tracks through this
+reservations = ReservationManager()
+
 # this track layout has one instance of cross-track
 xtrack = XTrack("Crossing 1")
 
@@ -225,6 +530,10 @@ sectors = {"RED_1": Sector(RED, max_speed=2, max_speed_time=1.),
            BLUE: StructuredSector(BLUE, max_speed_time=3.)
            }
 
+# sectors are known by their key in the dict above
+for name in sectors:
+    sectors[name].name = name
+
 station_sector_names = {DIRECTION_B: "RED_1",
                         DIRECTION_A: "RED_2"}
 
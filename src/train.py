@@ -1,21 +1,23 @@
 import sys
-import time, datetime
-from time import sleep
-from threading import Thread, Timer, RLock
-from colorsys import rgb_to_hsv
+from threading import RLock
 
-from pylgbst.hub import SmartHub
-from pylgbst.peripherals import Voltage, Current, LEDLight
-from pylgbst.peripherals import COLOR_BLUE, COLOR_ORANGE, COLOR_GREEN, COLOR_RED
+from hubs import SmartHub
+from hubs import Voltage, Current, LEDLight
+from hubs import COLOR_BLUE, COLOR_ORANGE, COLOR_GREEN, COLOR_RED
 
 import uuid_definitions
 from track import DIRECTION_A, TIME_BLIND
-from src.util import VariableTimerValue
-from track import sectors, station_sector_names, clear_track, xtrack, XTrack
+from util import VariableTimerValue
+from track import sectors, station_sector_names, clear_track, xtrack, XTrack, reservations
 from signal import INTER_SECTOR
-from event import EventProcessor, SensorEventFilter
-from signal import HUE, SATURATION, RGB_MINIMUM, V_MINIMUM
-from signal import RED, GREEN, BLUE, YELLOW, PURPLE
+from event import EventProcessor, EventQueue, SensorEventFilter, SensorConfirmation
+from classifier import load_color_table
+from scheduler import scheduler
+from clock import clock
+from hubqueue import HubCommandQueue, STOP, MOTOR, LED, HEADLIGHT
+from recorder import TelemetryRecorder
+from capture import SensorCapture
+from calibration import load_profile
 from gui import tkinter_output_queue, tk_color, ASTATION, SECTOR, SIGNAL, XTRACK
 
 sign = lambda x: x and (1, -1)[x<0]
@@ -34,17 +36,19 @@ class Train:
     battery remains unchanged.
 
     This class can report voltage and current at stdout and the GUI. It can also record these
-    measurements in a text file that is named as the train instance, with suffix ".txt". If a
-    file of the same name already exists, it will be appended with data from the current run.
+    measurements, together with sector and signal events, in binary files that are named as
+    the train instance. Files are written in the background, and rotated by size and age
+    (see module recorder.py).
 
-    A thread lock mechanism is used to prevent collisions in the thread-unsafe pylgbst
-    environment. A per-hub lock is provided by default, a global lock can be provided by the
-    caller when the need arises to synchronize among multiple instances of Train.
+    Commands to the hub go through a per-hub priority queue with its own writer thread,
+    which prevents collisions in the thread-unsafe pylgbst environment. Motor commands are
+    sent ahead of LED and headlight commands. A global lock can be provided by the caller
+    when the need arises to serialize writes among multiple instances of Train.
 
     :param name: train name, used in the report
-    :param gui_id: str used by the GUI to direct report to appropriate field
+    :param gui_id: str used by the GUI to identify the train's column of fields
     :param ncars: int number of cars; used to normalize speed settings
-    :param lock: global lock used for threading access
+    :param lock: optional global lock used to serialize hub writes among trains
     :param gui: instance of GUI, used to report status info
     :param led_color: primary LED color used in this train instance
     :param led_secondary_color: secondary LED color used to signal a stopped train
@@ -97,64 +101,68 @@ class Train:
         # as when dealing with sensors.
         self.event_processor = None
 
+        # reservations of the track resources booked by the train, and total
+        # time spent at stations waiting for them to be free
+        self.bookings = []
+        self.station_wait_time = 0.
+        self.station_wait_start = 0.
+
         # subclasses may implement automatic control modes (self-driving);
         # this flag can be used to toggle between that, and manual mode.
         self.auto = False
 
-        # lock to control threaded access to hub functions
-        self.lock = lock
-        if self.lock is None:
-            self.lock = RLock()
+        # queue of outbound commands to the hub
+        self.commands = HubCommandQueue(self.name, lock)
 
         # motor
         self.motor = self.hub.port_A
-        self.motor_handler = MotorHandler(self.motor, self.ncars, self.lock, linear)
+        self.motor_handler = MotorHandler(self.motor, self.ncars, self.commands, linear,
+                                          profile=load_profile(self.name))
         self.power_index = 0
 
         # led control. Set initial status to current power index
-        self.led_handler = LEDHandler(self, self.lock)
+        self.led_handler = LEDHandler(self, self.commands)
         self.led_handler.set_status_led(self.power_index)
 
-        # Thread control: threads are used to hold the train at a
+        # Thread control: scheduled tasks are used to hold the train at a
         # station for a timed interval, and to accelerate a train
         # gradually between two power settings.
-        # These threads must be checked and eventually cancelled whenever
+        # These tasks must be checked and eventually cancelled whenever
         # an up_speed, down_speed, or stop command is issued by either the
         # user or the controlling script.
         self.timer_station = None
         self.acceleration_thread = None
-        self.stop_acceleration_thread = False
 
         # GUI access
         self.gui = gui
         self.report_signal_timer = None
         if self.gui is not None:
+            self.gui.register(self.name, self.gui_id)
             xtrack.initialize(self)
 
+        self.recorder = None
         if report:
-            fp = None
             if record:
-                fp = open(self.name + ".txt", "a")
-            self._start_reporting(fp)
+                self.recorder = TelemetryRecorder(self.name, sector_names=list(sectors))
+            self._start_reporting()
 
-    def _start_reporting(self, fp):
+    def _start_reporting(self):
         def _print_values():
             # print("\r%s  voltage %5.2f  current %5.2f  speed %i  power %4.2f" %
             #       (self.name, self.voltage, self.current, self.power_index, self.motor_handler.power), end='')
             sys.stdout.flush()
-            if fp is not None:
-                ct = datetime.datetime.now()
-                fp.write("\r%s  %s   voltage: %5.2f  current: %5.3f  speed: %i  power %4.2f" %
-                         (self.name, ct, self.voltage, self.current, self.power_index, self.motor_handler.power))
-                fp.flush()
+            if self.recorder is not None:
+                # the recorder writes to disk in its own thread
+                self.recorder.record(self.voltage, self.current, self.power_index,
+                                     self.motor_handler.power, sector=self._sector_name())
             if self.gui is not None and self.gui_id != "0":
                 # use gui-specific code to encode variables. Actual data passing must
                 # be done via a queue, since tkinter is not thread-safe and can't be
                 # updated directly from here.
-                output_buffer = self.gui.encode_basic_variables(self.name, self.gui_id, self.voltage,
-                                                                self.current, self.power_index,
-                                                                self.motor_handler.power)
-                tkinter_output_queue.put(output_buffer)
+                message = self.gui.encode_basic_variables(self.name, self.gui_id, self.voltage,
+                                                          self.current, self.power_index,
+                                                          self.motor_handler.power)
+                tkinter_output_queue.put(message)
 
         def _report_voltage(value):
             self.voltage = value
@@ -167,6 +175,17 @@ class Train:
         self.hub.voltage.subscribe(_report_voltage, mode=Voltage.VOLTAGE_L, granularity=5)
         self.hub.current.subscribe(_report_current, mode=Current.CURRENT_L, granularity=7)
 
+    def _sector_name(self):
+        # SimpleTrain instances don't keep track of sectors
+        sector = getattr(self, "sector", None)
+        return sector.name if sector is not None else None
+
+    def record_event(self, event):
+        # add a color event to the recorded telemetry
+        if self.recorder is not None:
+            self.recorder.record(self.voltage, self.current, self.power_index,
+                                 self.motor_handler.power, sector=self._sector_name(), event=event)
+
     def report_astation(self):
         # update GUI with @station value
         if self.gui is not None:
@@ -175,29 +194,28 @@ class Train:
 
     def report_sector(self, tkcolor, subtext=""):
         if self.gui is not None:
-            output_buffer = self.gui.encode_str_variable(SECTOR, self.name, self.gui_id,
-                                                         tkcolor, subtext=subtext)
-            tkinter_output_queue.put(output_buffer)
+            message = self.gui.encode_str_variable(SECTOR, self.name, self.gui_id,
+                                                   tkcolor, subtext=subtext)
+            tkinter_output_queue.put(message)
 
     def report_xtrack(self, tkcolor):
         if self.gui is not None:
-            output_buffer = self.gui.encode_str_variable(XTRACK, self.name, self.gui_id, tkcolor)
-            tkinter_output_queue.put(output_buffer)
+            message = self.gui.encode_str_variable(XTRACK, self.name, self.gui_id, tkcolor)
+            tkinter_output_queue.put(message)
 
     def report_signal(self, tkcolor):
         if self.gui is not None:
-            output_buffer = self.gui.encode_str_variable(SIGNAL, self.name, self.gui_id, tkcolor)
-            tkinter_output_queue.put(output_buffer)
+            message = self.gui.encode_str_variable(SIGNAL, self.name, self.gui_id, tkcolor)
+            tkinter_output_queue.put(message)
 
             # stop reporting after a while
             if self.report_signal_timer is not None:
                 self.report_signal_timer.cancel()
-            self.report_signal_timer = Timer(0.5, self._shut_off_signal_color)
-            self.report_signal_timer.start()
+            self.report_signal_timer = scheduler.call_later(0.5, self._shut_off_signal_color)
 
     def _shut_off_signal_color(self):
-        output_buffer = self.gui.encode_str_variable(SIGNAL, self.name, self.gui_id, tk_color[INTER_SECTOR])
-        tkinter_output_queue.put(output_buffer)
+        message = self.gui.encode_str_variable(SIGNAL, self.name, self.gui_id, tk_color[INTER_SECTOR])
+        tkinter_output_queue.put(message)
 
     # up_speed and down_speed are used only by handset actions. They should
     # kill both the station wait and the accelerate threads; that way, the
@@ -238,8 +256,10 @@ class Train:
             self.timer_station = None
 
     def cancel_acceleration_thread(self):
+        # waits for a ramp step in progress, so no stale power
+        # setting can reach the motor after this returns.
         if self.acceleration_thread is not None:
-            self.stop_acceleration_thread = True
+            self.acceleration_thread.cancel(wait=True)
             self.acceleration_thread = None
 
     def cancel_speedup_timer(self):
@@ -252,32 +272,29 @@ class Train:
         self.cancel_acceleration_thread()
         self.cancel_station_timer()
 
-    # The `accelerate` method has to be run in a thread, and stopped whenever a
-    # set_power call takes place coming, typically, from the up_speed, dow_speed,
-    # or stop methods initiated by either the user remote, or the controlling script
-    # itself, as for instance in response from a sensor signal.
+    # The `accelerate` method runs as a periodic task in the scheduler, one step
+    # at each period. It is stopped whenever a set_power call takes place coming,
+    # typically, from the up_speed, dow_speed, or stop methods initiated by either
+    # the user remote, or the controlling script itself, as for instance in response
+    # from a sensor signal.
     def accelerate(self, power_index_values, power_index_signal, sleep_time=0.3):
         # if already running, stop it before starting a new acceleration ramp
         self.cancel_acceleration_thread()
 
-        self.acceleration_thread = Thread(target=self._accelerate,
-                                          args=(power_index_values,
-                                                power_index_signal,
-                                                sleep_time))
-        self.stop_acceleration_thread = False
-        self.acceleration_thread.start()
-
-    def _accelerate(self, power_index_values, power_index_signal, sleep_time):
-        for k in power_index_values:
-            if self.stop_acceleration_thread:
-                break
-            self.set_power(k * power_index_signal)
-            if self.secondary_train is not None:
-                # secondary train runs in opposite direction as this train
-                self.secondary_train.set_power(- k * power_index_signal)
-            sleep(sleep_time)
-        self.stop_acceleration_thread = False
-        self.acceleration_thread = None
+        self.acceleration_thread = scheduler.call_periodic(sleep_time, self._accelerate,
+                                                           iter(power_index_values),
+                                                           power_index_signal)
+
+    def _accelerate(self, power_index_values, power_index_signal):
+        # one step in the ramp; returns False when the ramp is over
+        k = next(power_index_values, None)
+        if k is None:
+            return False
+
+        self.set_power(k * power_index_signal)
+        if self.secondary_train is not None:
+            # secondary train runs in opposite direction as this train
+            self.secondary_train.set_power(- k * power_index_signal)
 
 
 class MotorHandler:
@@ -292,6 +309,10 @@ class MotorHandler:
 
     A correction factor related to the battery voltage drop that happens during
     use is also handled by this class.
+
+    When a calibration profile fitted from recorded runs is available for the
+    train (see module calibration.py), it replaces both the duty cycle table
+    and the voltage and number of cars corrections.
     '''
     # NOMINAL_VOLTAGE = 8.3  # Volts (6 AAA Ni-MH batteries in hub - NEW)
     NOMINAL_VOLTAGE = 8.0  # Volts (6 AAA Ni-MH batteries in hub - after tens of recharges)
@@ -330,15 +351,27 @@ class MotorHandler:
 
     # experimental correction for number of cars. The correction should
     # be unity for default number of cars (2), and decrease voltage with one
-    # or zero cars.
+    # or zero cars. Longer trains extrapolate from the last step.
     ncars_correction = [0.85, 0.92, 1.]
 
-    def __init__(self, motor, ncars, lock, linear=False):
+    def __init__(self, motor, ncars, commands, linear=False, profile=None):
         self.motor = motor
         self.ncars = ncars
         self.power = 0.
-        self.lock = lock
+        self.commands = commands
         self.linear = linear
+        self.profile = profile
+
+        # coalescing of power writes. self.power is the latest setpoint;
+        # at most one motor write is kept waiting in the hub queue, and it
+        # sends whatever the setpoint is at the time it actually goes out.
+        # Stops are never coalesced. The lock is reentrant because commands
+        # may be sent inline, by put.
+        self.coalesce_lock = RLock()
+        self.pending_write = None
+        self.sent_power = 0.
+        self.writes_requested = 0
+        self.writes_sent = 0
 
         # linear voltage correction
         self.voltage_slope = (self.MAXIMUM_FACTOR - 1.0) / (self.MINIMUM_VOLTAGE - self.NOMINAL_VOLTAGE)
@@ -346,12 +379,50 @@ class MotorHandler:
 
     def set_motor_power(self, index, voltage):
         power = self._compute_power(index, voltage)
-        self.lock.acquire()
-        self.motor.power(param=power)
-        self.lock.release()
-        self.power = power
+
+        with self.coalesce_lock:
+            self.writes_requested += 1
+
+            if index == 0:
+                # a stop jumps ahead of everything else waiting in the hub
+                # queue, which cancels the motor write still waiting there.
+                # It sends its own value: a setpoint that comes in while the
+                # stop waits is written after it, never in its place.
+                self.power = power
+                self.pending_write = None
+                self.commands.put(STOP, self._write_power, power)
+                return
+
+            pending = self.pending_write
+            if pending is not None and not pending.cancelled:
+                # a motor write is still waiting in the queue; it will pick
+                # up the new setpoint.
+                self.power = power
+                return
+            if power == self.power:
+                # the latest setpoint was sent already, or is going out right now
+                return
+
+            self.power = power
+            command = self.commands.put(MOTOR, self._write_power)
+            self.pending_write = None if command.done.is_set() else command
+
+    def _write_power(self, power=None):
+        # runs in the hub writer thread. Motor writes send the latest
+        # setpoint, stops the value they were queued with.
+        with self.coalesce_lock:
+            if power is None:
+                self.pending_write = None
+                power = self.power
+        if power != self.sent_power:
+            self.motor.power(param=power)
+            self.sent_power = power
+            self.writes_sent += 1
 
     def _compute_power(self, index, voltage):
+        if self.profile is not None:
+            return self.profile.duty(index, voltage)
+
         duty = self.duty[index]
         if self.linear:
             duty =  self.duty_linear[index]
@@ -361,9 +432,15 @@ class MotorHandler:
     # compute power correction factor based on voltage drop from nominal value
     def _voltage_correcion(self, voltage):
         voltage_corrected = self.voltage_slope * voltage + self.voltage_zero
-        voltage_corrected *= self.ncars_correction[self.ncars]
+        voltage_corrected *= self._ncars_factor()
         return (voltage_corrected)
 
+    def _ncars_factor(self):
+        table = self.ncars_correction
+        if self.ncars < len(table):
+            return table[self.ncars]
+        return table[-1] + (self.ncars - len(table) + 1) * (table[-1] - table[-2])
+
     @property
     def get_power(self):
         return self.power
@@ -382,9 +459,9 @@ class SimpleTrain(Train):
     HeadlightHamdler.
 
     :param name: train name, used in the report
-    :param gui_id: str used by the GUI to direct report to appropriate field
+    :param gui_id: str used by the GUI to identify the train's column of fields
     :param ncars: int number of cars; used to normalize speed settings
-    :param lock: lock used for threading access
+    :param lock: optional global lock used to serialize hub writes among trains
     :param gui: instance of GUI, used to report status info
     :param led_color: primary LED color used in this train instance
     :param led_secondary_color: secondary LED color used to signal a stopped train
@@ -410,7 +487,7 @@ class SimpleTrain(Train):
         self.headlight_handler = None
 
         if isinstance(self.hub.port_B, LEDLight):
-            self.headlight_handler = HeadlightHandler(self, self.lock)
+            self.headlight_handler = HeadlightHandler(self, self.commands)
 
     # in the methods that increase or decrease motor power, one has to
     # always call the headlight brightness control, since the power can
@@ -450,9 +527,9 @@ class SmartTrain(Train):
     are registered with it.
 
     :param name: train name, used in the report
-    :param gui_id: str used by the GUI to direct report to appropriate field
+    :param gui_id: str used by the GUI to identify the train's column of fields
     :param ncars: int number of cars; used to normalize speed settings
-    :param lock: lock used for threading access
+    :param lock: optional global lock used to serialize hub writes among trains
     :param gui: instance of GUI, used to report status info
     :param led_color: primary LED color used in this train instance
     :param led_secondary_color: secondary LED color used to signal a stopped train
@@ -462,10 +539,22 @@ class SmartTrain(Train):
     :param init_short: if True, initialize time@station at short range
     :param address: UUID of the train's internal hub
     :param direction: direction of movement on the track
+    :param confirm: if True, sensor colors must be confirmed by several samples
+    :param capture: if True, capture raw sensor readings, for later replay
     '''
+    # maps vision sensor readings to signal colors. It is shared by
+    # all instances, and built when the first instance is created, from
+    # the classifier in the threshold table file if there is one. Any
+    # ColorLookupTable set here beforehand is used instead.
+    color_table = None
+
     def __init__(self, name, gui_id="0", ncars=2, lock=None, report=False, record=False, linear=False,
                  init_short=True, gui=None, led_color=COLOR_BLUE, led_secondary_color=COLOR_ORANGE,
-                 direction=DIRECTION_A, address=uuid_definitions.HUB_TEST): # test hub
+                 direction=DIRECTION_A, address=uuid_definitions.HUB_TEST, # test hub
+                 confirm=False, capture=False):
+
+        if SmartTrain.color_table is None:
+            SmartTrain.color_table = load_color_table()
 
         super(SmartTrain, self).__init__(name, gui_id, ncars=ncars, lock=lock,
                                          report=report, record=record, linear=linear,
@@ -474,11 +563,24 @@ class SmartTrain(Train):
                                           direction=direction,
                                           address=address)
 
+        # optional stage that rejects isolated false positive samples. It must
+        # exist before the vision sensor callback is subscribed.
+        self.sensor_confirmation = None
+        if confirm:
+            self.sensor_confirmation = SensorConfirmation(self)
+
+        # optional capture of the raw sensor readings, for later replay
+        self.sensor_capture = None
+        if capture:
+            self.sensor_capture = SensorCapture(self.name)
+
         self.hub.vision_sensor.subscribe(self._vision_sensor_callback, granularity=4, mode=6)
 
         # events coming from the vision sensor need to be pre-processed in order
-        # to filter out multiple detections, before being handled.
+        # to filter out multiple detections, before being handled. Handling
+        # takes place in a worker thread, away from the BLE notification thread.
         self.sensor_event_filter = SensorEventFilter(self)
+        self.event_queue = EventQueue(self)
         self.event_processor = EventProcessor(self)
         # self.event_processor = DummyEventProcessor(self) # for debugging only
 
@@ -506,11 +608,49 @@ class SmartTrain(Train):
         # event processor must be initialized to properly handle station sectors
         self.event_processor.last_station_event = None
 
+        # resources booked along the way are normally freed one by one as the
+        # train moves along. Make sure none is left behind, in case a signal
+        # was missed. The station sector stays booked, the train is in it.
+        self.release_track(keep=self.previous_sector)
+
         # train is initialized as if it were in the inter-sector zone right after
         # the station. To prevent confusion, we report sector as based instead on
         # the previous sector color.
         self.report_sector(tk_color[self.previous_sector.color])
 
+    def book_track(self, resources, timeout=0):
+        '''
+        Books track resources for the train, checking and booking them in a
+        single atomic step. The reservation is kept until the resources are
+        freed with method release_track.
+
+        :param resources: list of Sector and XTrack instances
+        :param timeout: maximum time to wait in sec; None waits forever, and
+            zero just tries once without waiting
+        :return: True if booked
+        '''
+        reservation = reservations.reserve(self, resources, timeout=timeout)
+        if reservation is None:
+            return False
+        self.bookings.append(reservation)
+        return True
+
+    def release_track(self, resource=None, keep=None):
+        '''
+        Frees track resources booked by the train, through the reservations
+        that hold them.
+
+        :param resource: the resource to free; None frees all of them
+        :param keep: resource left booked when freeing all of them
+        '''
+        for reservation in list(self.bookings):
+            if resource is not None:
+                reservation.release([resource])
+            else:
+                reservation.release([r for r in reservation.resources if r is not keep])
+            if not reservation.resources:
+                self.bookings.remove(reservation)
+
     def timed_stop_at_station(self):
         # this only happens in auto mode
         if not self.auto:
@@ -520,14 +660,11 @@ class SmartTrain(Train):
 
         # start a timed wait interval at a station
         time_station = self.variable_timer.get_time_station()
-        self.timer_station = Timer(time_station, self.restart_movement)
-        self.timer_station.start()
+        self.timer_station = scheduler.call_later(time_station, self.restart_movement)
 
         self.astation = time_station
         self.report_astation()
 
-        #TODO thread to update astation at every second, and propagate to gui
-
     def restart_movement(self):
         self.astation = 0
         self.report_astation()
@@ -540,24 +677,22 @@ class SmartTrain(Train):
         self.led_handler.set_solid(COLOR_RED)
         previous_sector = self.previous_sector
         next_sector = previous_sector.next[self.direction]
-        while next_sector.occupier is not None and \
-              next_sector.occupier != self.name:
-            time.sleep(0.5)
 
         # when restaring movement, check for the existence of a xtrack object
-        # ahead. In case there is one, check its status, and either book it
-        # and proceed moving, or wait until the xtrack is freed.
+        # ahead. In case there is one, it must be booked together with the
+        # next sector. Both are booked in one go, as soon as both are free,
+        # so no other train can grab one of them in between. The wait takes
+        # no thread: departure resumes in _depart once they are booked, and
+        # the request can be cancelled as the station timer.
         xt1 = previous_sector.look_ahead
-        if xt1 is not None and isinstance(xt1, XTrack):
-            # occupied; wait for opening
-            while not xt1.is_free(self):
-                time.sleep(0.5)
-
-            # book it when starting to leave
-            xtrack.book(self)
+        if not isinstance(xt1, XTrack):
+            xt1 = None
+        self.station_wait_start = clock.now()
+        self.timer_station = reservations.reserve_later(self, [next_sector, xt1], self._depart)
 
-        # immediately occupy next sector
-        next_sector.occupier = self.name
+    def _depart(self, reservation):
+        self.bookings.append(reservation)
+        self.station_wait_time += clock.now() - self.station_wait_start
 
         # train is departing from station, so gui displays inter-sector color
         self.report_sector(tk_color[INTER_SECTOR])
@@ -568,8 +703,9 @@ class SmartTrain(Train):
 
         # must be smaller than MINIMUM_TIME_STATION_SHORT, otherwise
         # the green signal may not go away.
-        sleep(1.0)
+        scheduler.call_later(1.0, self._leave_station)
 
+    def _leave_station(self):
         # need to find out if this train is running forward or reverse
         # Cannot use self.power_index since it is set to zero when train is
         # stopped. We use the existence of a secondary train to figure
@@ -585,39 +721,28 @@ class SmartTrain(Train):
         # stopped rigth over a signal tile on the track. In that situation,
         # as soon as the movement starts, a false signal can be issued.
         self.signal_blind = True
-        self.signal_blind_timer = Timer(TIME_BLIND, self.activate_signals)
-        self.signal_blind_timer.start()
+        self.signal_blind_timer = scheduler.call_later(TIME_BLIND, self.activate_signals)
 
         # accelerate just to move train out of station area into inter-sector
         # zone. Train will regain full speed when crossing sector signal.
         self.accelerate(list(range(1, 4)), power_index_signal, sleep_time=0.2)
 
     def _vision_sensor_callback(self, *args, **kwargs):
-        # use HSV as criterion for mapping colors
-        r = args[0]
-        g = args[1]
-        b = args[2]
-        h, s, v = rgb_to_hsv(r, g, b)
+        # this runs in the BLE notification thread, so it must be fast.
+        if self.sensor_capture is not None:
+            self.sensor_capture.record(args[0], args[1], args[2])
 
-        if h >= 1. or h <= 0.:
-            return
-
-        # RED hue flips back to zero when crossing 1. We add 1. here
-        # so the comparison logic downstream works.
-        if h > 0. and h <= 0.05:
-            h += 1.
-
-        # ignore events with low signal-to-noise ratio
-        if min(r, g, b) >= RGB_MINIMUM and v >= V_MINIMUM:
-
-            # find matching color.
-            for color in [PURPLE, BLUE, GREEN, RED, YELLOW, ]:
+        # The lookup table returns the same color the classifier it was
+        # compiled from (module classifier.py) would return. Readings the
+        # classifier rejects for low confidence come out as None; the
+        # confidence itself is not carried down the pipeline.
+        color = self.color_table.lookup(args[0], args[1], args[2])
 
-                if (h >= HUE[color][0] and h <= HUE[color][1]) and \
-                   (s >= SATURATION[color][0] and s <= SATURATION[color][1]):
+        if self.sensor_confirmation is not None:
+            color = self.sensor_confirmation.confirm(color)
 
-                    self.sensor_event_filter.filter_event(color)
-                    return
+        if color is not None:
+            self.sensor_event_filter.filter_event(color)
 
     # this method will set a flag that tells that it's safe now to get an
     # end-of-sector signal. The flag is managed by a timer and is used
@@ -686,16 +811,10 @@ class CompoundTrain():
         self.train_rear.stop(from_handset=from_handset)
 
     def set_power(self, power_index, force_led_blink=False):
+        # Train.set_power already takes care of both the motor and the LED
         self.train_front.set_power(power_index, force_led_blink=force_led_blink)
         self.train_rear.set_power(-power_index, force_led_blink=force_led_blink)
 
-        self.train_front.motor_handler.set_motor_power(power_index, self.train_front.voltage)
-        self.train_rear.motor_handler.set_motor_power(-power_index, self.train_rear.voltage)
-
-        self.train_front.led_handler.set_status_led(power_index, force_blink=force_led_blink)
-        self.train_rear.led_handler.set_status_led(-power_index, force_blink=force_led_blink)
-
-
 
 class LEDHandler:
     '''
@@ -704,8 +823,8 @@ class LEDHandler:
 
     A Handler class is used to send/receive messages to/from a train hub, minimizing
     the number of actual Bluetooth messages. This helps in shielding the BLE environment
-    from a flurry of unecessary messages. It also uses a lock to set hub parameters,
-    preventing collisions in pylgbst.
+    from a flurry of unecessary messages. Hub parameters are set via the hub command
+    queue, with lower priority than motor commands.
     '''
     STATIC = 0
     BLINKING = 1
@@ -713,22 +832,21 @@ class LEDHandler:
     # blinking should be fast to minimize latency in handset response time
     BLINK_TIME = 0.3 # seconds
 
-    def __init__(self, train, lock):
+    def __init__(self, train, commands):
         self.train = train
-        self.lock = lock
+        self.commands = commands
         self.led = train.hub.led
         self.led_color = train.led_color
         self.led_secondary_color = train.led_secondary_color
         self.previous_power_index = 0
 
-        # we require a quite complex thread control mechanism to implement
-        # a blinking LED that starts with a delay when the motor stops. The
+        # the blinking LED starts with a delay when the motor stops. The
         # delay is necessary to minimize latency when operating train with
-        # the handset buttons.
+        # the handset buttons. Both the delay and the blinking itself are
+        # tasks in the scheduler.
         self.led_thread = None
         self.delay_timer = None
-        self.led_thread_stop_switch = False
-        self.led_thread_is_running = False
+        self.led_blink_index = 0
 
         self.set_status_led(1)
 
@@ -736,9 +854,7 @@ class LEDHandler:
         self._cancel_led_thread()
         self._cancel_delay_timer()
 
-        self.lock.acquire()
-        self.led.set_color(color)
-        self.lock.release()
+        self.commands.put(LED, self.led.set_color, color)
 
     def set_status_led(self, new_power_index, force_blink=False):
         # here is the logic that prevents redundant BLE messages to be sent to the train hub
@@ -749,42 +865,30 @@ class LEDHandler:
             self._cancel_delay_timer()
 
             if self._led_desired_mode(new_power_index) == self.STATIC:
-                self.lock.acquire()
-                self.led.set_color(self.led_color)
-                self.lock.release()
+                self.commands.put(LED, self.led.set_color, self.led_color)
             else: # BLINKING
-                self.delay_timer = Timer(2., self._start_led_thread, [])
-                self.delay_timer.start()
+                self.delay_timer = scheduler.call_later(2., self._start_led_thread)
 
             self.previous_power_index = new_power_index
 
     def _start_led_thread(self):
-        self.led_thread = Thread(target=self._swap_led_color, args=(self.led_color, self.led_secondary_color))
-        self.led_thread_stop_switch = False
-        self.led_thread_is_running = True
-        self.led_thread.start()
+        self.led_blink_index = 0
+        self.led_thread = scheduler.call_periodic(self.BLINK_TIME, self._swap_led_color,
+                                                  (self.led_color, self.led_secondary_color))
 
     def _led_desired_mode(self, power_index):
         return self.BLINKING if power_index == 0 else self.STATIC
 
-    def _swap_led_color(self, c1, c2):
-        while not self.led_thread_stop_switch:
-            self.lock.acquire()
-            self.led.set_color(c1)
-            self.lock.release()
-            sleep(self.BLINK_TIME)
-            self.lock.acquire()
-            self.led.set_color(c2)
-            self.lock.release()
-            sleep(self.BLINK_TIME)
-
-        self.led_thread_is_running = False
+    def _swap_led_color(self, colors):
+        # one blink step: alternates in between the two colors at each call
+        self.commands.put(LED, self.led.set_color, colors[self.led_blink_index])
+        self.led_blink_index = 1 - self.led_blink_index
 
     def _cancel_led_thread(self):
+        # a blink step in progress must complete before the LED
+        # can be set by the caller.
         if self.led_thread is not None:
-            self.led_thread_stop_switch = True
-            while self.led_thread_is_running:
-                sleep(self.BLINK_TIME / 10)
+            self.led_thread.cancel(wait=True)
             self.led_thread = None
 
     def _cancel_delay_timer(self):
@@ -801,15 +905,13 @@ class HeadlightHandler:
 
     A Handler class is used to send/receive messages to/from a train hub, minimizing
     the number of actual Bluetooth messages. This helps in shielding the BLE environment
-    from a flurry of unecessary messages. It also uses a lock to set hub parameters,
-    preventing collisions in pylgbst.
+    from a flurry of unecessary messages. Hub parameters are set via the hub command
+    queue, with lower priority than motor commands.
     '''
-    def __init__(self, train, lock):
-        self.lock = lock
+    def __init__(self, train, commands):
+        self.commands = commands
         self.headlight = train.hub.port_B
-        self.lock.acquire()
-        self.headlight_brightness = self.headlight.brightness
-        self.lock.release()
+        self.headlight_brightness = self.commands.call(HEADLIGHT, lambda: self.headlight.brightness)
 
     # thread control
     headlight_timer = None
@@ -824,24 +926,19 @@ class HeadlightHandler:
                 brightness = 100
                 if brightness != self.headlight_brightness:
                     self._cancel_headlight_thread()
-                    self._set_brightness(brightness, self.lock)
+                    self._set_brightness(brightness)
                     self.headlight_brightness = brightness
             else:
                 # dim headlight after delay
                 if brightness != self.headlight_brightness:
                     self._cancel_headlight_thread()
-                    self.headlight_timer = Timer(3, self._set_brightness, [brightness, self.lock])
-                    self.headlight_timer.start()
+                    self.headlight_timer = scheduler.call_later(3, self._set_brightness, brightness)
                     self.headlight_brightness = brightness
 
-    # wrapper to allow locking
-    def _set_brightness(self, brightness, lock):
-        lock.acquire()
-        self.headlight.set_brightness(brightness)
-        lock.release()
+    def _set_brightness(self, brightness):
+        self.commands.put(HEADLIGHT, self.headlight.set_brightness, brightness)
 
     def _cancel_headlight_thread(self):
         if self.headlight_timer is not None:
-            self.headlight_timer.cancel()
+            self.headlight_timer.cancel(wait=True)
             self.headlight_timer = None
-            sleep(0.1)
@@ -19,15 +19,20 @@ class VariableTimerValue:
     and then zero. The zero value must be handled by
     the caller; it's initial purpose is to signal the situation in which the train doesn't
     stop at all.
+
+    Values come from the module-level random generator, unless a generator
+    of their own is provided (e.g. a seeded random.Random instance, to get
+    reproducible sequences in simulations and tests).
     """
-    def __init__(self, short=True):
+    def __init__(self, short=True, generator=None):
         self.short = short
+        self.generator = generator if generator is not None else random
 
     def get_time_station(self):
         if self.short:
-            time_station = random.uniform(MINIMUM_TIME_STATION_SHORT, MAXIMUM_TIME_STATION_SHORT)
+            time_station = self.generator.uniform(MINIMUM_TIME_STATION_SHORT, MAXIMUM_TIME_STATION_SHORT)
         else:
-            time_station = random.uniform(MINIMUM_TIME_STATION_LONG, MAXIMUM_TIME_STATION_LONG)
+            time_station = self.generator.uniform(MINIMUM_TIME_STATION_LONG, MAXIMUM_TIME_STATION_LONG)
 
         self.short = not self.short
 
@@ -52,5 +57,12 @@ class TestTimer(unittest.TestCase):
         self.assertLessEqual(t2, MAXIMUM_TIME_STATION_LONG)
         self.assertGreaterEqual(t2, MINIMUM_TIME_STATION_LONG)
 
+    def test_seeded_generator(self):
+        timer_1 = VariableTimerValue(generator=random.Random(42))
+        timer_2 = VariableTimerValue(generator=random.Random(42))
+
+        for k in range(4):
+            self.assertEqual(timer_1.get_time_station(), timer_2.get_time_station())
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
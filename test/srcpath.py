@@ -0,0 +1,36 @@
+''' Helper that makes the modules in src importable from the unit tests.
+'''
+import os
+import sys
+import importlib
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SRC = os.path.join(ROOT, "src")
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def import_from_src(*names):
+    '''
+    Imports modules from src, and returns them in a list.
+
+    Modules in src import each other by bare name. Module src/signal.py
+    shadows the standard library module with the same name, thus the latter
+    is taken out of the module cache while importing, and put back after.
+    '''
+    if SRC not in sys.path:
+        sys.path.insert(0, SRC)
+    # some modules import from the src package
+    if ROOT not in sys.path:
+        sys.path.append(ROOT)
+
+    stdlib_signal = sys.modules.get("signal")
+    if stdlib_signal is not None and not hasattr(stdlib_signal, "INTER_SECTOR"):
+        del sys.modules["signal"]
+    else:
+        stdlib_signal = None
+
+    try:
+        return [importlib.import_module(name) for name in names]
+    finally:
+        if stdlib_signal is not None:
+            sys.modules["signal"] = stdlib_signal
@@ -0,0 +1,151 @@
+''' Unit test that verifies the motor calibration: speed measurement from
+    recorded runs, model fit, profiles, and their use by MotorHandler.
+'''
+import os
+import tempfile
+import unittest
+
+from srcpath import import_from_src
+
+layoutsim, calibration, recorder, train, track, simhub, clock, scheduler = \
+    import_from_src("layoutsim", "calibration", "recorder", "train", "track", "simhub", "clock", "scheduler")
+
+# motor model of the simulated hubs
+GAIN = simhub.MAX_SPEED_CMS / ((1. - simhub.DEADBAND) * simhub.NOMINAL_VOLTAGE)
+DEADBAND = simhub.DEADBAND
+
+BLUE = recorder.BLUE
+GREEN = recorder.GREEN
+
+
+def _synthetic_run(stretches):
+    '''
+    Builds a recorded run where a train with the motor model above crosses
+    the given stretches, each one a tuple (power index, duty, voltage). All
+    stretches go from the BLUE sector entry tile to the sub-sector tile.
+    '''
+    run = {field: [] for field in recorder.FIELDS}
+    run["sectors"] = ["BLUE", "GREEN"]
+    run["events"] = recorder.EVENT_NAMES
+    length = calibration.SEGMENT_LENGTHS[track.DIRECTION_B][(None, BLUE, BLUE)]
+    blue = recorder.EVENT_NAMES.index(BLUE) + 1
+
+    def add(t, power_index, duty, voltage, sector, event):
+        for field, value in zip(recorder.FIELDS, [t, voltage, 0.3, duty, power_index, sector, event]):
+            run[field].append(value)
+
+    t = 0.
+    for power_index, duty, voltage in stretches:
+        speed = GAIN * voltage * (duty - DEADBAND)
+        add(t, power_index, duty, voltage, 0, blue)
+        add(t + 0.5, power_index, duty, voltage, 1, 0)
+        t += length / speed
+        add(t, power_index, duty, voltage, 1, blue)
+        # the train stops in between stretches
+        add(t + 1., 0, 0., voltage, 0, 0)
+        t += 5.
+    return run
+
+
+class TestCalibration(unittest.TestCase):
+
+    def _profile(self):
+        run = _synthetic_run([(2, 0.42, 8.0), (4, 0.52, 7.6), (6, 0.6, 7.2), (3, 0.48, 6.9)])
+        measurements = calibration.measure_segments(run, calibration.SEGMENT_LENGTHS[track.DIRECTION_B])
+        return calibration.fit_profile("Blue", measurements, train.MotorHandler.duty)
+
+    def test_measure_segments(self):
+        run = _synthetic_run([(2, 0.42, 8.0), (4, 0.52, 7.5)])
+        measurements = calibration.measure_segments(run, calibration.SEGMENT_LENGTHS[track.DIRECTION_B])
+
+        # stretches in between stops are skipped
+        self.assertEqual(len(measurements), 2)
+        self.assertEqual(measurements[1].power_index, 4)
+        self.assertAlmostEqual(measurements[1].speed, GAIN * 7.5 * (0.52 - DEADBAND))
+
+    def test_fit(self):
+        profile = self._profile()
+
+        self.assertAlmostEqual(profile.gain, GAIN)
+        self.assertAlmostEqual(profile.deadband, DEADBAND)
+        self.assertAlmostEqual(profile.rms_error, 0.)
+        self.assertEqual(profile.samples, 4)
+
+        # at nominal voltage, speeds are those of the hand-tuned duty cycle table
+        self.assertAlmostEqual(profile.duty(3, calibration.NOMINAL_VOLTAGE), train.MotorHandler.duty[3])
+        self.assertAlmostEqual(profile.duty(-3, calibration.NOMINAL_VOLTAGE), train.MotorHandler.duty[-3])
+
+    # speed holds as the battery drains
+    def test_constant_speed(self):
+        profile = self._profile()
+
+        duties = [profile.duty(4, voltage) for voltage in [8.0, 7.5, 7.0, 6.5]]
+        for duty, voltage in zip(duties, [8.0, 7.5, 7.0, 6.5]):
+            self.assertAlmostEqual(profile.speed(duty, voltage), profile.target_speeds[4])
+        self.assertListEqual(duties, sorted(duties))
+
+    def test_save_and_load(self):
+        profile = self._profile()
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertIsNone(calibration.load_profile("Blue", directory))
+            profile.save(directory)
+            loaded = calibration.load_profile("Blue", directory)
+
+        self.assertEqual(loaded.gain, profile.gain)
+        self.assertEqual(loaded.target_speeds, profile.target_speeds)
+        self.assertEqual(loaded.duty(5, 7.3), profile.duty(5, 7.3))
+
+
+# calibration from runs recorded on the simulated layout, whose stretch
+# lengths are the ones in SEGMENT_LENGTHS
+class TestSimulatedCalibration(unittest.TestCase):
+
+    def setUp(self):
+        # recorded files go to the current directory
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+        clock.clock.use(clock.RealClock())
+        scheduler.scheduler.select(scheduler.THREADED)
+
+    def test_fit(self):
+        simulation = layoutsim.LayoutSimulation(ntrains=2, seed=1, record=True)
+        simulation.run(0.3)
+        for simulated_train in simulation.trains:
+            simulated_train.recorder.close()
+
+        for simulated_train in simulation.trains:
+            run = recorder.read_telemetry_session(simulated_train.name)
+            measurements = calibration.measure_segments(
+                run, calibration.SEGMENT_LENGTHS[simulated_train.direction])
+            profile = calibration.fit_profile(simulated_train.name, measurements, train.MotorHandler.duty)
+
+            self.assertGreater(profile.samples, 20)
+            self.assertAlmostEqual(profile.gain, GAIN, delta=0.1 * GAIN)
+            self.assertAlmostEqual(profile.deadband, DEADBAND, delta=0.03)
+            self.assertLess(profile.rms_error, 1.)
+
+
+class TestMotorHandler(unittest.TestCase):
+
+    # longer trains get more power, and no IndexError
+    def test_ncars(self):
+        powers = [train.MotorHandler(None, ncars, None)._compute_power(3, 7.5) for ncars in range(6)]
+        self.assertListEqual(powers, sorted(powers))
+        self.assertGreater(powers[4], powers[2])
+
+    def test_profile(self):
+        profile = calibration.MotorProfile("Blue", GAIN, DEADBAND, {1: 10., 2: 20.})
+        handler = train.MotorHandler(None, 2, None, profile=profile)
+
+        self.assertAlmostEqual(handler._compute_power(2, 8.), 20. / (GAIN * 8.) + DEADBAND)
+        self.assertAlmostEqual(handler._compute_power(-1, 8.), -(10. / (GAIN * 8.) + DEADBAND))
+        self.assertEqual(handler._compute_power(0, 8.), 0.)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+''' Unit test that verifies the raw sensor capture ring buffer and file,
+    and the replay of captures through a train's sensor pipeline.
+'''
+import os
+import tempfile
+import unittest
+
+from srcpath import import_from_src
+
+layoutsim, capture, simhub, signal, track, clock, scheduler = \
+    import_from_src("layoutsim", "capture", "simhub", "signal", "track", "clock", "scheduler")
+
+
+class TestSensorCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = clock.VirtualClock(start=10.)
+        clock.clock.use(self.clock)
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        clock.clock.use(clock.RealClock())
+        self.directory.cleanup()
+
+    def _capture(self, capacity):
+        return capture.SensorCapture("train", directory=self.directory.name, capacity=capacity,
+                                     save_at_exit=False)
+
+    def test_save_and_read(self):
+        sensor_capture = self._capture(10)
+        for k in range(3):
+            self.clock.run(10. + 0.05 * k)
+            sensor_capture.record(k, 2 * k, 300 + k)
+
+        run = capture.read_capture(sensor_capture.save())
+        self.assertListEqual(list(run["time"]), [10., 10.05, 10.1])
+        self.assertListEqual(list(run["b"]), [300, 301, 302])
+        self.assertEqual(run["name"], "train")
+
+    # the oldest readings are overwritten, and the rest are saved in order
+    def test_ring_buffer(self):
+        sensor_capture = self._capture(5)
+        for k in range(8):
+            sensor_capture.record(k, 0, 0)
+
+        self.assertEqual(sensor_capture.dropped, 3)
+        run = capture.read_capture(sensor_capture.save())
+        self.assertListEqual(list(run["r"]), [3, 4, 5, 6, 7])
+
+    def test_nothing_to_save(self):
+        self.assertIsNone(self._capture(5).save())
+        self.assertListEqual(os.listdir(self.directory.name), [])
+
+
+def _tile_crossing(start, colors, interval=0.05, track_readings=60, tile_readings=4):
+    # readings of a sensor crossing the given tiles, with plain track in between
+    result = {"time": [], "r": [], "g": [], "b": []}
+    t = start
+    for color in colors:
+        for rgb in [simhub.TRACK_RGB] * track_readings + [simhub.TILE_RGB[color]] * tile_readings:
+            result["time"].append(t)
+            for field, value in zip(["r", "g", "b"], rgb):
+                result[field].append(value)
+            t += interval
+    return result
+
+
+class TestReplay(unittest.TestCase):
+
+    def tearDown(self):
+        clock.clock.use(clock.RealClock())
+        scheduler.scheduler.select(scheduler.THREADED)
+
+    def test_fast(self):
+        readings = []
+        statistics = capture.replay(_tile_crossing(0., [signal.RED] * 10),
+                                    lambda *rgb: readings.append(rgb), speed=None)
+
+        self.assertEqual(statistics["samples"], 640)
+        self.assertEqual(len(readings), 640)
+        self.assertAlmostEqual(statistics["duration"], 639 * 0.05)
+        self.assertLess(statistics["wall_time"], statistics["duration"])
+
+    # a replayed sector entry goes all the way through the train's pipeline
+    def test_pipeline(self):
+        simulation = layoutsim.LayoutSimulation(ntrains=1, seed=1)
+        train = simulation.trains[0]
+        train.auto = True
+        train.initialize_sectors()
+        start = simulation.clock.now()
+
+        statistics = capture.replay(_tile_crossing(500., [signal.BLUE]), train._vision_sensor_callback)
+
+        self.assertIs(train.sector, track.sectors[signal.BLUE])
+        self.assertEqual(train.event_queue.statistics()["processed"], 1)
+        self.assertAlmostEqual(simulation.clock.now() - start, statistics["duration"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+''' Unit test that verifies that the color lookup table returns exactly
+    the same results as the reference HSV classification algorithm.
+'''
+import os
+import csv
+import glob
+import unittest
+
+from srcpath import import_from_src, DATA
+
+classifier, = import_from_src("classifier")
+HSVClassifier = classifier.HSVClassifier
+ColorLookupTable = classifier.ColorLookupTable
+LUT_SIZE = classifier.LUT_SIZE
+
+
+class TestLookupTable(unittest.TestCase):
+
+    # checks every possible input in a small table. Hue and saturation
+    # ranges are scale-invariant, so lowering the brightness thresholds
+    # exercises the ranges of all colors in a table that can be scanned
+    # in reasonable time.
+    def test_every_input(self):
+        classifier = HSVClassifier(rgb_minimum=3, v_minimum=25)
+        size = 64
+        table = ColorLookupTable(classifier, size=size)
+
+        found = set()
+        for r in range(size):
+            for g in range(size):
+                for b in range(size):
+                    expected = classifier.classify(r, g, b)
+                    self.assertEqual(table.lookup(r, g, b), expected, (r, g, b))
+                    found.add(expected)
+
+        # make sure the test is not trivial
+        self.assertSetEqual(found, set(classifier.colors) | {None})
+
+    # checks the default table against readings captured from real tiles
+    def test_captured_readings(self):
+        table = ColorLookupTable()
+
+        filelist = glob.glob(os.path.join(DATA, "*.csv"))
+        filelist.remove(os.path.join(DATA, "lego_colors.csv"))
+
+        for filename in filelist:
+            with open(filename, mode='r') as csv_file:
+                for row in csv.reader(csv_file):
+                    if len(row) != 3:
+                        continue
+                    r, g, b = [int(float(x)) for x in row]
+                    self.assertEqual(table.lookup(r, g, b),
+                                     table.classifier.classify(r, g, b), (filename, r, g, b))
+
+    # readings outside the table are classified by the reference algorithm
+    def test_outside_table(self):
+        table = ColorLookupTable(size=LUT_SIZE)
+        for rgb in [(486, 255, 200), (400, 300, 100), (300, 50, 60), (1023, 1023, 1023)]:
+            self.assertEqual(table.lookup(*rgb), table.classifier.classify(*rgb))
+
+
+class TestMahalanobisClassifier(unittest.TestCase):
+
+    # tilted and elongated clusters, not far from the ones of real tiles
+    def _classifier(self, **kwargs):
+        centroids = {"RED": (0.73, 0.13), "PURPLE": (0.62, 0.14), "BLUE": (0.11, 0.35)}
+        covariances = {"RED": [[1.6e-4, -1.1e-4], [-1.1e-4, 0.9e-4]],
+                       "PURPLE": [[0.6e-4, -0.4e-4], [-0.4e-4, 0.5e-4]],
+                       "BLUE": [[0.4e-4, 0.], [0., 0.4e-4]]}
+        return classifier.MahalanobisClassifier(centroids, covariances, **kwargs)
+
+    def test_score(self):
+        mahalanobis = self._classifier()
+
+        color, confidence = mahalanobis.score(184, 43, 71)
+        self.assertEqual(color, "PURPLE")
+        self.assertGreater(confidence, 0.5)
+
+        # too far from every color, or too dark
+        self.assertEqual(mahalanobis.score(100, 100, 100), (None, 0.))
+        self.assertEqual(mahalanobis.score(18, 4, 7), (None, 0.))
+
+        # confidence drops with the distance to the centroid
+        self.assertLess(mahalanobis.score(200, 40, 80)[1], confidence)
+
+    # same check as for the HSV classifier, in a small table
+    def test_every_input(self):
+        mahalanobis = self._classifier(rgb_minimum=3, v_minimum=25)
+        size = 64
+        table = ColorLookupTable(mahalanobis, size=size)
+
+        found = set()
+        for r in range(size):
+            for g in range(size):
+                for b in range(size):
+                    expected = mahalanobis.classify(r, g, b)
+                    self.assertEqual(table.lookup(r, g, b), expected, (r, g, b))
+                    found.add(expected)
+
+        self.assertSetEqual(found, set(mahalanobis.colors) | {None})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+''' Unit test that verifies the virtual clock: ordering of sleeping
+    participants, and condition waits with a timeout.
+'''
+import unittest
+from threading import Condition
+
+from srcpath import import_from_src
+
+clock, = import_from_src("clock")
+
+
+class TestVirtualClock(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = clock.VirtualClock()
+        self.log = []
+
+    def _sleeper(self, name, seconds):
+        self.clock.sleep(seconds)
+        self.log.append((name, self.clock.now()))
+
+    def test_sleep_ordering(self):
+        self.clock.spawn(self._sleeper, "slow", 10.)
+        self.clock.spawn(self._sleeper, "fast", 1.)
+        self.clock.spawn(self._sleeper, "late", 2., delay=5.)
+
+        self.clock.run(100.)
+
+        self.assertListEqual(self.log, [("fast", 1.), ("late", 7.), ("slow", 10.)])
+        self.assertEqual(self.clock.now(), 100.)
+
+    # sleeping outside a participant drives the clock instead
+    def test_sleep_outside_participant(self):
+        self.clock.spawn(self._sleeper, "participant", 1.)
+        self.clock.sleep(3.)
+
+        self.assertListEqual(self.log, [("participant", 1.)])
+        self.assertEqual(self.clock.now(), 3.)
+
+    def test_wait_for(self):
+        condition = Condition()
+        state = {"free": False}
+
+        def waiter(timeout):
+            with condition:
+                result = self.clock.wait_for(condition, lambda: state["free"], timeout)
+            self.log.append((result, self.clock.now()))
+
+        # times out
+        self.clock.spawn(waiter, 2.)
+        self.clock.run(10.)
+        self.assertEqual(self.log, [(False, 2.)])
+
+        # predicate becomes true before the timeout
+        self.log = []
+        self.clock.spawn(waiter, 20.)
+        self.clock.call_at(13., lambda: state.update(free=True))
+        self.clock.run(50.)
+        self.assertEqual(len(self.log), 1)
+        self.assertTrue(self.log[0][0])
+        self.assertAlmostEqual(self.log[0][1], 13., delta=clock.POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    unittest.main()
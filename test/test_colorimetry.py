@@ -0,0 +1,64 @@
+''' Unit test that verifies the vectorized colorimetry analysis against
+    the standard library, on the captures in test/data.
+'''
+import os
+import random
+import statistics
+import unittest
+from colorsys import rgb_to_hsv
+
+import numpy
+
+from srcpath import import_from_src
+
+colorimetry, = import_from_src("colorimetry")
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+class TestColorimetry(unittest.TestCase):
+
+    def setUp(self):
+        self.files = colorimetry.capture_files(DATA)
+
+    def test_rgb_to_hsv(self):
+        generator = random.Random(1)
+        readings = [(generator.randint(0, 300), generator.randint(0, 300), generator.randint(0, 300))
+                    for k in range(2000)]
+        # grays, black, and ties in the maximum channel
+        readings += [(0, 0, 0), (80, 80, 80), (200, 200, 10), (10, 200, 200), (200, 10, 200)]
+
+        hsv = colorimetry.rgb_to_hsv(numpy.array(readings))
+        for (r, g, b), row in zip(readings, hsv):
+            for value, expected in zip(row, rgb_to_hsv(r, g, b)):
+                self.assertAlmostEqual(value, expected, places=12)
+
+    def test_summaries(self):
+        self.assertNotIn(os.path.join(DATA, "lego_colors.csv"), self.files)
+        summaries = colorimetry.analyze(self.files)
+
+        file_name = os.path.join(DATA, "DarkGreen.csv")
+        readings = colorimetry.load_capture(file_name)
+        hues = [rgb_to_hsv(*reading)[0] for reading in readings]
+        summary = summaries[file_name]
+
+        self.assertEqual(summary["H"]["count"], len(hues))
+        self.assertAlmostEqual(summary["H"]["mean"], statistics.mean(hues), places=12)
+        self.assertAlmostEqual(summary["H"]["stdev"], statistics.stdev(hues), places=12)
+        self.assertEqual(summary["H"]["min"], min(hues))
+        self.assertEqual(summary["G"]["max"], max(readings[:, 1]))
+        self.assertAlmostEqual(summary["B"]["percentiles"][50], statistics.median(readings[:, 2]))
+
+    # results don't depend on how files are split among processes
+    def test_pool(self):
+        serial = colorimetry.analyze(self.files[:4], processes=1)
+        pooled = colorimetry.analyze(self.files[:4], processes=2)
+
+        self.assertListEqual(list(serial), list(pooled))
+        for file_name in serial:
+            for channel in colorimetry.CHANNELS:
+                self.assertAlmostEqual(serial[file_name][channel]["stdev"], pooled[file_name][channel]["stdev"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,210 @@
+''' Unit test that verifies that sensor events are filtered per train
+    and per color.
+'''
+import unittest
+import threading
+
+from srcpath import import_from_src
+
+event, signal, clock = import_from_src("event", "signal", "clock")
+
+
+class _TestEventProcessor():
+    def __init__(self):
+        self.events = []
+
+    def process_event(self, event_key):
+        self.events.append(event_key)
+
+
+class _TestTrain():
+    def __init__(self, power_index=0):
+        self.name = "test"
+        self.event_processor = _TestEventProcessor()
+        self.event_queue = event.EventQueue(self)
+        self.power_index = power_index
+
+
+class TestSensorEventFilter(unittest.TestCase):
+    def setUp(self):
+        self.clock = clock.VirtualClock(start=100.)
+        clock.clock.use(self.clock)
+
+    def tearDown(self):
+        clock.clock.use(clock.RealClock())
+
+    def _filter_at(self, event_filter, event_time, color):
+        self.clock.run(event_time)
+        event_filter.filter_event(color)
+        # let the queue worker run
+        self.clock.run(event_time)
+
+    # events are passed on exactly when the threshold has elapsed, not before
+    def test_threshold_boundary(self):
+        train = _TestTrain()
+        event_filter = event.SensorEventFilter(train)
+
+        self._filter_at(event_filter, 100., signal.RED)
+        self._filter_at(event_filter, 100. + event.TIME_THRESHOLD, signal.RED)
+        self._filter_at(event_filter, 100. + event.TIME_THRESHOLD + 0.01, signal.RED)
+
+        self.assertListEqual(train.event_processor.events, [signal.RED, signal.RED])
+
+    # double detections within the threshold are ignored
+    def test_double_detection(self):
+        train = _TestTrain()
+        event_filter = event.SensorEventFilter(train)
+
+        self._filter_at(event_filter, 100., signal.GREEN)
+        self._filter_at(event_filter, 100. + event.TIME_THRESHOLD / 2, signal.GREEN)
+        self._filter_at(event_filter, 100. + event.TIME_THRESHOLD / 2, signal.BLUE)
+        self._filter_at(event_filter, 101. + event.TIME_THRESHOLD, signal.GREEN)
+
+        self.assertListEqual(train.event_processor.events,
+                             [signal.GREEN, signal.BLUE, signal.GREEN])
+
+    # an event in one train does not suppress the same event in another train
+    def test_independent_trains(self):
+        train_1 = _TestTrain()
+        train_2 = _TestTrain()
+        filter_1 = event.SensorEventFilter(train_1)
+        filter_2 = event.SensorEventFilter(train_2)
+
+        self._filter_at(filter_1, 100., signal.GREEN)
+        self._filter_at(filter_2, 100.1, signal.GREEN)
+
+        self.assertListEqual(train_1.event_processor.events, [signal.GREEN])
+        self.assertListEqual(train_2.event_processor.events, [signal.GREEN])
+
+    def test_per_color_threshold(self):
+        train = _TestTrain()
+        event_filter = event.SensorEventFilter(train, time_thresholds={signal.RED: 2.0})
+
+        self._filter_at(event_filter, 100., signal.RED)
+        self._filter_at(event_filter, 100., signal.YELLOW)
+        self._filter_at(event_filter, 101., signal.RED)
+        self._filter_at(event_filter, 101., signal.YELLOW)
+        self._filter_at(event_filter, 102.5, signal.RED)
+
+        self.assertListEqual(train.event_processor.events,
+                             [signal.RED, signal.YELLOW, signal.YELLOW, signal.RED])
+
+
+class TestSensorConfirmation(unittest.TestCase):
+    def setUp(self):
+        self.clock = clock.VirtualClock(start=100.)
+        clock.clock.use(self.clock)
+
+    def tearDown(self):
+        clock.clock.use(clock.RealClock())
+
+    # builds a stage, with the sample interval already measured
+    def _confirmation(self, train, vote):
+        confirmation = event.SensorConfirmation(train, vote=vote, tile_time=0.5, max_window=16)
+        confirmation.sample_interval = 0.0625
+        return confirmation
+
+    # feeds samples 0.0625 s apart, returns the confirmed colors
+    def _feed(self, confirmation, samples):
+        result = []
+        for color in samples:
+            self.clock.run(self.clock.now() + 0.0625)
+            result.append(confirmation.confirm(color))
+        return result
+
+    # window size follows train speed
+    def test_window_size(self):
+        train = _TestTrain(power_index=1)
+        confirmation = self._confirmation(train, 0.6)
+        self._feed(confirmation, [None] * 10)
+        self.assertEqual(confirmation.window, 8)
+        self.assertEqual(confirmation.required, 5)
+
+        train.power_index = -4
+        self._feed(confirmation, [None])
+        self.assertEqual(confirmation.window, 2)
+        self.assertEqual(confirmation.required, 2)
+
+    # isolated samples are rejected, steady samples are confirmed once
+    def test_confirmation(self):
+        train = _TestTrain(power_index=1)
+        confirmation = self._confirmation(train, 0.6)
+        G = signal.GREEN
+
+        result = self._feed(confirmation, [None] * 10 + [G, None, None, G] + [None] * 10)
+        self.assertNotIn(G, result)
+
+        result = self._feed(confirmation, [G, G, None, G, G, G, G, G, None])
+        self.assertListEqual(result, [None, None, None, None, None, G, None, None, None])
+        self.assertEqual(confirmation.confirmed, 1)
+        self.assertAlmostEqual(confirmation.statistics()["max_latency"], 0.3125)
+
+    # a vote of 1. requires a run of samples as long as the window
+    def test_run_length(self):
+        train = _TestTrain(power_index=2)
+        confirmation = self._confirmation(train, 1.)
+        B = signal.BLUE
+
+        result = self._feed(confirmation, [None] * 10 + [B, B, B, None, B, B, B, B])
+        self.assertEqual(confirmation.window, 4)
+        self.assertListEqual(result[10:], [None] * 7 + [B])
+
+
+class _BlockingEventProcessor(_TestEventProcessor):
+    # stands for an event processor that stops the train and waits
+    def __init__(self, wait):
+        super(_BlockingEventProcessor, self).__init__()
+        self.wait = wait
+
+    def process_event(self, event_key):
+        self.wait()
+        super(_BlockingEventProcessor, self).process_event(event_key)
+
+
+class TestEventQueue(unittest.TestCase):
+
+    def tearDown(self):
+        clock.clock.use(clock.RealClock())
+
+    # the caller never waits on a blocked processor, and a full queue drops events
+    def test_overflow(self):
+        release = threading.Event()
+        train = _TestTrain()
+        train.event_processor = _BlockingEventProcessor(lambda: release.wait(5.))
+        event_queue = event.EventQueue(train, maxsize=2)
+
+        results = [event_queue.put(color) for color in [signal.RED, signal.GREEN, signal.BLUE, signal.YELLOW]]
+        # the first event may or may not have been taken by the worker yet
+        self.assertIn(results, [[True, True, False, False], [True, True, True, False]])
+        self.assertEqual(event_queue.dropped, results.count(False))
+
+        release.set()
+        for k in range(100):
+            if event_queue.statistics()["processed"] == results.count(True):
+                break
+            threading.Event().wait(0.01)
+        self.assertListEqual(train.event_processor.events,
+                             [signal.RED, signal.GREEN, signal.BLUE][:results.count(True)])
+
+    def test_latency(self):
+        virtual_clock = clock.VirtualClock(start=100.)
+        clock.clock.use(virtual_clock)
+        train = _TestTrain()
+        train.event_processor = _BlockingEventProcessor(lambda: clock.clock.sleep(5.))
+        event_queue = event.EventQueue(train)
+
+        event_queue.put(signal.GREEN)
+        virtual_clock.run(101.)
+        event_queue.put(signal.YELLOW)
+        virtual_clock.run(120.)
+
+        # the second event waited for the first one to be processed
+        statistics = event_queue.statistics()
+        self.assertEqual(statistics["processed"], 2)
+        self.assertEqual(statistics["latency_max"], 4.)
+        self.assertEqual(statistics["latency_mean"], 2.)
+        self.assertListEqual(train.event_processor.events, [signal.GREEN, signal.YELLOW])
+
+
+if __name__ == "__main__":
+    unittest.main()
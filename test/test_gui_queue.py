@@ -0,0 +1,166 @@
+''' Unit test that verifies the GUI output queue, the coalescing of
+    display updates, the dispatch of messages to widgets, and the station
+    countdown.
+'''
+import unittest
+
+from srcpath import import_from_src
+
+gui, clock = import_from_src("gui", "clock")
+
+
+class TestGUIOutputQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = clock.VirtualClock(start=10.)
+        clock.clock.use(self.clock)
+
+    def tearDown(self):
+        clock.clock.use(clock.RealClock())
+
+    def test_drain(self):
+        output_queue = gui.GUIOutputQueue()
+        output_queue.put("a")
+        self.clock.run(11.)
+        output_queue.put("b")
+
+        self.assertListEqual(output_queue.drain(), [(10., "a"), (11., "b")])
+        self.assertListEqual(output_queue.drain(), [])
+
+    def test_bounded(self):
+        output_queue = gui.GUIOutputQueue(maxsize=3)
+        for k in range(5):
+            output_queue.put(str(k))
+
+        self.assertEqual(output_queue.depth, 3)
+        self.assertEqual(output_queue.dropped, 2)
+        self.assertListEqual([message for timestamp, message in output_queue.drain()], ["0", "1", "2"])
+
+
+class _TestWidget():
+    def __init__(self):
+        self.value = None
+        self.options = {}
+
+    def set(self, value):
+        self.value = value
+
+    def configure(self, **options):
+        self.options = options
+
+
+class _TestGUI(gui.GUI):
+    # GUI without Tk; columns are made of test widgets
+    def __init__(self):
+        self.columns = []
+        self.column_index = {}
+        self.handlers = self._message_handlers()
+        self.pending_basic = {}
+        self.countdowns = {}
+
+    def _build_column(self):
+        return [_TestWidget() for field in gui.FIELD_LABELS]
+
+
+class TestMessages(unittest.TestCase):
+
+    def setUp(self):
+        self.gui = _TestGUI()
+
+    def test_coalesce_newest_per_train_and_field(self):
+        messages = [self.gui.encode_basic_variables("Blue", "1", 8.1, 0.1, 2, 0.4),
+                    self.gui.encode_str_variable(gui.SIGNAL, "Blue", "1", gui.TK_RED),
+                    self.gui.encode_basic_variables("Purple", "2", 7.9, 0.2, 3, 0.5),
+                    self.gui.encode_basic_variables("Blue", "1", 8.0, 0.1, 3, 0.5),
+                    self.gui.encode_str_variable(gui.SIGNAL, "Blue", "1", gui.TK_GRAY)]
+
+        self.assertListEqual(gui.coalesce(messages), [messages[3], messages[4], messages[2]])
+
+    def test_dispatch(self):
+        # names may contain the comma that used to separate fields
+        self.gui._decode_message_and_update(
+            self.gui.encode_basic_variables("Blue, the first", "1", 8.1, 0.1234, 2, 0.4))
+        widgets = self.gui.columns[0]
+        self.assertEqual(widgets[gui.NAME_FIELD].value, "Blue, the first")
+        self.assertEqual(widgets[gui.VOLTAGE_FIELD].value, " 8.10")
+        self.assertEqual(widgets[gui.CURRENT_FIELD].value, "0.123")
+        self.assertEqual(widgets[gui.SPEED_FIELD].value, "2")
+
+        self.gui._decode_message_and_update(
+            self.gui.encode_str_variable(gui.SECTOR, "Blue", "1", gui.TK_GREEN, subtext="F"))
+        self.assertEqual(widgets[gui.SECTOR_FIELD].options, {"text": "F", "bg": gui.TK_GREEN})
+
+        self.gui._decode_message_and_update(self.gui.encode_str_variable(gui.XTRACK, "Blue", "1", gui.TK_RED))
+        self.assertEqual(widgets[gui.XTRACK_FIELD].options, {"bg": gui.TK_RED})
+
+
+    def test_columns(self):
+        for k in range(5):
+            self.gui._decode_message_and_update(gui.GUIMessage(gui.REGISTER, "Train %i" % k, str(k), ()))
+        self.gui._decode_message_and_update(self.gui.encode_str_variable(gui.SIGNAL, "Train 3", "3", gui.TK_RED))
+
+        self.assertEqual(len(self.gui.columns), 5)
+        self.assertEqual(self.gui.columns[3][gui.NAME_FIELD].value, "Train 3")
+        self.assertEqual(self.gui.columns[3][gui.SIGNAL_FIELD].options, {"bg": gui.TK_RED})
+
+    # telemetry repaints are limited per tick, and go round-robin
+    def test_throttled_repaint(self):
+        ntrains = 2 * gui.BASIC_REPAINTS_PER_TICK + 1
+        for k in range(ntrains):
+            self.gui._decode_message_and_update(gui.GUIMessage(gui.REGISTER, str(k), str(k), ()))
+
+        messages = [self.gui.encode_basic_variables(str(k), str(k), 8., 0.1, 1, 0.3) for k in range(ntrains)]
+        self.gui._update(messages)
+        painted = [column[gui.VOLTAGE_FIELD].value is not None for column in self.gui.columns]
+        self.assertEqual(sum(painted), gui.BASIC_REPAINTS_PER_TICK)
+
+        # a newer value for a train already waiting doesn't move it back in line
+        self.gui._update([self.gui.encode_basic_variables("4", "4", 7., 0.1, 1, 0.3)])
+        self.gui._update([])
+        painted = [column[gui.VOLTAGE_FIELD].value is not None for column in self.gui.columns]
+        self.assertTrue(all(painted))
+        self.assertEqual(self.gui.columns[4][gui.VOLTAGE_FIELD].value, " 7.00")
+        self.assertEqual(len(self.gui.pending_basic), 0)
+
+
+class TestCountdown(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = clock.VirtualClock(start=100.)
+        clock.clock.use(self.clock)
+        self.gui = _TestGUI()
+
+    def tearDown(self):
+        clock.clock.use(clock.RealClock())
+
+    # runs the GUI ticks up to the given time; returns the values painted
+    def _tick_until(self, end_time):
+        painted = []
+        while self.clock.now() < end_time:
+            self.clock.run(self.clock.now() + gui.QUEUE_POLLING / 1000.)
+            self.gui._update([message for timestamp, message in gui.tkinter_output_queue.drain()])
+            value = self.gui.columns[0][gui.ASTATION_FIELD].value
+            if len(painted) == 0 or painted[-1] != value:
+                painted.append(value)
+        return painted
+
+    def test_countdown(self):
+        self.gui.report_astation("Blue", "1", 3.5)
+        painted = self._tick_until(105.)
+
+        self.assertListEqual(painted, ["  3", "  2", "  1", "  0"])
+        self.assertEqual(len(self.gui.countdowns), 0)
+
+    # a train that leaves early stops its countdown
+    def test_cancel(self):
+        self.gui.report_astation("Blue", "1", 30.)
+        self._tick_until(101.2)
+        self.gui.report_astation("Blue", "1", 0)
+        painted = self._tick_until(110.)
+
+        self.assertListEqual(painted, ["  0"])
+        self.assertEqual(len(self.gui.countdowns), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+''' Unit test that verifies ordering, supersession and metrics in the
+    hub command queue, and the coalescing of motor power writes.
+'''
+import unittest
+from threading import Event
+
+from srcpath import import_from_src
+
+layoutsim, hubqueue, train = import_from_src("layoutsim", "hubqueue", "train")
+HubCommandQueue = hubqueue.HubCommandQueue
+STOP = hubqueue.STOP
+MOTOR = hubqueue.MOTOR
+LED = hubqueue.LED
+
+
+class TestHubCommandQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.commands = HubCommandQueue("test")
+        self.sent = []
+
+        # holds the writer busy while the test fills up the queue
+        self.busy = Event()
+        self.release = Event()
+        self.commands.put(LED, self._hold)
+        self.busy.wait()
+
+    def _hold(self):
+        self.busy.set()
+        self.release.wait()
+
+    def _send(self, value):
+        self.sent.append(value)
+
+    def test_priority(self):
+        self.commands.put(LED, self._send, "led 1")
+        self.commands.put(MOTOR, self._send, "motor")
+        self.commands.put(LED, self._send, "led 2")
+        last = self.commands.put(STOP, self._send, "stop")
+        self.release.set()
+
+        self.commands.call(LED, self._send, "led 3")
+        self.assertTrue(last.done.is_set())
+        self.assertListEqual(self.sent, ["stop", "led 1", "led 2", "led 3"])
+
+    def test_stop_supersedes_motor(self):
+        superseded = self.commands.put(MOTOR, self._send, 0.5)
+        self.commands.put(STOP, self._send, 0.)
+        self.commands.put(MOTOR, self._send, 0.3)
+        self.release.set()
+
+        self.commands.call(LED, self._send, "led")
+        self.assertTrue(superseded.cancelled)
+        self.assertListEqual(self.sent, [0., 0.3, "led"])
+
+    def test_statistics(self):
+        self.commands.put(MOTOR, self._send, 0.5)
+        self.assertEqual(self.commands.depth, 1)
+        self.assertEqual(self.commands.max_depth, 1)
+        self.release.set()
+        self.commands.call(LED, self._send, "led")
+
+        statistics = self.commands.statistics()
+        self.assertEqual(statistics["depth"], 0)
+        self.assertEqual(statistics["motor_count"], 1)
+        self.assertEqual(statistics["light_count"], 2)
+        self.assertGreater(statistics["motor_latency_max"], 0.)
+
+
+class _Motor():
+    def __init__(self):
+        self.sent = []
+
+    def power(self, param):
+        self.sent.append(param)
+
+
+class TestMotorPowerCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        self.commands = HubCommandQueue("test")
+        self.motor = _Motor()
+        self.handler = train.MotorHandler(self.motor, 2, self.commands, linear=True)
+        self.voltage = train.MotorHandler.NOMINAL_VOLTAGE
+
+    def _hold(self):
+        # holds the writer busy until _flush, so writes pile up in the queue
+        busy = Event()
+        self.release = Event()
+        self.commands.put(LED, lambda: (busy.set(), self.release.wait()))
+        busy.wait()
+
+    def _flush(self):
+        self.release.set()
+        self.commands.call(LED, lambda: None)
+
+    # ramp steps superseded while a write waits in the queue are never sent
+    def test_superseded_ramp_step(self):
+        self._hold()
+        for index in range(1, 5):
+            self.handler.set_motor_power(index, self.voltage)
+        self._flush()
+
+        self.assertListEqual(self.motor.sent, [self.handler._compute_power(4, self.voltage)])
+        self.assertEqual(self.handler.writes_requested, 4)
+        self.assertEqual(self.handler.writes_sent, 1)
+
+    def test_equal_write_dropped(self):
+        self.handler.set_motor_power(3, self.voltage)
+        self.commands.call(LED, lambda: None)
+        self.handler.set_motor_power(3, self.voltage)
+        self.commands.call(LED, lambda: None)
+
+        self.assertEqual(len(self.motor.sent), 1)
+        self.assertIsNone(self.handler.pending_write)
+
+    # a setpoint that comes in while a stop waits goes out after the stop
+    def test_stop_then_go(self):
+        self.handler.set_motor_power(4, self.voltage)
+        self.commands.call(LED, lambda: None)
+
+        self._hold()
+        self.handler.set_motor_power(0, self.voltage)
+        self.handler.set_motor_power(2, self.voltage)
+        self._flush()
+
+        self.assertListEqual(self.motor.sent, [self.handler._compute_power(4, self.voltage), 0.,
+                                               self.handler._compute_power(2, self.voltage)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+''' Unit test that runs a short layout simulation, and verifies that trains
+    complete laps and that results are reproducible for a given seed.
+'''
+import unittest
+
+from srcpath import import_from_src
+
+layoutsim, clock, scheduler = import_from_src("layoutsim", "clock", "scheduler")
+
+
+class TestLayoutSimulation(unittest.TestCase):
+
+    def tearDown(self):
+        clock.clock.use(clock.RealClock())
+        scheduler.scheduler.select(scheduler.THREADED)
+
+    def _run(self, seed):
+        simulation = layoutsim.LayoutSimulation(ntrains=2, seed=seed)
+        return simulation.run(0.05)
+
+    def test_run(self):
+        report = self._run(1)
+
+        self.assertAlmostEqual(report["simulated_hours"], 0.05, places=3)
+        for values in report["trains"].values():
+            self.assertGreater(values["arrivals"], 0)
+        for fraction in report["sector_utilization"].values():
+            self.assertGreater(fraction, 0.)
+            self.assertLess(fraction, 1.)
+
+    def test_reproducible(self):
+        first = self._run(2)
+        second = self._run(2)
+        for name in first["trains"]:
+            self.assertEqual(first["trains"][name]["arrivals"], second["trains"][name]["arrivals"])
+        self.assertEqual(first["sector_utilization"], second["sector_utilization"])
+
+    def test_too_many_trains(self):
+        with self.assertRaises(ValueError):
+            layoutsim.LayoutSimulation(ntrains=3)
+
+
+if __name__ == "__main__":
+    unittest.main()
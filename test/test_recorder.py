@@ -0,0 +1,107 @@
+''' Unit test that verifies the telemetry recorder and reader: file formats,
+    bounded buffer, and file rotation.
+'''
+import os
+import tempfile
+import unittest
+
+from srcpath import import_from_src
+
+recorder, = import_from_src("recorder")
+
+
+class TestTelemetryRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _recorder(self, format=recorder.CSV, **kwargs):
+        # long flush interval: the tests flush by themselves
+        result = recorder.TelemetryRecorder("train", directory=self.directory.name, format=format,
+                                            sector_names=["RED_1", "GREEN"], flush_interval=3600., **kwargs)
+        self.addCleanup(result.close)
+        return result
+
+    def _read(self, index=0):
+        name = "train.csv" if index == 0 else "train.%i.csv" % index
+        with open(os.path.join(self.directory.name, name)) as f:
+            return f.read().splitlines()
+
+    def test_csv(self):
+        telemetry = self._recorder()
+        telemetry.record(8.1, 0.123, 3, 0.45)
+        telemetry.record(8.0, 0.2, -2, 0.5, sector="GREEN", event=recorder.GREEN)
+        telemetry.flush()
+
+        lines = self._read()
+        self.assertEqual(lines[0], ",".join(recorder.FIELDS))
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].endswith(",8.100,0.1230,0.450,3,,"))
+        self.assertTrue(lines[2].endswith(",8.000,0.2000,0.500,-2,GREEN,GREEN"))
+        self.assertEqual(telemetry.written, 2)
+
+    def test_binary(self):
+        telemetry = self._recorder(format=recorder.BINARY)
+        telemetry.record(8.1, 0.125, 3, 0.5)
+        telemetry.flush()
+        telemetry.record(7.5, 0.25, -2, 0.75, sector="RED_1", event=recorder.RED)
+        telemetry.record(7.25, 0.5, 1, 0.25, sector="GREEN")
+        telemetry.close()
+
+        run = recorder.read_telemetry(os.path.join(self.directory.name, "train.tlm"))
+        # voltage is stored in single precision
+        for value, expected in zip(run["voltage"], [8.1, 7.5, 7.25]):
+            self.assertAlmostEqual(value, expected, places=5)
+        self.assertListEqual(list(run["current"]), [0.125, 0.25, 0.5])
+        self.assertListEqual(list(run["power_index"]), [3, -2, 1])
+        self.assertListEqual(list(run["power"]), [0.5, 0.75, 0.25])
+        self.assertListEqual([run["sectors"][code - 1] if code else None for code in run["sector"]],
+                             [None, "RED_1", "GREEN"])
+        self.assertListEqual([run["events"][code - 1] if code else None for code in run["event"]],
+                             [None, recorder.RED, None])
+        self.assertLessEqual(run["time"][0], run["time"][2])
+
+    def test_bounded_buffer(self):
+        telemetry = self._recorder(buffer_size=5)
+        for k in range(8):
+            telemetry.record(8., 0.1, k, 0.3)
+        telemetry.flush()
+
+        # the oldest samples were dropped
+        self.assertEqual(telemetry.dropped, 3)
+        self.assertListEqual([line.split(",")[4] for line in self._read()[1:]], ["3", "4", "5", "6", "7"])
+
+    def test_rotation(self):
+        telemetry = self._recorder(max_bytes=200, backups=2)
+        for k in range(12):
+            telemetry.record(8., 0.1, k, 0.3)
+            telemetry.flush()
+
+        files = sorted(os.listdir(self.directory.name))
+        self.assertListEqual(files, ["train.1.csv", "train.2.csv", "train.csv"])
+
+        # every file starts with the header, and the newest samples are in the current file
+        for index in range(3):
+            self.assertEqual(self._read(index)[0], ",".join(recorder.FIELDS))
+        self.assertEqual(self._read()[-1].split(",")[4], "11")
+        self.assertLess(int(self._read(2)[1].split(",")[4]), int(self._read(1)[1].split(",")[4]))
+
+    def test_binary_session(self):
+        telemetry = self._recorder(format=recorder.BINARY, max_bytes=200, backups=3)
+        for k in range(20):
+            telemetry.record(8., 0.1, k % 7, 0.3)
+            telemetry.flush()
+        telemetry.close()
+
+        # only the samples in the files kept are loaded, in order
+        session = recorder.read_telemetry_session(os.path.join(self.directory.name, "train"), backups=3)
+        indices = list(session["power_index"])
+        self.assertEqual(indices[-1], 19 % 7)
+        self.assertListEqual(indices, [k % 7 for k in range(20 - len(indices), 20)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+''' Unit test that verifies the shared scheduler: delayed and periodic
+    actions, and their cancellation.
+'''
+import time
+import unittest
+from threading import Event
+
+from srcpath import import_from_src
+
+scheduler_module, = import_from_src("scheduler")
+Scheduler = scheduler_module.Scheduler
+SchedulerSelector = scheduler_module.SchedulerSelector
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler(workers=2)
+
+    def test_call_later_order(self):
+        results = []
+        done = Event()
+        self.scheduler.call_later(0.10, results.append, "second")
+        self.scheduler.call_later(0.15, lambda: (results.append("third"), done.set()))
+        self.scheduler.call_later(0.05, results.append, "first")
+
+        self.assertTrue(done.wait(2.))
+        self.assertListEqual(results, ["first", "second", "third"])
+
+    def test_cancel(self):
+        results = []
+        task = self.scheduler.call_later(0.05, results.append, "cancelled")
+        task.cancel()
+        time.sleep(0.15)
+        self.assertListEqual(results, [])
+
+    def test_periodic_stops_on_false(self):
+        counter = [3]
+        done = Event()
+
+        def step():
+            counter[0] -= 1
+            if counter[0] == 0:
+                done.set()
+                return False
+
+        self.scheduler.call_periodic(0.02, step)
+        self.assertTrue(done.wait(2.))
+        time.sleep(0.1)
+        self.assertEqual(counter[0], 0)
+
+    def test_cancel_wait(self):
+        started = Event()
+        finished = []
+
+        def slow():
+            started.set()
+            time.sleep(0.1)
+            finished.append(True)
+
+        task = self.scheduler.submit(slow)
+        self.assertTrue(started.wait(2.))
+        task.cancel(wait=True)
+        self.assertListEqual(finished, [True])
+
+
+class TestSchedulerSelector(unittest.TestCase):
+
+    def test_select(self):
+        selector = SchedulerSelector(scheduler_module.VIRTUAL)
+        selector.select(scheduler_module.THREADED)
+        self.assertIsInstance(selector.backend, Scheduler)
+
+        done = Event()
+        selector.submit(done.set)
+        self.assertTrue(done.wait(2.))
+
+        # mode can't be switched once running
+        self.assertRaises(RuntimeError, selector.select, scheduler_module.VIRTUAL)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+''' Unit test that verifies the simulated hub: train movement, vision
+    sensor stream, battery sag, and handset buttons.
+'''
+import unittest
+
+from srcpath import import_from_src
+
+simhub, classifier, signal = import_from_src("simhub", "classifier", "signal")
+
+
+class TestSimulatedHub(unittest.TestCase):
+
+    def setUp(self):
+        self.layout = simhub.SimulatedLayout(realtime=False)
+        self.route = simhub.Route(200., [simhub.Tile(50., signal.GREEN, length=10.),
+                                         simhub.Tile(120., signal.RED, length=10.)])
+        self.layout.configure("hub", self.route)
+        self.hub = simhub.SmartHub(address="hub", layout=self.layout)
+
+    def _run(self, duration):
+        for k in range(int(duration / self.layout.tick)):
+            self.layout.step(self.layout.tick)
+
+    def test_movement(self):
+        self._run(1.)
+        self.assertEqual(self.hub.position, 0.)
+
+        # below the deadband, the train doesn't move
+        self.hub.port_A.power(simhub.DEADBAND)
+        self._run(1.)
+        self.assertEqual(self.hub.position, 0.)
+
+        self.hub.port_A.power(0.6)
+        self._run(2.)
+        self.assertGreater(self.hub.position, 40.)
+        self.assertLess(self.hub.position, 100.)
+
+    def test_sensor_stream(self):
+        table = classifier.ColorLookupTable()
+        colors = []
+        self.hub.vision_sensor.subscribe(lambda r, g, b: colors.append(table.lookup(r, g, b)))
+
+        # one full lap at low speed detects both tiles, and nothing else
+        self.hub.port_A.power(0.4)
+        while self.layout.time < 200. / (simhub.MAX_SPEED_CMS * 0.25) + 1.:
+            self.layout.step(self.layout.tick)
+
+        detected = [c for k, c in enumerate(colors) if c is not None and (k == 0 or colors[k - 1] != c)]
+        self.assertListEqual(detected, [signal.GREEN, signal.RED])
+
+    def test_battery_sag(self):
+        voltages = []
+        self.hub.voltage.subscribe(voltages.append)
+        self._run(1.)
+        self.hub.port_A.power(1.)
+        self._run(1.)
+
+        self.assertGreater(voltages[0], voltages[-1] + simhub.INTERNAL_RESISTANCE * simhub.LOAD_CURRENT * 0.9)
+        self.assertGreater(self.hub.current_value, simhub.LOAD_CURRENT)
+
+    def test_handset(self):
+        handset = simhub.RemoteHandset(layout=self.layout)
+        events = []
+        handset.port_B.subscribe(lambda button, button_set: events.append((button, button_set)))
+
+        handset.press(simhub.RemoteButton.RIGHT, simhub.RemoteButton.PLUS, duration=0.2)
+        self.assertListEqual(events, [(simhub.RemoteButton.PLUS, simhub.RemoteButton.RIGHT)])
+
+        self._run(0.3)
+        self.assertListEqual(events, [(simhub.RemoteButton.PLUS, simhub.RemoteButton.RIGHT),
+                                      (simhub.RemoteButton.RELEASE, simhub.RemoteButton.RIGHT)])
+
+
+if __name__ == "__main__":
+    unittest.main()
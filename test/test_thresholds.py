@@ -0,0 +1,126 @@
+''' Unit test that verifies the fitting of hue and saturation ranges to
+    labeled captures, and the loading of the fitted tables by the runtime.
+'''
+import os
+import random
+import tempfile
+import unittest
+
+import numpy
+
+from srcpath import import_from_src
+
+thresholds, classifier, signal = import_from_src("thresholds", "classifier", "signal")
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+class TestThresholds(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.labeled = thresholds.load_labeled(DATA)
+        cls.fitted = thresholds.fit_thresholds(cls.labeled)
+
+    def test_fit(self):
+        report = thresholds.evaluate(self.fitted, self.labeled)
+
+        for color in self.fitted.colors:
+            self.assertLess(report[color]["false_negative_rate"], 0.01)
+            self.assertEqual(report[color]["false_positive_rate"], 0.)
+        self.assertEqual(report[None]["false_positive_rate"], 0.)
+
+        # boxes are well inside the hue domain, and don't cover the background
+        for color in self.fitted.colors:
+            low, high = self.fitted.hue[color]
+            self.assertLess(high - low, 0.1)
+
+    # a reading in the overlap of two boxes would go to the color tested first
+    def test_disjoint_boxes(self):
+        colors = self.fitted.colors
+        for k, first in enumerate(colors):
+            for second in colors[k + 1:]:
+                disjoint = [self.fitted.hue[first][1] < self.fitted.hue[second][0] or
+                            self.fitted.hue[second][1] < self.fitted.hue[first][0],
+                            self.fitted.saturation[first][1] < self.fitted.saturation[second][0] or
+                            self.fitted.saturation[second][1] < self.fitted.saturation[first][0]]
+                self.assertTrue(any(disjoint), (first, second))
+
+    def test_vectorized_classify(self):
+        generator = random.Random(1)
+        readings = [(generator.randint(0, 400), generator.randint(0, 400), generator.randint(0, 400))
+                    for k in range(5000)]
+        readings += [tuple(int(v) for v in reading) for reading in self.labeled[signal.RED][:200]]
+
+        indices = thresholds.classify(self.fitted, numpy.array(readings, dtype=float))
+        for reading, index in zip(readings, indices):
+            expected = self.fitted.classify(*reading)
+            self.assertEqual(self.fitted.colors[index] if index >= 0 else None, expected)
+
+    def test_runtime_tables(self):
+        report = thresholds.evaluate(self.fitted, self.labeled)
+        with tempfile.TemporaryDirectory() as directory:
+            threshold_file = os.path.join(directory, "thresholds.json")
+            table_file = os.path.join(directory, "thresholds.lut")
+
+            # without files, the ranges in signal.py are used
+            table = classifier.load_color_table(threshold_file, table_file)
+            self.assertEqual(table.classifier.hue, signal.HUE)
+
+            thresholds.save(self.fitted, report, threshold_file, table_file)
+            table = classifier.load_color_table(threshold_file, table_file)
+            self.assertEqual(table.classifier.parameters(), self.fitted.parameters())
+            self.assertEqual(table.table, classifier.ColorLookupTable(self.fitted).table)
+
+            # a table compiled from other ranges is not used
+            classifier.ColorLookupTable().save(table_file)
+            table = classifier.load_color_table(threshold_file, table_file)
+            self.assertEqual(table.lookup(*self.labeled[signal.PURPLE][0].astype(int)), signal.PURPLE)
+            self.assertEqual(table.table, classifier.ColorLookupTable(self.fitted).table)
+
+
+class TestStatistical(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.labeled = thresholds.load_labeled(DATA)
+        cls.fitted = thresholds.fit_statistical(cls.labeled)
+
+    def test_fit(self):
+        report = thresholds.evaluate(self.fitted, self.labeled)
+
+        for color in self.fitted.colors:
+            self.assertLess(report[color]["false_negative_rate"], 0.01)
+            self.assertEqual(report[color]["false_positive_rate"], 0.)
+        self.assertEqual(report[None]["false_positive_rate"], 0.)
+
+    def test_vectorized_classify(self):
+        generator = random.Random(2)
+        readings = [(generator.randint(0, 400), generator.randint(0, 400), generator.randint(0, 400))
+                    for k in range(5000)]
+        readings += [tuple(int(v) for v in reading) for reading in self.labeled[signal.PURPLE][:200]]
+
+        indices, confidences = self.fitted.score_array(numpy.array(readings, dtype=float))
+        for reading, index, confidence in zip(readings, indices, confidences):
+            color, expected = self.fitted.score(*reading)
+            self.assertEqual(self.fitted.colors[index] if index >= 0 else None, color)
+            self.assertAlmostEqual(confidence, expected)
+
+    def test_runtime_tables(self):
+        report = thresholds.evaluate(self.fitted, self.labeled)
+        with tempfile.TemporaryDirectory() as directory:
+            threshold_file = os.path.join(directory, "thresholds.json")
+            table_file = os.path.join(directory, "thresholds.lut")
+
+            thresholds.save(self.fitted, report, threshold_file, table_file)
+            table = classifier.load_color_table(threshold_file, table_file)
+            self.assertIsInstance(table.classifier, classifier.MahalanobisClassifier)
+            self.assertEqual(table.classifier.parameters(), self.fitted.parameters())
+
+            for color in self.fitted.colors:
+                for reading in self.labeled[color][:50].astype(int):
+                    self.assertEqual(table.lookup(*reading), color)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,206 @@
+''' Unit test that verifies timing-sensitive behavior in virtual time: the
+    signal-blind interval after a station departure, the sector entry guard,
+    and handset button gestures.
+'''
+import unittest
+
+from srcpath import import_from_src
+
+layoutsim, controller, clock, scheduler, track, signal, event = \
+    import_from_src("layoutsim", "controller", "clock", "scheduler", "track", "signal", "event")
+
+RemoteButton = controller.RemoteButton
+
+
+class TestTrainTiming(unittest.TestCase):
+
+    def setUp(self):
+        self.simulation = layoutsim.LayoutSimulation(ntrains=1, seed=1)
+        self.clock = self.simulation.clock
+        self.train = self.simulation.trains[0]
+        self.train.auto = True
+        self.train.initialize_sectors()
+
+    def tearDown(self):
+        clock.clock.use(clock.RealClock())
+        scheduler.scheduler.select(scheduler.THREADED)
+
+    def test_signal_blind(self):
+        start = self.clock.now()
+        self.clock.spawn(self.train.restart_movement)
+
+        # restart_movement waits 1 s before moving, then goes blind
+        self.clock.run(start + 1. + track.TIME_BLIND - 0.05)
+        self.assertTrue(self.train.signal_blind)
+
+        # signals are ignored while blind
+        self.clock.spawn(self.train.event_processor.process_event, signal.BLUE)
+        self.clock.run(self.clock.now() + 0.01)
+        self.assertIsNone(self.train.sector)
+
+        self.clock.run(start + 1. + track.TIME_BLIND + 0.05)
+        self.assertFalse(self.train.signal_blind)
+
+    def test_sector_time(self):
+        start = self.clock.now()
+        self.clock.spawn(self.train.event_processor.process_event, signal.BLUE)
+
+        sector = track.sectors[signal.BLUE]
+        self.clock.run(start + sector.sector_time - 0.05)
+        self.assertIs(self.train.sector, sector)
+        self.assertTrue(self.train.just_entered_sector)
+
+        self.clock.run(start + sector.sector_time + 0.05)
+        self.assertFalse(self.train.just_entered_sector)
+
+    # leaving a structured sector, a train waits for the next sector to be
+    # free, and books it before going on. Once in it, it frees the sector
+    # it left.
+    def test_stop_and_wait(self):
+        sector = track.sectors[signal.BLUE]
+        next_sector = sector.next[self.train.direction]
+        self.train.sector = sector
+        self.train.sector.sub_sector_type = track.SLOW
+        self.train.just_entered_sector = False
+        self.assertTrue(self.train.book_track([sector]))
+
+        holder = _TestTrain("train 2")
+        reservation = track.reservations.reserve(holder, [next_sector], timeout=0)
+
+        start = self.clock.now()
+        self.clock.spawn(self.train.event_processor.process_event, signal.BLUE)
+        self.clock.run(start + 5.)
+        self.assertIs(self.train.sector, sector)
+        self.assertEqual(next_sector.occupier, holder.name)
+
+        reservation.release()
+        self.clock.run(start + 5.1)
+        self.assertIsNone(self.train.sector)
+        self.assertEqual(next_sector.occupier, self.train.name)
+
+        self.clock.spawn(self.train.event_processor._enter_sector, next_sector.color)
+        self.clock.run(start + 5.2)
+        self.assertIs(self.train.sector, next_sector)
+        self.assertIsNone(sector.occupier)
+        self.assertEqual(next_sector.occupier, self.train.name)
+
+    # after a few laps, guard and speedup come from measured traversal times
+    def test_measured_sector_time(self):
+        self.simulation.run(0.1)
+
+        estimator = self.train.event_processor.sector_times
+        sector = track.sectors[signal.BLUE]
+        statistics = estimator.statistics()[sector.name]
+        self.assertGreaterEqual(statistics["exit"]["samples"], event.SECTOR_TIME_MIN_SAMPLES)
+
+        guard = estimator.guard_time(sector)
+        self.assertGreater(guard, sector.sector_time)
+        self.assertLess(guard, statistics["exit"]["mean"] - 2 * statistics["exit"]["deviation"])
+        self.assertLess(estimator.speedup_time(sector), statistics["signal"]["mean"] - event.SPEEDUP_MARGIN)
+
+
+class TestSectorTimeEstimator(unittest.TestCase):
+
+    def setUp(self):
+        self.estimator = event.SectorTimeEstimator()
+        self.sector = track.Sector(signal.GREEN, sector_time=1., max_speed_time=5.)
+
+    def _feed(self, times):
+        for elapsed in times:
+            self.estimator.update_exit(self.sector.name, elapsed)
+            self.estimator.update_signal(self.sector.name, elapsed / 2.)
+
+    def test_static_until_ready(self):
+        self._feed([8.] * (event.SECTOR_TIME_MIN_SAMPLES - 1))
+        self.assertEqual(self.estimator.guard_time(self.sector), 1.)
+        self.assertEqual(self.estimator.speedup_time(self.sector), 5.)
+
+        self._feed([8.])
+        self.assertAlmostEqual(self.estimator.guard_time(self.sector), event.GUARD_FRACTION * 8.)
+        self.assertAlmostEqual(self.estimator.speedup_time(self.sector), 4. - event.SPEEDUP_MARGIN)
+
+    def test_variance(self):
+        # noisy times widen the safety margin
+        self._feed([8., 9., 7., 8.5, 7.5] * 10)
+        statistics = self.estimator.statistics()[self.sector.name]["exit"]
+        self.assertAlmostEqual(statistics["mean"], 8., delta=0.3)
+        self.assertGreater(statistics["deviation"], 0.4)
+        self.assertAlmostEqual(self.estimator.guard_time(self.sector),
+                               statistics["mean"] - event.SECTOR_TIME_SIGMAS * statistics["deviation"])
+
+    def test_outlier(self):
+        self._feed([8.] * 10)
+        self._feed([60.])
+        self.assertLess(self.estimator.statistics()[self.sector.name]["exit"]["mean"], 9.)
+
+        # a train that got slower for good is followed anyway
+        self._feed([12.] * 50)
+        self.assertAlmostEqual(self.estimator.statistics()[self.sector.name]["exit"]["mean"], 12., places=2)
+
+        # a spurious early signal doesn't shrink the estimate either
+        self._feed([0.5])
+        self.assertGreater(self.estimator.statistics()[self.sector.name]["exit"]["mean"], 11.)
+
+    # a spurious first measurement doesn't seed the estimate
+    def test_spurious_first(self):
+        self._feed([0.5, 8., 8.2])
+        self.assertAlmostEqual(self.estimator.statistics()[self.sector.name]["exit"]["mean"], 8.)
+        self.assertAlmostEqual(self.estimator.speedup_time(self.sector),
+                               4. - event.SECTOR_TIME_SIGMAS * event.SECTOR_TIME_ROBUST_SIGMA * 0.1 -
+                               event.SPEEDUP_MARGIN)
+
+
+class _TestTrain():
+    def __init__(self, name):
+        self.name = name
+
+    def report_xtrack(self, tkcolor):
+        pass
+
+
+class _TestController():
+    def __init__(self):
+        self.handset = None
+        self.actions = []
+        self.handset_short_red_actions = {RemoteButton.LEFT: lambda: self.actions.append("short")}
+
+    def _handle_red_button(self, mode):
+        self.actions.append(mode)
+
+
+class TestHandsetGestures(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = clock.VirtualClock()
+        clock.clock.use(self.clock)
+        self.controller = _TestController()
+        self.handler = controller.HandsetHandler(self.controller)
+
+    def tearDown(self):
+        clock.clock.use(clock.RealClock())
+
+    def _press_at(self, press_time, button):
+        self.clock.run(press_time)
+        self.handler.callback_from_button(button, RemoteButton.LEFT)
+
+    def test_gestures(self):
+        # quick press
+        self._press_at(10., RemoteButton.RED)
+        self._press_at(10.2, RemoteButton.RELEASE)
+        self.assertListEqual(self.controller.actions, ["short"])
+
+        # dual press, and its two releases
+        self._press_at(20., RemoteButton.RED)
+        self._press_at(20.1, RemoteButton.RED)
+        self._press_at(20.3, RemoteButton.RELEASE)
+        self._press_at(20.3, RemoteButton.RELEASE)
+        self.assertListEqual(self.controller.actions, ["short", controller.DUAL])
+
+        # long press
+        self._press_at(30., RemoteButton.RED)
+        self._press_at(31.5, RemoteButton.RELEASE)
+        self.assertListEqual(self.controller.actions, ["short", controller.DUAL, controller.LONG])
+
+
+if __name__ == "__main__":
+    unittest.main()
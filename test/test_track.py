@@ -0,0 +1,242 @@
+''' Unit test that verifies that trains waiting for a sector or a cross-track
+    wake up as soon as it is freed, and that sets of track resources are
+    booked atomically.
+'''
+import time
+import unittest
+from threading import Thread
+
+from srcpath import import_from_src
+
+track, signal, clock, scheduler = import_from_src("track", "signal", "clock", "scheduler")
+
+
+class _TestTrain():
+    def __init__(self, name):
+        self.name = name
+        self.gui = None
+
+    def report_xtrack(self, tkcolor):
+        pass
+
+
+class _ReportingTrain(_TestTrain):
+    '''
+    Records the cross-track colors it is sent, along with whether the track
+    lock could be taken by another thread at the time.
+    '''
+    def __init__(self, name):
+        super().__init__(name)
+        self.reports = []
+
+    def report_xtrack(self, tkcolor):
+        unlocked = []
+        def probe():
+            if track.track_condition.acquire(blocking=False):
+                track.track_condition.release()
+                unlocked.append(True)
+        prober = Thread(target=probe)
+        prober.start()
+        prober.join()
+        self.reports.append((tkcolor, bool(unlocked)))
+
+
+class TestSector(unittest.TestCase):
+    def setUp(self):
+        self.sector = track.Sector(signal.GREEN)
+        self.train_1 = _TestTrain("train 1")
+        self.train_2 = _TestTrain("train 2")
+
+    def test_acquire_release(self):
+        self.assertTrue(self.sector.acquire(self.train_1))
+        self.assertEqual(self.sector.occupier, self.train_1.name)
+        self.assertTrue(self.sector.is_free(self.train_1))
+        self.assertFalse(self.sector.is_free(self.train_2))
+
+        # a train cannot release a sector it doesn't own
+        self.sector.release(self.train_2)
+        self.assertEqual(self.sector.occupier, self.train_1.name)
+
+        self.sector.release(self.train_1)
+        self.assertIsNone(self.sector.occupier)
+
+    def test_timeout(self):
+        self.sector.acquire(self.train_1)
+        self.assertFalse(self.sector.acquire(self.train_2, timeout=0.05))
+        self.assertFalse(self.sector.wait_until_free(self.train_2, timeout=0.05))
+        self.assertEqual(self.sector.occupier, self.train_1.name)
+
+    # waiter wakes up when the sector is released, either via the
+    # release method, or by direct assignment of its occupier
+    def test_wake_up(self):
+        for free in [lambda: self.sector.release(self.train_1),
+                     lambda: setattr(self.sector, "occupier", None)]:
+            self.sector.acquire(self.train_1)
+            result = []
+            waiter = Thread(target=lambda: result.append(self.sector.acquire(self.train_2, timeout=5.)))
+            waiter.start()
+            time.sleep(0.05)
+            self.assertListEqual(result, [])
+
+            start = time.monotonic()
+            free()
+            waiter.join()
+            self.assertLess(time.monotonic() - start, 0.1)
+            self.assertListEqual(result, [True])
+            self.assertEqual(self.sector.occupier, self.train_2.name)
+            self.sector.release(self.train_2)
+
+
+class TestXTrack(unittest.TestCase):
+    def test_wake_up(self):
+        xtrack = track.XTrack("test crossing")
+        train_1 = _TestTrain("train 1")
+        train_2 = _TestTrain("train 2")
+
+        xtrack.book(train_1)
+        self.assertFalse(xtrack.wait_until_free(train_2, timeout=0.05))
+        self.assertTrue(xtrack.wait_until_free(train_1, timeout=0.05))
+
+        result = []
+        waiter = Thread(target=lambda: result.append(xtrack.wait_until_free(train_2, timeout=5.)))
+        waiter.start()
+        time.sleep(0.05)
+
+        # second call to book by the same train releases the cross-track
+        xtrack.book(train_1)
+        waiter.join()
+        self.assertListEqual(result, [True])
+
+    # the GUI is only updated once the track lock is released
+    def test_report_unlocked(self):
+        xtrack = track.XTrack("test crossing")
+        train = _ReportingTrain("train 1")
+        xtrack.book(train)
+        xtrack.book(train)
+        xtrack.book(train)
+        xtrack.release(train)
+        self.assertListEqual(train.reports, [(track.tk_color[signal.RED], True),
+                                             (track.tk_color[track.INTER_SECTOR], True),
+                                             (track.tk_color[signal.RED], True),
+                                             (track.tk_color[track.INTER_SECTOR], True)])
+
+
+class TestReservationManager(unittest.TestCase):
+    def setUp(self):
+        self.manager = track.ReservationManager()
+        self.sector = track.Sector(signal.BLUE)
+        self.xtrack = track.XTrack("test crossing")
+        self.train_1 = _TestTrain("train 1")
+        self.train_2 = _TestTrain("train 2")
+
+    # either all resources are booked, or none
+    def test_all_or_nothing(self):
+        self.xtrack.book(self.train_2)
+
+        result = self.manager.reserve(self.train_1, [self.sector, self.xtrack], timeout=0)
+        self.assertIsNone(result)
+        self.assertIsNone(self.sector.occupier)
+
+        self.xtrack.book(self.train_2)
+        reservation = self.manager.reserve(self.train_1, [self.sector, None, self.xtrack], timeout=0)
+        self.assertIsNotNone(reservation)
+        self.assertEqual(self.sector.occupier, self.train_1.name)
+        self.assertEqual(self.xtrack.booked, self.train_1.name)
+
+        reservation.release()
+        self.assertIsNone(self.sector.occupier)
+        self.assertIsNone(self.xtrack.booked)
+
+    # resources taken over by another train are not released
+    def test_release_owned_only(self):
+        reservation = self.manager.reserve(self.train_1, [self.sector, self.xtrack])
+        self.sector.occupier = self.train_2.name
+        reservation.release()
+        self.assertEqual(self.sector.occupier, self.train_2.name)
+        self.assertIsNone(self.xtrack.booked)
+
+    # resources can be freed one at a time
+    def test_release_some(self):
+        reservation = self.manager.reserve(self.train_1, [self.sector, self.xtrack])
+        reservation.release([self.sector])
+        self.assertIsNone(self.sector.occupier)
+        self.assertEqual(self.xtrack.booked, self.train_1.name)
+        self.assertListEqual(reservation.resources, [self.xtrack])
+
+        reservation.release()
+        self.assertIsNone(self.xtrack.booked)
+        self.assertListEqual(reservation.resources, [])
+
+    # waiting train gets the resources when the last one is freed
+    def test_wait(self):
+        self.sector.acquire(self.train_2)
+        self.xtrack.book(self.train_2)
+
+        result = []
+        waiter = Thread(target=lambda: result.append(
+            self.manager.reserve(self.train_1, [self.xtrack, self.sector], timeout=5.)))
+        waiter.start()
+
+        self.sector.release(self.train_2)
+        time.sleep(0.05)
+        self.assertListEqual(result, [])
+        self.assertIsNone(self.sector.occupier)
+
+        self.xtrack.book(self.train_2)
+        waiter.join()
+        self.assertIsNotNone(result[0])
+        self.assertEqual(self.sector.occupier, self.train_1.name)
+        self.assertEqual(self.xtrack.booked, self.train_1.name)
+
+    # a request left with the manager is served when the resources are freed,
+    # without any thread waiting for them
+    def test_reserve_later(self):
+        clock.clock.use(clock.VirtualClock())
+        scheduler.scheduler.select(scheduler.VIRTUAL)
+        try:
+            self.sector.acquire(self.train_2)
+            served = []
+            # a cancelled request would have been served first
+            cancelled = self.manager.reserve_later(_TestTrain("train 3"), [self.sector], served.append)
+            self.manager.reserve_later(self.train_1, [self.sector, self.xtrack], served.append)
+            cancelled.cancel()
+
+            clock.clock.sleep(1.)
+            self.assertListEqual(served, [])
+            self.assertIsNone(self.xtrack.booked)
+
+            self.sector.release(self.train_2)
+            clock.clock.sleep(1.)
+            self.assertEqual(len(served), 1)
+            self.assertEqual(served[0].train, self.train_1)
+            self.assertEqual(self.sector.occupier, self.train_1.name)
+            self.assertEqual(self.xtrack.booked, self.train_1.name)
+            self.assertListEqual(self.manager.waiting, [])
+        finally:
+            clock.clock.use(clock.RealClock())
+            scheduler.scheduler.select(scheduler.THREADED)
+
+    # booking status is reported outside the track lock, whether the
+    # resources are reserved directly or served to a waiting request
+    def test_report_unlocked(self):
+        clock.clock.use(clock.VirtualClock())
+        scheduler.scheduler.select(scheduler.VIRTUAL)
+        try:
+            train = _ReportingTrain("train 1")
+            reservation = self.manager.reserve(train, [self.sector, self.xtrack], timeout=0)
+            reservation.release()
+
+            self.sector.acquire(self.train_2)
+            self.manager.reserve_later(train, [self.sector, self.xtrack], lambda reservation: None)
+            self.sector.release(self.train_2)
+            clock.clock.sleep(1.)
+
+            red, free = track.tk_color[signal.RED], track.tk_color[track.INTER_SECTOR]
+            self.assertListEqual(train.reports, [(red, True), (free, True), (red, True)])
+        finally:
+            clock.clock.use(clock.RealClock())
+            scheduler.scheduler.select(scheduler.THREADED)
+
+
+if __name__ == "__main__":
+    unittest.main()